@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup time: importing the entry script with everything it imports.
+
+Every measurement runs fresh interpreter; the time of bare interpreter
+startup is subtracted. Fails when any of the slow modules that should be
+imported only when needed (e.g. 'requests') is imported, or when the import
+takes longer than '--max-ms'.
+Usage: python3 benchmarks/bench_import.py [-r REPEAT] [--max-ms MS]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# the entry script, its name is the same as name of the package, so it's
+# imported from its path
+ENTRY_SCRIPT = 'replay_downloader.py'
+
+# modules that must not be imported at startup, they are needed only by some
+# runs (HTTP, '--spool', native extracting, ranged downloads)
+LAZY_MODULES = ('requests', 'urllib3', 'http.client', 'http.cookiejar', 'ssl', 'sqlite3',
+                'concurrent.futures', 'mmap')
+
+
+def run(code: str) -> tuple:
+    """Returns wall time of running the code in new interpreter and its output."""
+    start = time.perf_counter()
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return time.perf_counter() - start, out.decode('utf-8').strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=0,
+                        help='fail when the import takes longer (0 = no limit)')
+    args = parser.parse_args()
+
+    code = ('import importlib.util, sys\n'
+            'spec = importlib.util.spec_from_file_location("__startup__", {!r})\n'
+            'spec.loader.exec_module(importlib.util.module_from_spec(spec))\n'
+            'print(" ".join(m for m in {!r} if m in sys.modules))').format(ENTRY_SCRIPT,
+                                                                            LAZY_MODULES)
+    bare = min(run('pass')[0] for _ in range(args.repeat))
+    times = []
+    for _ in range(args.repeat):
+        elapsed, loaded = run(code)
+        times.append(elapsed - bare)
+    times.sort()
+    print('import     min {:7.1f} ms  median {:7.1f} ms  (interpreter {:.1f} ms)'.format(
+        times[0] * 1000, times[len(times) // 2] * 1000, bare * 1000))
+
+    failed = False
+    if loaded:
+        print('imported at startup:', loaded)
+        failed = True
+    if args.max_ms and times[0] * 1000 > args.max_ms:
+        print('slower than {:.1f} ms'.format(args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
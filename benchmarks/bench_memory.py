@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory usage of file records.
+
+Compares current file records with the original namedtuple based ones.
+Usage: python3 benchmarks/bench_memory.py [NUM_RECORDS]
+"""
+
+import collections
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from replay_downloader.mappings import Fileinfo, Ftypes, Rtypes
+from replay_downloader.record import FileRecord
+
+
+# the original representation
+LegacyFileinfo = collections.namedtuple('LegacyFileinfo', 'path type clname audio_f video_f')
+LegacyFileinfo.__new__.__defaults__ = ('', '', '')
+
+
+class LegacyFileRecord:
+    def __init__(self, file_info):
+        self.rec = [file_info]
+
+    def add(self, file_info):
+        self.rec.append(file_info)
+
+
+def build(fileinfo, file_record, num):
+    """Creates records the same way as the pipeline does (download + extract audio)."""
+    records = []
+    for i in range(num):
+        name = '2015{:06d}_TS_ChNN_Atiyoga_Teachings_Tashigar_South'.format(i)
+        rec = file_record(fileinfo('rtmp://' + name + '.mp3', Rtypes.RTMP))
+        rec.add(fileinfo(os.path.join('/var/tmp/replay_work', name + '.flv'), Ftypes.FLV,
+                         ''.join(['Down', 'load']), Ftypes.MP3))
+        rec.add(fileinfo(os.path.join('/srv/replay/archive', name + '.mp3'), Ftypes.MP3,
+                         ''.join(['Extract', 'Audio']), Ftypes.MP3))
+        records.append(rec)
+    return records
+
+
+def measure(fileinfo, file_record, num):
+    tracemalloc.start()
+    records = build(fileinfo, file_record, num)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    legacy = measure(LegacyFileinfo, LegacyFileRecord, num)
+    compact = measure(Fileinfo, FileRecord, num)
+    print('records: {}'.format(num))
+    print('namedtuple: {:.1f} MiB'.format(legacy / 1024 / 1024))
+    print('compact:    {:.1f} MiB'.format(compact / 1024 / 1024))
+    print('saved:      {:.0f} %'.format(100 - compact * 100 / legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput of listing, downloading and extracting against local fake server.
+
+Runs the pipeline (download, extract_audio, cleanup) on direct links to FLV
+files served by 'tests/fake_replay_server.py' and fetches HLS segments of
+all recordings in parallel.
+Usage: python3 benchmarks/bench_pipeline.py [-n RECORDINGS] [-s SIZE] [-l LATENCY]
+       [-e ERROR_RATE] [-c CONCURRENCY]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from replay_downloader import hls, perform, session, stages
+from replay_downloader.config import Config
+from replay_downloader.download import Download, iter_replay_list
+from replay_downloader.mappings import Rtypes
+from replay_downloader.utils import parse_size
+from tests.fake_replay_server import FakeReplayServer
+
+
+def report(name: str, elapsed: float, count: int, size: int = 0):
+    line = '{:<10} {:8.3f} s {:10.1f} /s'.format(name, elapsed, count / elapsed)
+    if size:
+        line += ' {:10.1f} MiB/s'.format(size / elapsed / 1024 / 1024)
+    print(line)
+
+
+def bench_listing(conf: Config, repeat: int = 20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        list(iter_replay_list(Rtypes.RTMP, conf))
+        list(iter_replay_list(Rtypes.HTTP, conf))
+    report('listing', time.perf_counter() - start, repeat * 2)
+
+
+def bench_segments(conf: Config, server: FakeReplayServer, concurrency: int):
+    ses = session.get_session(conf)
+    urls = []
+    for url in iter_replay_list(Rtypes.HTTP, conf):
+        master = hls.Playlist(ses.get(url).text, url)
+        variant = master.variants[0].url
+        urls.extend(hls.Playlist(ses.get(variant).text, variant).segment_urls)
+
+    def fetch(url):
+        response = ses.get(url)
+        return len(response.content) if response.ok else 0
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        size = sum(executor.map(fetch, urls))
+    report('segments', time.perf_counter() - start, len(urls), size)
+
+
+def bench_pipeline(conf: Config, server: FakeReplayServer, concurrency: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        to_do = [Download.parse_line(server.media_url(name)) for name in server.recordings]
+        context = {'work_dir': tmpdir, 'destination': tmpdir, 'concurrency': concurrency}
+        work, tasks = stages.build_pipeline(conf, ['download', 'extract_audio', 'cleanup'],
+                                            to_do, context)
+        start = time.perf_counter()
+        perform.do_the_work(work, lambda: None)
+        elapsed = time.perf_counter() - start
+        if tasks['download'].obj.executor is not None:
+            tasks['download'].obj.executor.shutdown()
+    report('pipeline', elapsed, len(server.recordings), len(server.recordings) * server.media_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--recordings', type=int, default=20)
+    parser.add_argument('-s', '--size', default='4M', help='size of one recording')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='seconds waited before every response')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help='probability that segment request fails')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    segments = 10
+    with FakeReplayServer(recordings=args.recordings, segments=segments,
+                          segment_size=size // segments, media_size=size,
+                          latency=args.latency, error_rate=args.error_rate) as server, \
+            tempfile.TemporaryDirectory() as tmpdir:
+        conf = Config()
+        conf.AUTH.cookie_file = os.path.join(tmpdir, 'cookies')
+        server.configure(conf)
+        perform.LOOP_DELAY = 0.01
+
+        bench_listing(conf)
+        bench_segments(conf, server, args.concurrency)
+        bench_pipeline(conf, server, args.concurrency)
+        session.close_session()
+        print('requests:', dict(server.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,17 +11,24 @@ It can download from both standard replay and mobile replay.
 
 
 import argparse
+import cProfile
+import json
 import sys
 
 from replay_downloader import (
-    cleanup,
     config,
+    control,
+    daemon,
     download,
-    extract_audio,
     log,
     mappings,
     msgs,
     perform,
+    planner,
+    simulate,
+    stages,
+    todo,
+    trace,
     utils
 )
 
@@ -44,8 +51,12 @@ def cmd_arguments():
                         help='get list of remote files from mobile replay')
     parser.add_argument('-a', '--append', action='store_true',
                         help='append new list of remote files to existing file')
-    parser.add_argument('-g', '--get-list', metavar='FILE',
-                        help='download all files on list')
+    parser.add_argument('-g', '--get-list', metavar='FILE', nargs='+',
+                        help="download all files on list(s), '-' for stdin")
+    parser.add_argument('--spool', metavar='FILE',
+                        help='keep queue of files to download on disk; '
+                        'unfinished queue is resumed when the same file is used again '
+                        '(with the same lists, or without them)')
     parser.add_argument('-f', '--download-file', metavar='REMOTE_FILE_NAME',
                         help='download remote file')
     parser.add_argument('-p', '--concurrent', metavar='NUM', type=int,
@@ -65,6 +76,25 @@ def cmd_arguments():
     parser.add_argument('--cleanup',
                         help='delete intermediate files',
                         action='store_true')
+    parser.add_argument('--plan', action='store_true',
+                        help='estimate download times and start the longest downloads first')
+    parser.add_argument('--simulate', metavar='NUM[,NUM...]',
+                        help='simulate the pipeline with listed download concurrencies '
+                        '(see [SIMULATE] config section) and exit')
+    parser.add_argument('--sim-trace', metavar='LOGFILE',
+                        help='use jobs from log file of previous run for simulation')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write timeline of all jobs to FILE (Chrome trace format, '
+                        'view in Perfetto), not with --daemon')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the main loop, write cProfile stats to FILE')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, poll replay listings and accept commands '
+                        'on control socket')
+    parser.add_argument('--ctl', metavar='CMD', nargs='+',
+                        help='send command to running daemon: status, poll, stop, reload, '
+                        'drain, enqueue ENTRY..., pause STAGE, resume STAGE, '
+                        'concurrency STAGE NUM')
     return parser
 
 
@@ -84,18 +114,71 @@ def get_avail_list(cmd_parser, cfg):
         sys.exit(mappings.ExitCodes.CONFIG)
 
 
+def control_daemon(args, cfg):
+    """Sends command to running daemon and exit."""
+    if not args.ctl:
+        return
+
+    try:
+        response = daemon.send_command(cfg.DAEMON.socket, daemon.parse_command(args.ctl))
+    except ValueError as emsg:
+        print('Error: {}'.format(emsg), file=sys.stderr)
+        sys.exit(mappings.ExitCodes.CONFIG)
+    except EnvironmentError as emsg:
+        print('Error: cannot connect to daemon: {}'.format(emsg), file=sys.stderr)
+        sys.exit(mappings.ExitCodes.FAIL)
+
+    print(json.dumps(response, indent=2))
+    sys.exit(mappings.ExitCodes.SUCCESS if response.get('ok') else mappings.ExitCodes.FAIL)
+
+
+def run_simulation(args, cfg):
+    """Simulates the pipeline with different settings and exit."""
+    if not args.simulate:
+        return
+
+    opts = cfg.SIMULATE
+    try:
+        concurrencies = [int(num) for num in args.simulate.split(',')]
+        extract_slots = [int(num) for num in opts.extract_concurrency.split(',')
+                         if num.strip()]
+        extract_rate = utils.parse_size(opts.extract_rate)
+        if args.sim_trace:
+            jobs = simulate.jobs_from_log(args.sim_trace)
+        else:
+            jobs = simulate.synthetic_jobs(int(opts.jobs), utils.parse_size(opts.mean_size),
+                                           extract_rate)
+        results = simulate.sweep(jobs, concurrencies, utils.parse_size(opts.bandwidth),
+                                 utils.parse_size(opts.job_bandwidth), extract_rate,
+                                 extract_slots)
+    except (EnvironmentError, ValueError) as emsg:
+        print('Error: {}'.format(emsg), file=sys.stderr)
+        sys.exit(mappings.ExitCodes.CONFIG)
+
+    print('Simulated {} job(s)'.format(len(jobs)))
+    print(simulate.format_results(results))
+    sys.exit(mappings.ExitCodes.SUCCESS)
+
+
 def get_list_to_download(args):
-    """Returns list of files to download."""
-    # list of files to download was specified
+    """Returns iterator of lines with files to download."""
+    # list(s) of files to download was specified
     if args.get_list:
-        try:
-            to_download_list = utils.get_list_from_file(args.get_list)
-        except EnvironmentError as emsg:
-            print(str(emsg), file=sys.stderr)
-            sys.exit(mappings.ExitCodes.CONFIG)
+        # fail early if any of the files can't be read
+        for list_file in args.get_list:
+            if list_file == '-':
+                continue
+            try:
+                open(list_file).close()
+            except EnvironmentError as emsg:
+                print(str(emsg), file=sys.stderr)
+                sys.exit(mappings.ExitCodes.CONFIG)
+        to_download_list = utils.iter_lines_from_files(args.get_list)
     # single file to download was specified
     elif args.download_file:
         to_download_list = [args.download_file]
+    else:
+        to_download_list = []
     return to_download_list
 
 
@@ -131,12 +214,17 @@ def main():
         sys.exit(mappings.ExitCodes.CONFIG)
 
     get_avail_list(cmd_parser, cfg)
-    log.log_init(args.logfile)
+    control_daemon(args, cfg)
+    run_simulation(args, cfg)
+    if args.daemon and args.trace:
+        # the trace is kept in memory until the program exits
+        print('Error: --trace can\'t be used with --daemon', file=sys.stderr)
+        sys.exit(mappings.ExitCodes.CONFIG)
+    log.log_init(args.logfile, utils.parse_size(cfg.LOG.max_size),
+                 int(cfg.LOG.backup_count))
+    trace.trace_init(args.trace)
     messages, msg_handler = msgs.setup_messages(args)
 
-    # instantiate work pipeline
-    work = perform.Work()
-
     # number of concurrent processes
     avail_slots = args.concurrent if args.concurrent > 0 else cfg.RUN.concurrency
 
@@ -146,37 +234,81 @@ def main():
     # directory for intermediate files
     workdir = args.work_dir if args.work_dir else cfg.RUN.work_dir
 
+    # files to download are loaded lazily, as they are needed
+    spool = todo.SpoolFile(args.spool) if args.spool else None
+    to_download = todo.TodoQueue(get_list_to_download(args),
+                                 download.Download.parse_line, spool=spool)
+
+    if args.plan:
+        plan = planner.Planner(cfg, avail_slots)
+        to_download = plan.plan(to_download)
+        if not args.quiet and plan.complete:
+            print('Predicted download time: {:.0f} s'.format(plan.predicted))
+        elif not args.quiet:
+            print('Predicted download time of first {} entries: {:.0f} s'.format(
+                len(plan.durations), plan.predicted))
+
     #
     # Create the work pipeline. When one step of the pipeline is finished
     # with processing one item from it's stack, the outcome is passed to next
     # step on the pipeline.
     # Work is finished when all steps in the pipeline are finished.
     #
+    stage_names = [name.strip() for name in cfg.PIPELINE.stages.split(',') if name.strip()]
+    if args.cleanup and 'cleanup' not in stage_names:
+        stage_names.append('cleanup')
+    if utils.parse_size(cfg.CLEANUP.cache_size) and 'cleanup' not in stage_names:
+        print("Warning: nothing is added to the cache and evicted from it "
+              "without the cleanup stage ('--cleanup')", file=sys.stderr)
+    context = {'work_dir': workdir, 'destination': dest_dir, 'concurrency': avail_slots,
+               'concurrency_override': args.concurrent if args.concurrent > 0 else 0}
+    try:
+        work, tasks = stages.build_pipeline(cfg, stage_names, to_download, context)
+    except ValueError as emsg:
+        print('Error: {}'.format(emsg), file=sys.stderr)
+        sys.exit(mappings.ExitCodes.CONFIG)
 
-    # get processed list of files to download
-    to_download = download.Download.parse_todownload_list(get_list_to_download(args))
-
-    # download setup
-    downloads = download.Download(cfg, to_download, destination=workdir)
-    scheduler = perform.ProcScheduler(downloads, avail_slots)
-    work.add(scheduler)
-
-    # extract audio setup
-    extracting = extract_audio.ExtractAudio(cfg, downloads.finished_ready, destination=dest_dir)
-    scheduler = perform.ProcScheduler(extracting, avail_slots)
-    work.add(scheduler)
-
-    if args.cleanup:
-        # cleanup setup
-        work.add(cleanup.Cleanup(extracting.finished_ready))
-
-    perform.check_required_tools(work)
-    perform.do_the_work(work, msg_handler)
+    if args.plan and 'download' in tasks:
+        tasks['download'].obj.on_finished = plan.finished
+
+    perform.check_required_tools(work, cfg.COMMANDS.probe_cache)
+    if args.plan:
+        plan.start()
+    # SIGHUP reloads configuration, SIGUSR1 drains the pipeline
+    controller = control.Controller(cfg, work, to_download,
+                                    args.concurrent if args.concurrent > 0 else 0)
+    with controller:
+        if args.daemon:
+            try:
+                daemon.Daemon(cfg, work, tasks, to_download,
+                              controller=controller).run(msg_handler)
+            except FileExistsError as emsg:
+                print('Error: {}'.format(emsg), file=sys.stderr)
+                sys.exit(mappings.ExitCodes.FAIL)
+        elif args.profile:
+            profiler = cProfile.Profile()
+            profiler.runcall(perform.do_the_work, work, msg_handler, controller)
+            profiler.dump_stats(args.profile)
+        else:
+            perform.do_the_work(work, msg_handler, controller)
+    trace.trace_shutdown()
 
     if not args.quiet:
         messages.print_summary()
-
-    sys.exit(get_retval(messages))
+        if controller.saved:
+            print('\nDrained, {} unfinished entries saved to {}'.format(
+                controller.saved, controller.saved_to))
+
+    if args.plan:
+        plan.save()
+        if not args.quiet and plan.actual() is not None:
+            print('\nDownload time predicted: {:.0f} s, actual: {:.0f} s'.format(
+                plan.predicted, plan.actual()))
+
+    retval = get_retval(messages)
+    if controller.saved and retval == mappings.ExitCodes.SUCCESS:
+        retval = mappings.ExitCodes.INCOMPLETE
+    sys.exit(retval)
 
 
 if __name__ == '__main__':
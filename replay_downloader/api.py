@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Running the pipeline from other Python programs.
+
+The pipeline is built once and runs in background thread, entries (lines in
+the same format as the list of files to download) can be submitted at any
+time. Every entry gets a future, for example:
+
+    with Pipeline(config.get_config_file(None)) as pipeline:
+        futures = pipeline.submit(['20151205_TS_Teaching.mp3'])
+        print(futures[0].result().path)
+
+Nothing is printed, progress is reported by callbacks. Messages of the
+stages are discarded and their message queues are removed on shutdown.
+"""
+
+import collections
+import concurrent.futures
+import queue
+import threading
+
+from replay_downloader import config, download, log, msgs, perform, stages
+
+
+# outcome of entry that went through the whole pipeline; 'path' is the final file
+Result = collections.namedtuple('Result', 'entry path record')
+
+# progress event; 'kind' is one of 'queued', 'running' (in 'stage'), 'finished', 'failed'
+Event = collections.namedtuple('Event', 'kind entry stage record')
+
+
+class JobFailed(Exception):
+    """Processing of the entry failed in one of the stages."""
+
+    def __init__(self, entry: str, stage: str, file_record):
+        super().__init__("'{}' failed in stage '{}'".format(entry, stage))
+        self.entry = entry
+        self.stage = stage
+        self.record = file_record
+
+
+class _Job:
+    __slots__ = ('entry', 'future', 'location', 'record')
+
+    def __init__(self, entry: str, future: concurrent.futures.Future, file_record):
+        self.entry = entry
+        self.future = future
+        # (stage, state) where the record was seen last
+        self.location = None
+        self.record = file_record
+
+    def failed(self) -> JobFailed:
+        return JobFailed(self.entry, self.location[0] if self.location else '', self.record)
+
+
+class Pipeline:
+    """Work pipeline running in background thread.
+
+    The stages, the HTTP session and pools of workers are shared by all
+    submitted entries.
+    """
+
+    def __init__(self, conf: config.Config, stage_names: list = None, work_dir: str = '',
+                 destination: str = '', concurrency: int = None, callback=None):
+        """
+        Args:
+            conf (Config): Configuration.
+            stage_names (list): Names of the stages, '[PIPELINE] stages' by default.
+            work_dir (str): Directory for intermediate files.
+            destination (str): Directory where final outcome will be saved.
+            concurrency (int): Default number of parallel jobs in every stage.
+            callback: Called with 'Event' whenever a job moves in the pipeline.
+        """
+        if stage_names is None:
+            stage_names = [name.strip() for name in conf.PIPELINE.stages.split(',')
+                           if name.strip()]
+        context = {'work_dir': work_dir or conf.RUN.work_dir,
+                   'destination': destination or conf.RUN.destination_dir,
+                   'concurrency': concurrency or conf.RUN.concurrency}
+        self.to_do = []
+        self.work, self.tasks = stages.build_pipeline(conf, stage_names, self.to_do, context)
+        self._callbacks = [callback] if callback is not None else []
+        # jobs by record id
+        self._jobs = {}
+        # entries submitted by other threads
+        self._submitted = queue.Queue()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._drain = True
+        self._thread = threading.Thread(target=self._run, name='replay-pipeline', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(wait=exc[0] is None)
+
+    def add_callback(self, callback):
+        """Adds callable that gets 'Event' whenever a job moves in the pipeline."""
+        self._callbacks.append(callback)
+
+    def submit(self, entries) -> list:
+        """Adds entries to the pipeline, returns list of futures, one per entry.
+
+        Result of the future is 'Result', 'JobFailed' is raised when the
+        entry failed and 'ValueError' when it can't be parsed.
+        """
+        if self._stopping:
+            raise RuntimeError('cannot submit entries after shutdown')
+        futures = []
+        for entry in entries:
+            future = concurrent.futures.Future()
+            self._submitted.put((entry, future))
+            futures.append(future)
+        self._wakeup.set()
+        return futures
+
+    def shutdown(self, wait: bool = True):
+        """Stops the pipeline.
+
+        With 'wait' all submitted entries are processed first, otherwise
+        running processes are killed, futures of entries that were not
+        started are cancelled and the others fail with 'JobFailed'.
+        """
+        self._drain = wait
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _emit(self, kind: str, job: _Job, stage: str, file_record):
+        event = Event(kind, job.entry, stage, file_record)
+        for callback in self._callbacks:
+            try:
+                callback(event)
+            # pylint: disable=broad-except
+            except Exception as emsg:
+                log.logit('[api] callback failed: {}'.format(emsg), 'error')
+
+    def _enqueue_submitted(self):
+        while True:
+            try:
+                entry, future = self._submitted.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                file_record = download.Download.parse_line(entry)
+            except ValueError as emsg:
+                future.set_exception(emsg)
+                continue
+            if file_record is None:
+                future.set_exception(ValueError("nothing to do for '{}'".format(entry)))
+                continue
+            self._jobs[file_record.id] = _Job(entry, future, file_record)
+            self.to_do.append(file_record)
+
+    def _locate(self) -> dict:
+        """Returns (stage, state) and record of every record in the pipeline, by record id."""
+        found = {}
+        for name, task in self.tasks.items():
+            for file_record in task.to_do:
+                found[file_record.id] = ((name, 'queued'), file_record)
+            obj = getattr(task, 'obj', task)
+            records = getattr(obj, 'records', None)
+            for procinfo in getattr(task, 'running_procs', ()):
+                for file_record in (records(procinfo) if records else [procinfo.file_record]):
+                    found[file_record.id] = ((name, 'running'), file_record)
+        return found
+
+    def _update(self, finished: list):
+        """Resolves futures of finished and failed jobs and reports progress."""
+        for file_record in finished:
+            job = self._jobs.pop(file_record.id, None)
+            if job is not None:
+                self._emit('finished', job, '', file_record)
+                job.future.set_result(Result(job.entry, file_record[-1].path, file_record))
+
+        found = self._locate()
+        for rec_id, job in list(self._jobs.items()):
+            if rec_id not in found:
+                # the stage dropped the record
+                del self._jobs[rec_id]
+                exc = job.failed()
+                self._emit('failed', job, exc.stage, job.record)
+                job.future.set_exception(exc)
+                continue
+            location, file_record = found[rec_id]
+            if location != job.location:
+                job.location = location
+                self._emit(location[1], job, location[0], file_record)
+
+    def _stage_outs(self) -> list:
+        """Returns message queues of all stages."""
+        return [task.obj.out for task in self.tasks.values()
+                if hasattr(getattr(task, 'obj', None), 'out')]
+
+    def _cancel_all(self):
+        for job in self._jobs.values():
+            job.future.set_exception(job.failed())
+        self._jobs.clear()
+        while True:
+            try:
+                self._submitted.get_nowait()[1].cancel()
+            except queue.Empty:
+                return
+
+    def _run(self):
+        """The main loop, runs in background thread."""
+        try:
+            with perform.CleanExit(self.work):
+                while not self._stopping or (self._drain and
+                                             (self._jobs or not self._submitted.empty())):
+                    self._enqueue_submitted()
+                    for task in self.work:
+                        if isinstance(task, perform.Discard):
+                            self._update(list(task.to_do))
+                        task()
+                    # nothing prints the messages, don't let them pile up
+                    for out in self._stage_outs():
+                        for msglist in out.values():
+                            msglist.clear()
+                    self._wakeup.wait(perform.LOOP_DELAY)
+                    self._wakeup.clear()
+        # pylint: disable=broad-except
+        except Exception as emsg:
+            log.logit('[api] pipeline failed: {}'.format(emsg), 'error')
+        finally:
+            self._cancel_all()
+            for out in self._stage_outs():
+                msgs.out_remove(out)
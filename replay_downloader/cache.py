@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Work directory as cache of intermediate files.
+
+Intermediate files (downloaded FLV and MP4 files) are kept after the
+pipeline is done with them and the least recently used ones are deleted
+when their total size exceeds the budget. Download of a file that is in the
+cache is skipped. Only files added by the cleanup stage are managed, their
+last use is recorded in index file in the work directory; without the
+cleanup stage nothing is added to the cache and nothing is evicted.
+
+Unfinished downloads that are too old can be deleted from the work
+directory at start, whether the cache is on or not. Only files with names
+the downloads use are deleted.
+"""
+
+import json
+import os
+import threading
+import time
+
+from replay_downloader import config, log, mappings, ranged, utils
+
+
+INDEX_NAME = '.replay_cache.json'
+
+# extensions of downloaded files (see 'download.MEDIA_TYPES')
+MEDIA_EXTS = ('.flv', '.mp4', '.mp3', '.m4a', '.aac')
+
+# names of unfinished downloads end with one of these
+PART_SUFFIXES = tuple(ext + mappings.PART_EXT for ext in MEDIA_EXTS) + tuple(
+    ext + mappings.PART_EXT + ranged.RANGES_EXT for ext in MEDIA_EXTS)
+
+# caches by directory
+_CACHES = {}
+# directories where old unfinished downloads were deleted
+_SWEPT = set()
+_LOCK = threading.Lock()
+
+
+def sweep_parts(directory: str, max_age: float, now: float = None) -> list:
+    """Deletes unfinished downloads older than 'max_age' seconds, returns deleted files."""
+    deleted = []
+    now = time.time() if now is None else now
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return deleted
+    for name in names:
+        # e.g. partial downloads of web browser are not ours
+        if not name.lower().endswith(PART_SUFFIXES):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                deleted.append(path)
+        except OSError:
+            pass
+    for path in deleted:
+        log.logit('[cache] removed stale {}'.format(path), file=path)
+    return deleted
+
+
+class WorkCache:
+    """Size-bounded LRU cache of files in directory."""
+
+    def __init__(self, directory: str, max_size: int, clock=time.time):
+        """
+        Args:
+            directory (str): The work directory.
+            max_size (int): Budget for total size of cached files in bytes.
+        """
+        self.directory = os.path.abspath(os.path.expanduser(directory or '.'))
+        self.max_size = max_size
+        self.clock = clock
+        self.index_path = os.path.join(self.directory, INDEX_NAME)
+        # time of last use by absolute path
+        self.used = {}
+        # cached files used by running jobs, never evicted
+        self.pinned = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as ifl:
+                used = json.load(ifl)
+        except (EnvironmentError, ValueError):
+            return
+        self.used = {path: tstamp for path, tstamp in used.items() if os.path.isfile(path)}
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as ofl:
+            json.dump(self.used, ofl)
+        os.replace(tmp_path, self.index_path)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self.used and os.path.isfile(path)
+
+    def size(self) -> int:
+        """Returns total size of cached files."""
+        total = 0
+        for path in self.used:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def use(self, path: str):
+        """Records use of cached file.
+
+        It's not evicted until it's stored again or released.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self.used[path] = self.clock()
+            self.pinned.add(path)
+            self._save()
+
+    def release(self, paths: list):
+        """Allows eviction of files used by job that failed."""
+        with self._lock:
+            for path in paths:
+                self.pinned.discard(os.path.abspath(path))
+
+    def store(self, paths: list) -> list:
+        """Adds existing files to the cache, returns files that should be evicted.
+
+        The evicted files are removed from the cache, the caller deletes them.
+        """
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                if os.path.isfile(path) and os.path.dirname(path) == self.directory:
+                    self.used[path] = self.clock()
+                    self.pinned.discard(path)
+            evicted = self._victims()
+            self._save()
+        return evicted
+
+    def _victims(self) -> list:
+        sizes = {}
+        for path in list(self.used):
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                # deleted by somebody else
+                del self.used[path]
+        total = sum(sizes.values())
+        evicted = []
+        for path in sorted(self.used, key=self.used.get):
+            if total <= self.max_size:
+                break
+            if path in self.pinned:
+                continue
+            total -= sizes[path]
+            del self.used[path]
+            evicted.append(path)
+        return evicted
+
+    def sweep_parts(self, max_age: float) -> list:
+        """Deletes unfinished downloads older than 'max_age' seconds, returns deleted files."""
+        return sweep_parts(self.directory, max_age, self.clock())
+
+
+def get_cache(conf: config.Config, directory: str) -> WorkCache:
+    """Returns cache of the directory shared by all stages, None when caching is off.
+
+    Stale unfinished downloads are removed from the directory on first call,
+    also when caching is off.
+    """
+    max_size = utils.parse_size(conf.CLEANUP.cache_size)
+    key = os.path.abspath(os.path.expanduser(directory or '.'))
+    with _LOCK:
+        if key not in _SWEPT:
+            _SWEPT.add(key)
+            max_age = float(conf.CLEANUP.part_max_age or 0)
+            if max_age > 0:
+                sweep_parts(key, max_age)
+        if not max_size:
+            return None
+        if key not in _CACHES:
+            _CACHES[key] = WorkCache(key, max_size)
+        return _CACHES[key]
+
+
+def release(paths: list):
+    """Allows eviction of the files in all caches, e.g. when the job using them failed."""
+    with _LOCK:
+        caches = list(_CACHES.values())
+    for work_cache in caches:
+        work_cache.release(paths)
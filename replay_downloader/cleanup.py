@@ -5,33 +5,93 @@ Cleanup.
 
 import os
 
-from replay_downloader import log, mappings, msgs
+from replay_downloader import cache, config, log, mappings, msgs, perform, record, trace
+
+
+def delete_files(paths: list) -> list:
+    """Deletes files (and their unfinished versions), returns list of deleted files."""
+    deleted = []
+    for path in paths:
+        try:
+            os.remove(path)
+            deleted.append(path)
+            os.remove(path + mappings.PART_EXT)
+            deleted.append(path + mappings.PART_EXT)
+        except FileNotFoundError:
+            pass
+    return deleted
 
 
 class Cleanup:
-    """ Deletes all intermediate files. Callable object for work pipeline."""
+    """ Deletes all intermediate files.
+
+    With cache, the intermediate files are kept in the cache and only the
+    files evicted from the cache are deleted.
+
+    Callable object for work pipeline ('inline' backend) or schedulable
+    object for 'ProcScheduler' with pool of workers ('thread' and 'process'
+    backends).
+    """
+
+    config_section = 'CLEANUP'
+    backends = ('inline', 'thread', 'process')
 
-    def __init__(self, to_do: list):
+    def __init__(self, to_do: list, work_cache: cache.WorkCache = None):
         self.out = {mappings.MsgTypes.finished: msgs.MsgList('Deleted')}
         msgs.out_add(self.out)
         self.finished_ready = []
         self.to_do = to_do
+        # pool of workers, set by the pipeline for 'thread' and 'process' backends
+        self.executor = None
+        self.cache = work_cache
+
+    @classmethod
+    def create(cls, conf: config.Config, to_do: list, context: dict):
+        return cls(to_do, cache.get_cache(conf, context.get('work_dir', '')))
+
+    def _to_delete(self, file_record: record.FileRecord) -> list:
+        """Returns intermediate files of the record that should be deleted."""
+        paths = [rec.path for rec in file_record[:-1]]
+        if self.cache is None:
+            return paths
+        evicted = self.cache.store(paths)
+        for path in paths:
+            if path in self.cache:
+                log.logit('[cache] keeping {}'.format(path),
+                          job=file_record.id, stage='cleanup', file=path)
+        return evicted
+
+    def _deleted(self, file_record: record.FileRecord, deleted: list):
+        for path in deleted:
+            log.logit('[cleanup] {}'.format(path),
+                      job=file_record.id, stage='cleanup', file=path)
+            self.out[mappings.MsgTypes.finished].add(path)
 
     def __call__(self) -> bool:
         """Goes through every file record and delete all existing files except the last one."""
         length = len(self.to_do)
         for _ in range(length):
             file_record = self.to_do.pop()
-            for rec in file_record[:-1]:
-                try:
-                    os.remove(rec.path)
-                    log.logit('[cleanup] {}'.format(rec.path))
-                    self.out[mappings.MsgTypes.finished].add(rec.path)
-                    os.remove(rec.path + mappings.PART_EXT)
-                    log.logit('[cleanup] {}'.format(rec.path + mappings.PART_EXT))
-                    self.out[mappings.MsgTypes.finished].add(rec.path + mappings.PART_EXT)
-                except FileNotFoundError:
-                    pass
+            trace.job_dequeued(file_record, type(self).__name__)
+            with trace.job_span(file_record, 'cleanup', type(self).__name__):
+                self._deleted(file_record, delete_files(self._to_delete(file_record)))
             # pass for further processing
             self.finished_ready.append(file_record)
         return True
+
+    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
+        """Deletes files of the record in the pool of workers."""
+        future = self.executor.submit(delete_files, self._to_delete(file_record))
+        return mappings.Procinfo(perform.FutureProc(future), file_record)
+
+    def finished_handler(self, procinfo: mappings.Procinfo) -> int:
+        retcode = procinfo.proc.poll()
+        if retcode == 0:
+            self._deleted(procinfo.file_record, procinfo.proc.result())
+        else:
+            log.logit('[cleanup] failed: {}'.format(
+                procinfo.proc.communicate()[1].decode('utf-8')), 'error',
+                      job=procinfo.file_record.id, stage='cleanup')
+        # pass for further processing
+        self.finished_ready.append(procinfo.file_record)
+        return retcode
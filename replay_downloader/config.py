@@ -19,22 +19,141 @@ class Config:
         """
         # default values
         self.cfg = configparser.ConfigParser()
+        self.path = cfg_path
         self.cfg['RUN'] = {'concurrency': '3',
                            'destination_dir': '',
-                           'work_dir': ''}
-        self.cfg['AUTH'] = {'login': '', 'password': ''}
-        self.cfg['COMMANDS'] = {'rtmpdump': 'rtmpdump', 'ffmpeg': 'ffmpeg'}
+                           'work_dir': '',
+                           # options of the running program are reloaded when
+                           # 'control_file' changes (or on SIGHUP), 'drain = yes'
+                           # stops starting new downloads, entries that were not
+                           # started are saved to 'resume_file' (or to the spool)
+                           'control_file': '',
+                           'resume_file': '~/.cache/replay_downloader/resume',
+                           'drain': 'no'}
+        # login cookies are cached in 'cookie_file' for 'cookie_max_age' seconds
+        self.cfg['AUTH'] = {'login': '', 'password': '',
+                            'cookie_file': '~/.cache/replay_downloader/cookies',
+                            'cookie_max_age': '86400'}
+        # versions of the commands are cached in 'probe_cache'
+        self.cfg['COMMANDS'] = {'rtmpdump': 'rtmpdump', 'ffmpeg': 'ffmpeg',
+                                'probe_cache': '~/.cache/replay_downloader/tools.json'}
+        # priority of spawned processes: niceness, IO scheduling class
+        # ('realtime', 'best-effort', 'idle') and level (0-7), CPU list (e.g. '0-3,6');
+        # 'background' means lowest CPU priority and idle IO class
+        for section in ('DOWNLOAD', 'EXTRACT'):
+            self.cfg[section] = {'nice': '0',
+                                 'ionice_class': '',
+                                 'ionice_level': '',
+                                 'cpu_affinity': '',
+                                 'background': 'no',
+                                 'backend': '',
+                                 'concurrency': '',
+                                 'stall_timeout': '0',
+                                 'timeout': '0',
+                                 'min_rate': '0',
+                                 'retries': '2'}
+        # processes with no progress for 'stall_timeout' seconds or running
+        # longer than 'timeout' plus expected size / 'min_rate' seconds are
+        # killed and retried up to 'retries' times
+        self.cfg['DOWNLOAD']['stall_timeout'] = '300'
+        # recordings listed in both replays are downloaded from the other
+        # replay too when download fails or its rate is below 'hedge_min_rate'
+        # after 'hedge_delay' seconds; the first finished download wins
+        self.cfg['DOWNLOAD']['hedge'] = 'no'
+        self.cfg['DOWNLOAD']['hedge_min_rate'] = '0'
+        self.cfg['DOWNLOAD']['hedge_delay'] = '60'
+        # extract MP3 from FLV and AAC from MP4 in-process, ffmpeg is used
+        # for other formats and when the native extracting fails
+        self.cfg['EXTRACT']['native'] = 'yes'
+        # number of files extracted by one ffmpeg command (saves ffmpeg
+        # start-up time when there are many short files)
+        self.cfg['EXTRACT']['batch_size'] = '1'
+        # stages of the pipeline in order; every stage can have execution
+        # 'backend' and 'concurrency' options in its config section
+        # (RUN.concurrency is used when empty)
+        self.cfg['PIPELINE'] = {'stages': 'download, extract_audio'}
+        # intermediate files up to 'cache_size' bytes are kept in the work
+        # directory instead of being deleted (0 = delete all), unfinished
+        # downloads older than 'part_max_age' seconds are deleted at start
+        # (0 = never)
+        self.cfg['CLEANUP'] = {'backend': '', 'concurrency': '',
+                               'cache_size': '0',
+                               'part_max_age': '0'}
+        # daemon mode: replay listings to poll ('RTMP', 'HTTP'), poll interval
+        # in seconds, control socket and file with already enqueued entries
+        self.cfg['DAEMON'] = {'replay_types': 'RTMP, HTTP',
+                              'poll_interval': '900',
+                              'socket': '~/.cache/replay_downloader/control.sock',
+                              'seen_file': '~/.cache/replay_downloader/seen'}
+        # planning of downloads: history of download times, number of parallel
+        # probes of remote files, probe timeout in seconds and number of entries
+        # ordered at once
+        self.cfg['PLANNER'] = {'history_file': '~/.cache/replay_downloader/history.json',
+                               'workers': '8',
+                               'probe_timeout': '10',
+                               'window': '100'}
+        # simulation of the pipeline: synthetic jobs (number, mean size),
+        # bandwidth, bytes per second processed by audio extracting,
+        # extract concurrency (comma separated list, same as download if empty)
+        self.cfg['SIMULATE'] = {'jobs': '100',
+                                'mean_size': '300M',
+                                'bandwidth': '10M',
+                                'job_bandwidth': '0',
+                                'extract_rate': '50M',
+                                'extract_concurrency': ''}
+        # rotate log file when it reaches 'max_size' (e.g. '10M'), 0 means never
+        self.cfg['LOG'] = {'max_size': '0', 'backup_count': '5'}
+        # bandwidth limits for downloads, e.g. '512K' or '2M' (bytes per second);
+        # full_speed_hours are time windows without limits, e.g. '20:00-07:00'
+        self.cfg['BANDWIDTH'] = {'limit': '0',
+                                 'job_limit': '0',
+                                 'full_speed_hours': ''}
+        # mirrors are probed every 'probe_interval' seconds (latency, download
+        # of 'probe_bytes'); at most 'max_jobs' downloads run from one mirror
+        # (0 = no limit); mirror is not used for 'demote_time' seconds after
+        # 'max_failures' failed downloads in a row
+        self.cfg['MIRRORS'] = {'max_jobs': '0',
+                               'probe_interval': '600',
+                               'probe_timeout': '5',
+                               'probe_bytes': '65536',
+                               'max_failures': '3',
+                               'demote_time': '600'}
         self.cfg['RTMP'] = {'replay_url': 'http://webcast.dzogchen.net/index.php?id=replay',
                             'login_url': 'http://webcast.dzogchen.net/login-exec.php',
                             'list_regex': r'so.addVariable\(\'file\',\'/([^\']*.mp3)\'\);',
                             'replay_rtmp': 'rtmp://78.129.190.44/replay',
                             'player_url': 'http://webcast.dzogchen.net/player.swf',
-                            'referer': 'http://webcast.dzogchen.net/index.php?id=replay'}
+                            'referer': 'http://webcast.dzogchen.net/index.php?id=replay',
+                            # comma separated base URLs of mirrors, 'replay_rtmp' if empty
+                            'mirrors': '',
+                            # 'native' extracts MP3 while downloading instead
+                            # of saving FLV file first, 'ffmpeg' pipes the
+                            # stream to ffmpeg that extracts it (the FLV is
+                            # downloaded when ffmpeg fails, e.g. on AAC audio)
+                            'stream': 'no'}
         self.cfg['HTTP'] = {'replay_url': 'http://webcast.dzogchen.net/index.php?id=mobilereplay',
                             'login_url': 'http://webcast.dzogchen.net/login-exec.php',
-                            'list_regex': r'<a href=\"(http:[^\"]*playlist.m3u8)\"'}
+                            'list_regex': r'<a href=\"(http:[^\"]*playlist.m3u8)\"',
+                            # comma separated base URLs (e.g. 'http://host:port') of
+                            # mirrors, the host from the replay listing if empty
+                            'mirrors': '',
+                            # number of pooled connections per host
+                            'pool_size': '10',
+                            # direct links to media files are downloaded in ranges
+                            # of 'range_size' bytes over 'connections' connections
+                            'connections': '4',
+                            'range_size': '4M',
+                            # stream of HLS master playlist to download: 'audio',
+                            # 'lowest' or 'highest' bandwidth, 'master' lets ffmpeg
+                            # choose; 'max_bandwidth' in bits per second (0 = no limit)
+                            'rendition': 'master',
+                            'max_bandwidth': '0'}
 
         # read config file and override default values
+        self.update(cfg_path)
+
+    def update(self, cfg_path: str):
+        """Reads config file and overrides current values, missing file is ignored."""
         if os.path.isfile(cfg_path):
             self.cfg.read(cfg_path)
 
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Changing the running pipeline without restart.
+
+SIGHUP, or change of the control file ('control_file' in the RUN config
+section), reloads the config file and applies concurrency and watchdog
+options of the stages and bandwidth limits to the running pipeline. The
+control file has the same format as the config file and overrides its values.
+
+Concurrency set at runtime (by 'concurrency' command of the daemon) is kept
+across reloads.
+
+SIGUSR1, or 'drain = yes', starts graceful drain: no new downloads are
+started, running downloads finish and go through the rest of the pipeline.
+Entries that were not started are put back to the spool file, or saved to
+'resume_file' as list of files to download, so the work can be resumed.
+Earlier resume file is kept with numeric suffix.
+"""
+
+import configparser
+import os
+import signal
+import threading
+
+from replay_downloader import config, download, log, perform
+
+
+class Controller:
+    """Applies reloaded configuration to running pipeline and drains it.
+
+    Signal handlers only record the request, the changes are made by 'check'
+    called from the main loop.
+    """
+
+    def __init__(self, conf: config.Config, work: perform.Work, to_do, concurrency: int = 0):
+        """
+        Args:
+            conf (Config): Configuration the pipeline was created with.
+            work (Work): The work pipeline.
+            to_do: The 'to_do' stack of the first stage.
+            concurrency (int): Default number of parallel jobs overriding the config
+                file (e.g. set on command line), 0 = use the config file.
+        """
+        self.config_file = conf.path
+        self.control_file = os.path.expanduser(conf.RUN.control_file)
+        self.resume_file = os.path.expanduser(conf.RUN.resume_file)
+        self.work = work
+        self.to_do = to_do
+        self.concurrency = concurrency
+        self.draining = False
+        # number of entries saved by drain and where
+        self.saved = 0
+        self.saved_to = ''
+        self._reload_requested = False
+        self._drain_requested = False
+        self._control_mtime = self._mtime()
+        self._old_handlers = {}
+        # concurrency set at runtime, by task
+        self._slots_overrides = {}
+
+    def __enter__(self):
+        # signal handlers can be set only in the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signum, handler in ((signal.SIGHUP, self.request_reload),
+                                    (signal.SIGUSR1, self.request_drain)):
+                self._old_handlers[signum] = signal.signal(signum, handler)
+        return self
+
+    def __exit__(self, *exc):
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+        self._old_handlers.clear()
+
+    # pylint: disable=unused-argument
+    def request_reload(self, *args):
+        """Asks for reload of the configuration (safe to call from signal handler)."""
+        self._reload_requested = True
+
+    # pylint: disable=unused-argument
+    def request_drain(self, *args):
+        """Asks for graceful drain (safe to call from signal handler)."""
+        self._drain_requested = True
+
+    def _mtime(self) -> float:
+        if not self.control_file:
+            return None
+        try:
+            return os.stat(self.control_file).st_mtime
+        except OSError:
+            return None
+
+    def check(self):
+        """Performs requested actions, called in every iteration of the main loop."""
+        mtime = self._mtime()
+        if mtime != self._control_mtime:
+            self._control_mtime = mtime
+            self._reload_requested = True
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload()
+        if self._drain_requested:
+            self._drain_requested = False
+            self.drain()
+
+    def set_concurrency(self, task: perform.ProcScheduler, slots: int):
+        """Sets concurrency of the task, it's kept when the configuration is reloaded."""
+        task.set_slots(slots)
+        self._slots_overrides[task] = slots
+
+    def load_config(self) -> config.Config:
+        """Reads the config file and the control file."""
+        conf = config.Config(self.config_file)
+        if self.control_file:
+            conf.update(self.control_file)
+        return conf
+
+    @staticmethod
+    def _set_watchdog(task: perform.ProcScheduler, watchdog: perform.Watchdog):
+        if watchdog is None or task.watchdog is None:
+            task.watchdog = watchdog
+        else:
+            # keep the history of running processes
+            task.watchdog.stall_timeout = watchdog.stall_timeout
+            task.watchdog.timeout = watchdog.timeout
+            task.watchdog.min_rate = watchdog.min_rate
+
+    def reload(self) -> bool:
+        """Applies the configuration to all stages, returns False if it can't be read."""
+        try:
+            conf = self.load_config()
+            drain = conf.cfg.getboolean('RUN', 'drain')
+            slots = {}
+            for task in self.work:
+                section = getattr(conf, getattr(getattr(task, 'obj', None), 'config_section', ''),
+                                  None)
+                slots[task] = self._slots_overrides.get(task) or self.concurrency or \
+                    int(getattr(section, 'concurrency', '') or conf.RUN.concurrency)
+        except (configparser.Error, ValueError) as emsg:
+            log.logit('[control] cannot reload configuration: {}'.format(emsg), 'error')
+            return False
+
+        for task in self.work:
+            if not isinstance(task, perform.ProcScheduler):
+                continue
+            if slots[task] != task.max_slots:
+                log.logit('[control] concurrency of {} changed from {} to {}'.format(
+                    task.name, task.max_slots, slots[task]), stage=task.name)
+                task.set_slots(slots[task])
+            section = getattr(conf, getattr(task.obj, 'config_section', ''), None)
+            if section is not None:
+                self._set_watchdog(task, perform.Watchdog.from_config(section))
+            throttle = getattr(task.obj, 'throttle', None)
+            if throttle is not None:
+                throttle.reconfigure(conf)
+        log.logit('[control] configuration reloaded')
+
+        if drain:
+            self.drain()
+        return True
+
+    def drain(self):
+        """Stops spawning of new jobs in the first stage, running jobs are finished."""
+        if self.draining:
+            return
+        self.draining = True
+        first = next(iter(self.work), None)
+        if hasattr(first, 'paused'):
+            first.paused = True
+        log.logit('[control] draining, {} running job(s) will be finished'.format(
+            len(getattr(first, 'running_procs', ()))))
+
+    def drained(self) -> bool:
+        """Returns True when drain was started and all running jobs are finished."""
+        if not self.draining:
+            return False
+        tasks = list(self.work)
+        if tasks and getattr(tasks[0], 'running_procs', None):
+            return False
+        for task in tasks[1:]:
+            if getattr(task, 'running_procs', None) or len(getattr(task, 'to_do', ())):
+                return False
+        return True
+
+    def _rotate_resume_file(self):
+        """Renames existing resume file to the first free 'resume_file.N'."""
+        if not os.path.exists(self.resume_file):
+            return
+        num = 1
+        while os.path.exists('{}.{}'.format(self.resume_file, num)):
+            num += 1
+        rotated = '{}.{}'.format(self.resume_file, num)
+        os.rename(self.resume_file, rotated)
+        log.logit('[control] earlier resume file kept as {}'.format(rotated), file=rotated)
+
+    def save_state(self) -> int:
+        """Saves entries that were not started, returns their number."""
+        spool = getattr(self.to_do, 'spool', None)
+        if spool is not None:
+            # lines stay in the spool until they are processed
+            self.to_do.flush()
+            self.saved = len(spool)
+            self.saved_to = spool.path
+            log.logit('[control] {} entries left in {}'.format(self.saved, self.saved_to),
+                      file=self.saved_to)
+            return self.saved
+
+        if isinstance(self.to_do, list):
+            # the stack is processed from the end, the saved list keeps its order
+            records = list(self.to_do)
+            del self.to_do[:]
+        else:
+            records = []
+            while len(self.to_do):
+                records.append(self.to_do.pop())
+        lines = [download.Download.format_line(file_record) for file_record in records]
+        if not lines:
+            return 0
+
+        resume_dir = os.path.dirname(self.resume_file)
+        if resume_dir:
+            os.makedirs(resume_dir, exist_ok=True)
+        self._rotate_resume_file()
+        with open(self.resume_file, 'w') as ofl:
+            ofl.writelines(line + '\n' for line in lines)
+        self.saved_to = self.resume_file
+        self.saved = len(lines)
+        log.logit('[control] {} entries that were not started saved to {}'.format(
+            self.saved, self.saved_to), file=self.saved_to)
+        return self.saved
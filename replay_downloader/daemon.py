@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running daemon mode with local control socket.
+
+The control protocol is one JSON object per line, e.g.
+{"cmd": "enqueue", "items": ["foo.mp3"]} -> {"ok": true, "queued": 1}
+"""
+
+import json
+import os
+import queue
+import select
+import socket
+import threading
+import time
+
+from replay_downloader import config, download, log, mappings, msgs, perform
+
+
+class Daemon:
+    """Keeps the work pipeline alive and feeds it with new work.
+
+    New entries are found by polling replay listings or added by clients
+    connected to the control socket.
+    """
+
+    def __init__(self, conf: config.Config, work: perform.Work, stages: dict, to_do,
+                 socket_path: str = '', controller=None):
+        """
+        Args:
+            conf (Config): Configuration.
+            work (Work): The work pipeline.
+            stages (dict): Pipeline tasks (e.g. 'ProcScheduler') by stage name.
+            to_do: The 'to_do' stack of the first stage, new entries are appended there.
+            socket_path (str): Path to the control socket.
+            controller (Controller): Reloads configuration and drains the pipeline.
+        """
+        self.conf = conf
+        self.work = work
+        self.stages = stages
+        self.to_do = to_do
+        self.socket_path = os.path.expanduser(socket_path or conf.DAEMON.socket)
+        self.poll_interval = int(conf.DAEMON.poll_interval)
+        self.replay_types = [mappings.Rtypes[rtype.strip().upper()]
+                             for rtype in conf.DAEMON.replay_types.split(',') if rtype.strip()]
+        self.seen_file = os.path.expanduser(conf.DAEMON.seen_file)
+        self.seen = set()
+        self.controller = controller
+        self.stopping = False
+        self._last_poll = None
+        self._polling = False
+        # entries found by the listing thread
+        self._found = queue.Queue()
+        self._load_seen()
+
+    def _load_seen(self):
+        """Loads entries that were already enqueued (the same format as list of files)."""
+        try:
+            with open(self.seen_file) as ifl:
+                self.seen.update(line.strip() for line in ifl)
+        except FileNotFoundError:
+            pass
+
+    def _save_seen(self, entries: list):
+        seen_dir = os.path.dirname(self.seen_file)
+        if seen_dir:
+            os.makedirs(seen_dir, exist_ok=True)
+        with open(self.seen_file, 'a') as ofl:
+            for entry in entries:
+                print(entry, file=ofl)
+
+    def enqueue(self, entries: list) -> int:
+        """Adds new entries to the pipeline, returns number of added entries."""
+        num = 0
+        for entry in entries:
+            file_record = download.Download.parse_line(entry)
+            if file_record is None:
+                continue
+            self.to_do.append(file_record)
+            num += 1
+        log.logit('[daemon] enqueued {} item(s)'.format(num))
+        return num
+
+    def _fetch_listings(self):
+        """Gets listings of available files, runs in separate thread."""
+        try:
+            for rtype in self.replay_types:
+                for remote_file in download.iter_replay_list(rtype, self.conf):
+                    entry = remote_file.strip()
+                    self._found.put(entry)
+        # pylint: disable=broad-except
+        except Exception as emsg:
+            log.logit('[daemon] failed to get replay list: {}'.format(emsg), 'error')
+        finally:
+            self._polling = False
+
+    def poll_listings(self):
+        """Starts polling of the replay listings if it's time for it."""
+        now = time.time()
+        if self._polling or not self.replay_types or self.poll_interval <= 0:
+            return
+        if self._last_poll is not None and now - self._last_poll < self.poll_interval:
+            return
+        self._last_poll = now
+        self._polling = True
+        threading.Thread(target=self._fetch_listings, daemon=True).start()
+
+    def enqueue_found(self):
+        """Enqueues entries found in the listings that were not seen before."""
+        new = []
+        while True:
+            try:
+                entry = self._found.get_nowait()
+            except queue.Empty:
+                break
+            if entry and entry not in self.seen:
+                self.seen.add(entry)
+                new.append(entry)
+        if new:
+            self._save_seen(new)
+            self.enqueue(new)
+
+    def _get_stage(self, name: str):
+        try:
+            return self.stages[name]
+        except KeyError:
+            raise ValueError("unknown stage '{}'".format(name))
+
+    def status(self) -> dict:
+        """Returns status of all stages."""
+        stages = {}
+        for name, task in self.stages.items():
+            stages[name] = {'queued': len(task.to_do) if hasattr(task, 'to_do') else 0,
+                            'running': len(getattr(task, 'running_procs', ())),
+                            'slots': getattr(task, 'max_slots', None),
+                            'paused': getattr(task, 'paused', False)}
+        totals = {}
+        for key in (mappings.MsgTypes.finished, mappings.MsgTypes.failed,
+                    mappings.MsgTypes.skipped, mappings.MsgTypes.stalled):
+            totals[key.name] = sum(len(msglist) for msglist in
+                                   msgs.Msgs.get_msglists_with_key(key))
+        return {'stages': stages, 'totals': totals}
+
+    def handle(self, request: dict) -> dict:
+        """Executes command received over the control socket."""
+        cmd = request.get('cmd')
+        try:
+            if cmd == 'enqueue':
+                return {'ok': True, 'queued': self.enqueue(request.get('items', []))}
+            elif cmd == 'concurrency':
+                task = self._get_stage(request['stage'])
+                slots = int(request['value'])
+                if slots < 1:
+                    raise ValueError('concurrency must be at least 1, got {}'.format(slots))
+                if self.controller is not None:
+                    # kept when the configuration is reloaded
+                    self.controller.set_concurrency(task, slots)
+                else:
+                    task.set_slots(slots)
+            elif cmd == 'pause':
+                self._get_stage(request['stage']).paused = True
+            elif cmd == 'resume':
+                self._get_stage(request['stage']).paused = False
+            elif cmd == 'poll':
+                self._last_poll = None
+                self.poll_listings()
+            elif cmd == 'status':
+                return dict(ok=True, **self.status())
+            elif cmd == 'stop':
+                self.stopping = True
+            elif cmd in ('reload', 'drain'):
+                if self.controller is None:
+                    raise ValueError("'{}' is not available".format(cmd))
+                if cmd == 'reload':
+                    self.controller.request_reload()
+                else:
+                    self.controller.request_drain()
+            else:
+                return {'ok': False, 'error': "unknown command '{}'".format(cmd)}
+        except (AttributeError, KeyError, TypeError, ValueError) as emsg:
+            return {'ok': False, 'error': str(emsg)}
+        return {'ok': True}
+
+    def _listen(self) -> socket.socket:
+        """Opens the control socket, raises 'FileExistsError' if other daemon listens there."""
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                try:
+                    conn.connect(self.socket_path)
+                except OSError:
+                    # left by daemon that didn't exit cleanly
+                    os.unlink(self.socket_path)
+                else:
+                    raise FileExistsError(
+                        'daemon is already running on {}'.format(self.socket_path))
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir:
+            os.makedirs(socket_dir, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(5)
+        return server
+
+    def serve(self, server: socket.socket, timeout: float):
+        """Handles requests on the control socket, waits up to 'timeout' seconds."""
+        readable = select.select([server], [], [], timeout)[0]
+        if not readable:
+            return
+        conn = server.accept()[0]
+        with conn:
+            conn.settimeout(1)
+            try:
+                request = conn.makefile('r').readline()
+                try:
+                    response = self.handle(json.loads(request))
+                except ValueError as emsg:
+                    response = {'ok': False, 'error': str(emsg)}
+                conn.sendall((json.dumps(response) + '\n').encode('utf-8'))
+            except OSError as emsg:
+                log.logit('[daemon] control connection failed: {}'.format(emsg), 'error')
+
+    def run(self, msg_handler):
+        """The main loop. Runs until 'stop' command is received or the work is drained."""
+        server = self._listen()
+        try:
+            with perform.CleanExit(self.work):
+                while not self.stopping:
+                    if self.controller is not None:
+                        self.controller.check()
+                    draining = self.controller is not None and self.controller.draining
+                    if not draining:
+                        self.poll_listings()
+                        self.enqueue_found()
+                    for task in self.work:
+                        task()
+                    # print messages produced during this iterration
+                    msg_handler()
+                    if draining and self.controller.drained():
+                        self.controller.save_state()
+                        break
+                    self.serve(server, 0.5)
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+
+def send_command(socket_path: str, request: dict) -> dict:
+    """Sends command to running daemon, returns the response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(os.path.expanduser(socket_path))
+        conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        return json.loads(conn.makefile('r').readline())
+
+
+def parse_command(args: list) -> dict:
+    """Converts command line arguments to control request.
+
+    Examples: ['status'], ['pause', 'download'], ['concurrency', 'download', '5'],
+    ['enqueue', 'foo.mp3', 'http://bar/playlist.m3u8']
+    """
+    if not args:
+        raise ValueError('no command specified')
+    cmd, params = args[0], args[1:]
+    if cmd == 'enqueue':
+        return {'cmd': cmd, 'items': params}
+    elif cmd in ('pause', 'resume') and len(params) == 1:
+        return {'cmd': cmd, 'stage': params[0]}
+    elif cmd == 'concurrency' and len(params) == 2:
+        return {'cmd': cmd, 'stage': params[0], 'value': params[1]}
+    elif cmd in ('status', 'poll', 'stop', 'reload', 'drain') and not params:
+        return {'cmd': cmd}
+    raise ValueError("invalid command '{}'".format(' '.join(args)))
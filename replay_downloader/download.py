@@ -3,14 +3,52 @@
 Download from replay.
 """
 
+import functools
 import os
 import re
 import sys
+import time
 
 from subprocess import Popen, PIPE
+from urllib.parse import unquote, urlsplit
 
-from requests import session
-from replay_downloader import config, log, mappings, msgs, record, utils
+from replay_downloader import (
+    cache,
+    config,
+    hedge,
+    hls,
+    log,
+    mappings,
+    mirrors,
+    msgs,
+    perform,
+    priority,
+    ranged,
+    record,
+    session,
+    streaming,
+    throttle,
+    utils
+)
+
+
+# timeout of fetching HLS master playlist, in seconds
+PLAYLIST_TIMEOUT = 10
+
+# file type and audio format of direct links to media files, by extension
+MEDIA_TYPES = {
+    'flv': (mappings.Ftypes.FLV, mappings.Ftypes.MP3),
+    'mp3': (mappings.Ftypes.MP3, mappings.Ftypes.MP3),
+    'mp4': (mappings.Ftypes.MP4, mappings.Ftypes.AAC),
+    'm4a': (mappings.Ftypes.MP4, mappings.Ftypes.AAC),
+    'aac': (mappings.Ftypes.AAC, mappings.Ftypes.AAC),
+}
+
+
+def _media_ext(url: str) -> str:
+    """Returns extension of the file name in URL."""
+    path = urlsplit(url).path
+    return path.rsplit('.', 1)[-1].lower() if '.' in os.path.basename(path) else ''
 
 
 class Download:
@@ -19,40 +57,137 @@ class Download:
     Schedulable object for 'ProcScheduler'.
     """
 
-    def __init__(self, conf: config.Config, to_do: list, destination: str = ''):
+    config_section = 'DOWNLOAD'
+    backends = ('subprocess', )
+
+    def __init__(self, conf: config.Config, to_do: list, destination: str = '',
+                 audio_destination: str = ''):
         # necassary tools
         self.required_tools = [conf.COMMANDS.rtmpdump, conf.COMMANDS.ffmpeg]
 
         self.conf = conf
+        self.priority = priority.Priority.from_config(conf, 'DOWNLOAD')
         self.out = {mappings.MsgTypes.active: msgs.MsgList('Downloading'),
                     mappings.MsgTypes.finished: msgs.MsgList('Downloaded'),
                     mappings.MsgTypes.skipped: msgs.MsgList('Skipped download of'),
                     mappings.MsgTypes.failed: msgs.MsgList('Failed to download'),
+                    mappings.MsgTypes.stalled: msgs.MsgList('Killed stalled download of'),
                     mappings.MsgTypes.errors: msgs.MsgList()}
         msgs.out_add(self.out)
         self._destination = ''
         self.destination = destination
+        # where MP3 extracted while downloading RTMP stream is saved
+        self.audio_destination = os.path.expanduser(audio_destination)
+        self.stream = conf.RTMP.stream
         self.finished_ready = []
         self.to_do = to_do
+        self.throttle = throttle.Throttle.from_config(conf)
+        # files that are being downloaded
+        self._active = set()
+        # bytes downloaded by already finished downloads
+        self._done_bytes = 0
+        # size of .part files of running downloads when they were started, resumed
+        # downloads don't download these bytes again
+        self._start_bytes = {}
+        # called with file record, return code and duration of every finished download
+        self.on_finished = None
+        # mirrors by download type, the URL from the record is used for types without mirrors
+        self.mirrors = {}
+        rtmp_mirrors = [url.strip() for url in conf.RTMP.mirrors.split(',') if url.strip()]
+        self.mirrors[mappings.Rtypes.RTMP] = mirrors.MirrorPool.from_config(
+            conf, rtmp_mirrors or [conf.RTMP.replay_rtmp])
+        http_mirrors = [url.strip() for url in conf.HTTP.mirrors.split(',') if url.strip()]
+        if http_mirrors:
+            self.mirrors[mappings.Rtypes.HTTP] = mirrors.MirrorPool.from_config(
+                conf, http_mirrors)
+        # pool and mirror of running downloads, by downloaded file
+        self._mirror_of = {}
+        # in-process downloads by downloaded file
+        self._ranged = {}
+        # pool of workers for in-process downloads
+        self.executor = None
+        # how many times can be download killed by watchdog and tried again
+        self.retries = int(conf.DOWNLOAD.retries or 0)
+        # number of retries by record id
+        self._retried = {}
+        # RTMP streams whose audio failed to extract while downloading, saved as FLV
+        self._no_stream = set()
+        # which stream of HLS master playlist is downloaded
+        self.rendition = conf.HTTP.rendition or 'master'
+        if self.rendition not in hls.POLICIES:
+            raise ValueError("unknown rendition policy '{}'".format(self.rendition))
+        self.max_bandwidth = utils.parse_size(conf.HTTP.max_bandwidth)
+        # recordings listed in both replays are downloaded from the other one
+        # when download is slow or fails
+        self.hedge = conf.DOWNLOAD.hedge.lower() in ('yes', 'true', 'on', '1')
+        self.hedge_min_rate = utils.parse_size(conf.DOWNLOAD.hedge_min_rate)
+        self.hedge_delay = float(conf.DOWNLOAD.hedge_delay)
+        # the other source of recordings, set by 'create' when hedging is on
+        self.sources = None
+        # backup download (file, mirror pool, mirror) by file of hedged download
+        self._backup_of = {}
+        # downloaded files kept by the cleanup stage
+        self.cache = cache.get_cache(conf, self.destination)
+
+    @staticmethod
+    def parse_line(line: str) -> record.FileRecord:
+        """Parses one line of the list of files to download.
+
+        Returns None for empty lines and comments.
+        """
+        line = line.strip()
+        if not line:
+            return None
+        elif line.startswith('#'):
+            return None
+        elif line.startswith(('http://', 'https://')):
+            if _media_ext(line) in MEDIA_TYPES:
+                return record.FileRecord(mappings.Fileinfo(line, mappings.Rtypes.HTTPFILE))
+            return record.FileRecord(mappings.Fileinfo(line, mappings.Rtypes.HTTP))
+        return record.FileRecord(mappings.Fileinfo('rtmp://' + line, mappings.Rtypes.RTMP))
+
+    @staticmethod
+    def format_line(file_record: record.FileRecord) -> str:
+        """Returns line of the list of files to download for the record (see 'parse_line')."""
+        remote = file_record[0]
+        if remote.type is mappings.Rtypes.RTMP:
+            # strip 'rtmp://'
+            return remote.path[7:]
+        return remote.path
 
     @staticmethod
     def parse_todownload_list(downloads_list: list) -> list:
         """Parses the list of files to download and store useful metadata."""
         retlist = []
         for i in downloads_list:
-            line = i.strip()
-            if not line:
-                continue
-            elif line.startswith('#'):
-                continue
-            elif line.startswith('http://'):
-                retlist.append(record.FileRecord(mappings.Fileinfo(line, mappings.Rtypes.HTTP)))
-            else:
-                retlist.append(
-                    record.FileRecord(mappings.Fileinfo('rtmp://' + line, mappings.Rtypes.RTMP)))
+            file_record = Download.parse_line(i)
+            if file_record is not None:
+                retlist.append(file_record)
 
         return retlist
 
+    @classmethod
+    def create(cls, conf: config.Config, to_do: list, context: dict):
+        """Creates the stage for pipeline."""
+        stage = cls(conf, to_do, destination=context.get('work_dir', ''),
+                    audio_destination=context.get('destination', ''))
+        for pool in stage.mirrors.values():
+            if len(pool) > 1:
+                pool.probe_all()
+        if stage.hedge:
+            stage.sources = hedge.SourceMap()
+            for replay_type in (mappings.Rtypes.RTMP, mappings.Rtypes.HTTP):
+                try:
+                    for entry in iter_replay_list(replay_type, conf):
+                        stage.sources.add(cls.parse_line(entry)[0])
+                # pylint: disable=broad-except
+                except Exception as emsg:
+                    log.logit('[hedge] failed to get replay list: {}'.format(emsg), 'error')
+                    stage.out[mappings.MsgTypes.errors].add(
+                        'Error: failed to get {} replay list for hedged downloads: {}'.format(
+                            replay_type.name, emsg))
+        return stage
+
     @property
     def destination(self):
         return self._destination
@@ -66,18 +201,111 @@ class Download:
         destdir = os.path.expanduser(destdir)
         try:
             os.makedirs(destdir)
-            self._destination = destdir
         except OSError:
             if not os.path.isdir(destdir):
                 raise
+        self._destination = destdir
 
-    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
-        """Runs command for downloading the file in the background.
+    def _transferred(self) -> int:
+        """Returns number of bytes downloaded so far."""
+        total = self._done_bytes
+        for filepath in self._active:
+            if filepath in self._ranged:
+                # the file is preallocated, its size says nothing
+                total += self._ranged[filepath].transferred
+                continue
+            total += self._new_bytes(filepath)
+        return total
 
-        Records corresponding metadata.
+    def _new_bytes(self, filepath: str) -> int:
+        """Returns number of bytes the running download of 'filepath' added to its .part file."""
+        try:
+            size = os.path.getsize(filepath + mappings.PART_EXT)
+        except OSError:
+            return 0
+        return max(size - self._start_bytes.get(filepath, 0), 0)
+
+    def _mark_start(self, filepath: str):
+        """Records size of .part file the download of 'filepath' starts with."""
+        try:
+            self._start_bytes[filepath] = os.path.getsize(filepath + mappings.PART_EXT)
+        except OSError:
+            self._start_bytes.pop(filepath, None)
+
+    def can_spawn(self) -> bool:
+        """Checks if the mirrors and bandwidth limits allow to start new download."""
+        if len(self.to_do) > 0:
+            pool = self.mirrors.get(self.to_do[-1][-1].type)
+            if pool is not None:
+                pool.maybe_probe()
+                if not pool.available():
+                    return False
+        if not self.throttle.limited():
+            return True
+        return self.throttle.can_spawn(len(self._active), self._transferred())
+
+    def progress(self, procinfo: mappings.Procinfo) -> int:
+        """Returns number of bytes downloaded by running download."""
+        filepath = procinfo.file_record[-1].path
+        if filepath in self._ranged:
+            return self._ranged[filepath].transferred
+        if isinstance(procinfo.proc, hedge.HedgedProc):
+            return procinfo.proc.progress()
+        # the stream can be saved to fallback file
+        fileinfo = getattr(procinfo.proc, 'fileinfo', None) or procinfo.file_record[-1]
+        try:
+            return os.path.getsize(fileinfo.path + mappings.PART_EXT)
+        except OSError:
+            return 0
+
+    def expected_size(self, procinfo: mappings.Procinfo) -> int:
+        """Returns size of the downloaded file if it's known."""
+        job = self._ranged.get(procinfo.file_record[-1].path)
+        return job.size if job is not None else None
+
+    def _mirror_url(self, download_type: int, url: str, mirror: mirrors.Mirror) -> str:
+        """Returns 'url' of the remote file on the mirror."""
+        if download_type is mappings.Rtypes.RTMP:
+            return mirror.url + url[len(self.conf.RTMP.replay_rtmp):]
+        return mirror.rebase(url)
+
+    def _submit(self, func, *args):
+        """Runs the function in the pool of workers, returns the future."""
+        if self.executor is None:
+            # needed only by in-process downloads, not worth importing at startup
+            # pylint: disable=import-outside-toplevel
+            import concurrent.futures
+
+            self.executor = concurrent.futures.ThreadPoolExecutor()
+        return self.executor.submit(func, *args)
+
+    def _select_rendition(self, url: str) -> str:
+        """Returns URL of the stream of HLS master playlist chosen by the policy."""
+        if self.rendition == 'master':
+            return url
+        try:
+            ses = session.get_session(self.conf)
+            playlist = hls.Playlist(ses.get(url, timeout=PLAYLIST_TIMEOUT).text, url)
+            selected, description = hls.select_rendition(playlist, self.rendition,
+                                                         self.max_bandwidth)
+        # pylint: disable=broad-except
+        except Exception as emsg:
+            log.logit('[download] can\'t read playlist {}: {}'.format(url, emsg), 'error')
+            return url
+        if selected is None:
+            return url
+        log.logit('[download] {} selected for {}'.format(description, url),
+                  policy=self.rendition, rendition=selected)
+        return selected
+
+    def _prepare(self, remote: mappings.Fileinfo) -> tuple:
+        """Returns download command, the URL in it, downloaded file and fallback file.
+
+        Returns None when the download type is not supported.
         """
-        remote_file_name = file_record[-1].path
-        download_type = file_record[-1].type
+        remote_file_name = remote.path
+        download_type = remote.type
+        fallback = None
 
         if download_type is mappings.Rtypes.RTMP:
             # strip 'rtmp://'
@@ -87,29 +315,146 @@ class Download:
                                     utils.remove_ext(remote_file_name) + '.flv')
             res_type = mappings.Ftypes.FLV
             audio_format = mappings.Ftypes.MP3
+            source = self.conf.RTMP.replay_rtmp + '/' + remote_file_name
             command = [self.conf.COMMANDS.rtmpdump, '--hashes', '--live',
-                       '--rtmp', self.conf.RTMP.replay_rtmp + '/' +
-                       remote_file_name, '--pageUrl',
+                       '--rtmp', source, '--pageUrl',
                        self.conf.RTMP.referer, '--swfUrl',
                        self.conf.RTMP.replay_url, '--swfVfy',
                        self.conf.RTMP.player_url, '--flv', res_file + mappings.PART_EXT]
+            if self.stream in ('native', 'ffmpeg') and remote.path not in self._no_stream:
+                # extract MP3 from the stream; native extracting keeps FLV
+                # when the audio is not MP3, ffmpeg gets the stream from pipe
+                if self.stream == 'native':
+                    fallback = mappings.Fileinfo(
+                        res_file, res_type, clname=type(self).__name__, audio_f=audio_format)
+                res_file = os.path.join(self.audio_destination,
+                                        utils.remove_ext(remote_file_name) + '.mp3')
+                res_type = mappings.Ftypes.MP3
+                command[-1] = '-'
+            elif os.path.isfile(res_file + mappings.PART_EXT):
+                # continue interrupted download
+                command.insert(-2, '--resume')
         elif download_type is mappings.Rtypes.HTTP:
             # extract file name from URI
             fname = re.search(r'mp4:([^\/]*)\/', remote_file_name)
             res_file = os.path.join(self.destination, fname.group(1))
             res_type = mappings.Ftypes.MP4
             audio_format = mappings.Ftypes.AAC
+            source = remote_file_name
             command = [self.conf.COMMANDS.ffmpeg, '-i',
-                       remote_file_name, '-c', 'copy', res_file + mappings.PART_EXT]
+                       source, '-c', 'copy', res_file + mappings.PART_EXT]
+            if os.path.isfile(res_file + mappings.PART_EXT):
+                # left by interrupted download, ffmpeg would ask before overwriting it
+                command.insert(1, '-y')
+        elif download_type is mappings.Rtypes.HTTPFILE:
+            fname = unquote(os.path.basename(urlsplit(remote_file_name).path))
+            res_file = os.path.join(self.destination, fname)
+            res_type, audio_format = MEDIA_TYPES[_media_ext(remote_file_name)]
+            source = remote_file_name
+            # downloaded in-process, there's no command, just the URL
+            command = [source]
         else:
+            return None
+        cur_fileinfo = mappings.Fileinfo(
+            res_file, res_type, clname=type(self).__name__, audio_f=audio_format)
+        return command, source, cur_fileinfo, fallback
+
+    def _run(self, download_type: int, command: list, res_file: str, fallback,
+             source_index: int = None):
+        """Starts the download, returns the process.
+
+        The HLS stream is selected in the pool of workers first, 'source_index'
+        is index of the playlist URL in the command.
+        """
+        if download_type is mappings.Rtypes.HTTP and self.rendition != 'master' and \
+                source_index is not None:
+            def start(url):
+                command[source_index] = url
+                return self._run(download_type, command, res_file, fallback)
+            return perform.ChainedProc(
+                self._submit(self._select_rendition, command[source_index]), start)
+        if download_type is mappings.Rtypes.HTTPFILE:
+            job = ranged.RangedDownload(
+                session.get_session(self.conf), command[0], res_file + mappings.PART_EXT,
+                connections=int(self.conf.HTTP.connections),
+                range_size=utils.parse_size(self.conf.HTTP.range_size),
+                bucket=self.throttle.job_bucket())
+            self._ranged[res_file] = job
+            return perform.FutureProc(self._submit(job.run), stop=job.stop)
+        elif fallback is not None:
+            return streaming.DemuxProc(command, res_file + mappings.PART_EXT, fallback,
+                                       self.priority.popen_kwargs())
+        elif download_type is mappings.Rtypes.RTMP and command[-1] == '-':
+            # the stream is written to stdout, ffmpeg extracts the audio from it
+            extract_command = [self.conf.COMMANDS.ffmpeg, '-y', '-i', '-', '-vn',
+                               '-acodec', 'copy', '-f', 'mp3', res_file + mappings.PART_EXT]
+            return streaming.PipeProc(command, extract_command, self.priority.popen_kwargs())
+        return Popen(command, stdout=PIPE, stderr=PIPE, **self.priority.popen_kwargs())
+
+    def _start_backup(self, remote: mappings.Fileinfo, res_file: str) -> hedge.Candidate:
+        """Starts download from the other source, returns None when it can't be started.
+
+        The backup of download of 'res_file' is one more running download for
+        bandwidth limits and mirrors, it's not started when they don't allow it.
+        """
+        prepared = self._prepare(remote)
+        if prepared is None:
+            return None
+        command, source, cur_fileinfo, fallback = prepared
+        if os.path.isfile(cur_fileinfo.path):
+            return None
+        if self.throttle.limited() and \
+                not self.throttle.can_spawn(len(self._active), self._transferred()):
+            log.logit('[hedge] bandwidth limit reached, not starting {}'.format(remote.path),
+                      file=cur_fileinfo.path)
+            return None
+        source_index = command.index(source)
+        pool = self.mirrors.get(remote.type)
+        mirror = None
+        if pool is not None:
+            mirror = pool.acquire()
+            if mirror is None:
+                log.logit('[hedge] all mirrors are busy, not starting {}'.format(remote.path),
+                          file=cur_fileinfo.path)
+                return None
+            command[source_index] = self._mirror_url(remote.type, source, mirror)
+        log.logit('[hedge] starting {}'.format(remote.path), file=cur_fileinfo.path)
+        self._mark_start(cur_fileinfo.path)
+        try:
+            proc = self._run(remote.type, command, cur_fileinfo.path, fallback, source_index)
+        except Exception:
+            self._start_bytes.pop(cur_fileinfo.path, None)
+            if mirror is not None:
+                pool.release(mirror, False)
+            raise
+        self._active.add(cur_fileinfo.path)
+        self._backup_of[res_file] = (cur_fileinfo.path, pool, mirror)
+        return hedge.Candidate(proc, remote, cur_fileinfo)
+
+    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
+        """Runs command for downloading the file in the background.
+
+        Records corresponding metadata.
+        """
+        download_type = file_record[-1].type
+        prepared = self._prepare(file_record[-1])
+        if prepared is None:
             self.out[mappings.MsgTypes.errors].add(
                 'Error: download failed, unsupported download type for {}'
-                .format(remote_file_name))
-            self.out[mappings.MsgTypes.failed].add(remote_file_name)
+                .format(file_record[-1].path))
+            self.out[mappings.MsgTypes.failed].add(file_record[-1].path)
             return
-        cur_fileinfo = mappings.Fileinfo(
-            res_file, res_type, clname=type(self).__name__, audio_f=audio_format)
+        command, source, cur_fileinfo, fallback = prepared
+        res_file = cur_fileinfo.path
 
+        if self.cache is not None and res_file in self.cache:
+            self.cache.use(res_file)
+            log.logit('[cache] using cached {}'.format(res_file),
+                      job=file_record.id, stage='download', file=res_file)
+            self.out[mappings.MsgTypes.finished].add(res_file)
+            file_record.add(cur_fileinfo)
+            self.finished_ready.append(file_record)
+            return
         if os.path.isfile(res_file):
             self.out[mappings.MsgTypes.errors].add(
                 'WARNING: skipping download, file exists: {}'.format(res_file))
@@ -118,34 +463,85 @@ class Download:
             self.finished_ready.append(file_record)
             return
 
+        # download from the best mirror
+        source_index = command.index(source)
+        pool = self.mirrors.get(download_type)
+        mirror = pool.acquire() if pool is not None else None
+        if mirror is not None:
+            command[source_index] = self._mirror_url(download_type, source, mirror)
+            self._mirror_of[res_file] = (pool, mirror)
+
         # run the command
-        proc = Popen(command, stdout=PIPE, stderr=PIPE)
+        self._mark_start(res_file)
+        try:
+            proc = self._run(download_type, command, res_file, fallback, source_index)
+        except Exception:
+            self._start_bytes.pop(res_file, None)
+            if mirror is not None:
+                self._mirror_of.pop(res_file, None)
+                pool.release(mirror, False)
+            raise
+        backup = self.sources.alternative(file_record[-1]) if self.sources else None
+        if backup is not None:
+            # the other source is started when this one is slow or fails
+            proc = hedge.HedgedProc(hedge.Candidate(proc, file_record[-1], cur_fileinfo),
+                                    functools.partial(self._start_backup, backup, res_file),
+                                    self.hedge_min_rate, self.hedge_delay)
         # add the file name to 'active' message queue
         self.out[mappings.MsgTypes.active].add(res_file)
+        self._active.add(res_file)
         # update file history
         file_record.add(cur_fileinfo)
         return mappings.Procinfo(proc, file_record)
 
+    @staticmethod
+    def _outcome(proc, candidate: hedge.Candidate, retcode: int) -> bool:
+        """Returns result of the download of the candidate of hedged download.
+
+        None means the download was killed because the other one won.
+        """
+        if not isinstance(proc, hedge.HedgedProc) or candidate is proc.winner:
+            return retcode == 0
+        return proc.outcome(candidate)
+
     def finished_handler(self, procinfo: mappings.Procinfo) -> int:
         """Actions performed when download is finished."""
         proc = procinfo.proc
-        filepath = procinfo.file_record[-1].path
-        filetype = procinfo.file_record[-1].type
         retcode = proc.poll()
 
+        res_file = procinfo.file_record[-1].path
+        self._active.discard(res_file)
+        pool, mirror = self._mirror_of.pop(res_file, (None, None))
+        job = self._ranged.pop(res_file, None)
+        backup = self._backup_of.pop(res_file, None)
+        if getattr(proc, 'fileinfo', None) is not None:
+            # the download produced different file than expected
+            procinfo.file_record.replace(proc.fileinfo)
+        if getattr(proc, 'source', None) is not None:
+            # hedged download, the file was downloaded from this source
+            procinfo.file_record.replace(proc.source, -2)
+        filepath = procinfo.file_record[-1].path
+        self._done_bytes += job.transferred if job is not None else self._new_bytes(filepath)
+        self._start_bytes.pop(filepath, None)
+        self._start_bytes.pop(res_file, None)
+
+        # structured fields of log records
+        fields = {'job': procinfo.file_record.id, 'stage': 'download', 'file': filepath,
+                  'duration': round(time.time() - procinfo.file_record.tstamp, 3)}
+
         # get stdout and stderr of the command
         out, err = proc.communicate()
         if out:
-            log.logit('[download] stdout for {}:'.format(filepath))
-            log.logit(out.decode('utf-8'))
+            log.logit('[download] stdout for {}:\n{}'.format(filepath, out.decode('utf-8')),
+                      stream='stdout', **fields)
         if err:
-            log.logit('[download] stderr for {}:'.format(filepath), 'error')
-            log.logit(err.decode('utf-8'), 'error')
+            log.logit('[download] stderr for {}:\n{}'.format(filepath, err.decode('utf-8')),
+                      'error', stream='stderr', **fields)
 
         # If rtmpdump finishes with following message:
         # "Download may be incomplete (downloaded about 99.50%), try resuming"
         # it means that download was ok even though the return value was non-zero
-        if (retcode == 2) and (filetype == mappings.Ftypes.FLV):
+        if (retcode == 2) and (procinfo.file_record[0].type is mappings.Rtypes.RTMP):
             for each_line in err.decode('utf-8').splitlines():
                 match = re.search(r'\(downloaded about 99\.[0-9]+%\),', each_line)
                 if match:
@@ -157,50 +553,90 @@ class Download:
             try:
                 # file.part should exist, rename it to strip the '.part'
                 os.rename(filepath + mappings.PART_EXT, filepath)
-                log.logit('[rename] {0}{1} to {0}'.format(filepath, mappings.PART_EXT))
+                log.logit('[rename] {0}{1} to {0}'.format(filepath, mappings.PART_EXT), **fields)
                 self.out[mappings.MsgTypes.finished].add(filepath)
                 # file is ready for further processing by next action in 'pipeline'
                 self.finished_ready.append(procinfo.file_record)
             except FileNotFoundError as emsg:
-                log.logit('[rename] failed: {}'.format(emsg), 'error')
+                log.logit('[rename] failed: {}'.format(emsg), 'error', **fields)
                 retcode = 1
-        if retcode != 0:
+        stalled = getattr(proc, 'watchdog', '')
+        if stalled:
+            self.out[mappings.MsgTypes.stalled].add(filepath)
+        if retcode != 0 and stalled and \
+                self._retried.get(procinfo.file_record.id, 0) < self.retries:
+            self._retried[procinfo.file_record.id] = \
+                self._retried.get(procinfo.file_record.id, 0) + 1
+            log.logit('[watchdog] killed {} download of {}, trying again'.format(
+                stalled, filepath), 'error', watchdog=stalled, **fields)
+            # the .part file is kept so the download can be resumed
+            procinfo.file_record.delete()
+            self.to_do.append(procinfo.file_record)
+        elif retcode != 0 and getattr(proc, 'extract_failed', False) and \
+                procinfo.file_record[-2].path not in self._no_stream:
+            # e.g. AAC audio can't be copied to MP3, FLV is saved and extracted later
+            log.logit('[download] extracting audio of {} failed, downloading FLV'.format(
+                procinfo.file_record[-2].path), 'error', **fields)
+            self._no_stream.add(procinfo.file_record[-2].path)
+            try:
+                os.remove(filepath + mappings.PART_EXT)
+            except OSError:
+                pass
+            procinfo.file_record.delete()
+            self.to_do.append(procinfo.file_record)
+        elif retcode != 0:
+            if stalled:
+                log.logit('[watchdog] killed {} download of {}'.format(stalled, filepath),
+                          'error', watchdog=stalled, **fields)
             self.out[mappings.MsgTypes.failed].add(filepath)
             self.out[mappings.MsgTypes.errors].add(
                 'Error downloading {}: {}'.format(filepath, err.decode('utf-8')))
             # remove last entry from file_record
             procinfo.file_record.delete()
 
+        if mirror is not None:
+            pool.release(mirror, self._outcome(proc, getattr(proc, 'primary', None), retcode))
+            fields['mirror'] = mirror.url
+        if backup is not None:
+            backup_path, backup_pool, backup_mirror = backup
+            self._active.discard(backup_path)
+            self._start_bytes.pop(backup_path, None)
+            if backup_mirror is not None:
+                backup_pool.release(backup_mirror, self._outcome(proc, proc.backup, retcode))
+        if retcode == 0:
+            try:
+                fields['size'] = os.path.getsize(filepath)
+            except OSError:
+                pass
+        log.logit('[download] finished {}'.format(filepath), retcode=retcode, **fields)
+        if self.on_finished is not None:
+            self.on_finished(procinfo.file_record, retcode, fields['duration'])
         return retcode
 
 
+def iter_replay_list(replay_type: int, conf: config.Config):
+    """Generator of remote files (streams) available for download."""
+    # get available files (streams) from classic replay...
+    if replay_type == mappings.Rtypes.RTMP:
+        conf_section = conf.RTMP
+    # ...or from mobile replay
+    elif replay_type == mappings.Rtypes.HTTP:
+        conf_section = conf.HTTP
+    else:
+        raise ValueError('Unrecognized replay type')
+
+    response = session.get_page(conf, conf_section.replay_url, conf_section.login_url)
+    for each_line in response.text.splitlines():
+        match = re.search(conf_section.list_regex, each_line)
+        if match:
+            yield match.group(1)
+
+
 def get_replay_list(replay_type: int, conf: config.Config, outfile: str, append=False):
     """Gets list of remote files (streams) available for download."""
     def _get_session(desc):
-        if not (conf.AUTH.login and conf.AUTH.password):
-            raise ValueError('Login or password are not configured')
-
-        payload = {
-            'login': conf.AUTH.login,
-            'password': conf.AUTH.password
-        }
-
-        # get available files (streams) from classic replay...
-        if replay_type == mappings.Rtypes.RTMP:
-            conf_section = conf.RTMP
-        # ...or from mobile replay
-        elif replay_type == mappings.Rtypes.HTTP:
-            conf_section = conf.HTTP
-        else:
-            raise ValueError('Unrecognized replay type')
-
-        with session() as ses:
-            ses.post(conf_section.login_url, data=payload)
-            response = ses.get(conf_section.replay_url)
-            for each_line in response.text.splitlines():
-                match = re.search(conf_section.list_regex, each_line)
-                if match:
-                    print(match.group(1), file=desc)
+        for remote_file in iter_replay_list(replay_type, conf):
+            print(remote_file, file=desc)
 
     # output to file or to stdout?
     if outfile == '-':
@@ -4,10 +4,31 @@ Extract audio from downloaded files.
 """
 
 import os
+import time
 
 from subprocess import Popen, PIPE
 
-from replay_downloader import config, log, mappings, msgs, record, utils
+from replay_downloader import (
+    cache,
+    config,
+    flv,
+    log,
+    mappings,
+    mp4,
+    msgs,
+    perform,
+    priority,
+    record,
+    utils
+)
+
+
+# functions extracting audio in-process, by (file type, audio format);
+# the function takes source and destination path
+NATIVE_EXTRACTORS = {
+    (mappings.Ftypes.FLV, mappings.Ftypes.MP3): flv.extract_mp3_file,
+    (mappings.Ftypes.MP4, mappings.Ftypes.AAC): mp4.extract_aac_file,
+}
 
 
 class ExtractAudio:
@@ -16,21 +37,47 @@ class ExtractAudio:
     Schedulable object for 'ProcScheduler'.
     """
 
+    config_section = 'EXTRACT'
+    backends = ('subprocess', 'thread', 'process')
+
     def __init__(self, conf: config.Config, to_do: list, destination: str = ''):
         # necassary tools
         self.required_tools = [conf.COMMANDS.ffmpeg]
 
         self.conf = conf
+        self.priority = priority.Priority.from_config(conf, 'EXTRACT')
         self.out = {mappings.MsgTypes.active: msgs.MsgList('Extracting audio'),
                     mappings.MsgTypes.finished: msgs.MsgList('Audio extracting resulted in'),
                     mappings.MsgTypes.skipped: msgs.MsgList('Skipped extracting audio of'),
                     mappings.MsgTypes.failed: msgs.MsgList('Failed to extract audio'),
+                    mappings.MsgTypes.stalled: msgs.MsgList('Killed stalled extracting of'),
                     mappings.MsgTypes.errors: msgs.MsgList()}
         msgs.out_add(self.out)
         self._destination = ''
         self.destination = destination
         self.finished_ready = []
         self.to_do = to_do
+        self.native = conf.EXTRACT.native.lower() in ('yes', 'true', 'on', '1')
+        # pool of workers for native extracting, set by the pipeline for
+        # 'thread' and 'process' backends
+        self.executor = None
+        # ids of records that native extracting can't handle
+        self._ffmpeg_only = set()
+        # number of files extracted by one ffmpeg command
+        self.batch_size = max(int(conf.EXTRACT.batch_size or 1), 1)
+        # additional records extracted by the process, by process
+        self._batches = {}
+        # ids of records that must not be batched
+        self._single = set()
+        # how many times can be extracting killed by watchdog and tried again
+        self.retries = int(conf.EXTRACT.retries or 0)
+        # number of retries by record id
+        self._retried = {}
+
+    @classmethod
+    def create(cls, conf: config.Config, to_do: list, context: dict):
+        """Creates the stage for pipeline."""
+        return cls(conf, to_do, destination=context.get('destination', ''))
 
     @property
     def destination(self):
@@ -50,10 +97,29 @@ class ExtractAudio:
                 raise
         self._destination = destdir
 
-    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
-        """Runs command for extracting the audio in the background.
+    def progress(self, procinfo: mappings.Procinfo) -> int:
+        """Returns size of the extracted audio written so far."""
+        try:
+            return os.path.getsize(procinfo.file_record[-1].path)
+        except OSError:
+            return 0
 
-        Record corresponding metadata.
+    def expected_size(self, procinfo: mappings.Procinfo) -> int:
+        """Returns size of the file the audio is extracted from."""
+        try:
+            return os.path.getsize(procinfo.file_record[-2].path)
+        except OSError:
+            return None
+
+    def records(self, procinfo: mappings.Procinfo) -> list:
+        """Returns all file records handled by the running process (batch)."""
+        return [procinfo.file_record] + self._batches.get(procinfo.proc, [])
+
+    def _result_fileinfo(self, file_record: record.FileRecord) -> mappings.Fileinfo:
+        """Returns record of the file with extracted audio.
+
+        Returns None when there is nothing to extract, the record is already
+        passed on or marked as failed then.
         """
         local_file_name = file_record[-1].path
         file_type = file_record[-1].type
@@ -63,13 +129,13 @@ class ExtractAudio:
                 'Error: failed to extract, audio format info not passed for {}'
                 .format(local_file_name))
             self.out[mappings.MsgTypes.failed].add(local_file_name)
-            return
+            return None
 
         if file_type == audio_format:
             # nothing to do, passing for further processing
             # by next action in 'pipeline'
             self.finished_ready.append(file_record)
-            return
+            return None
 
         fname = '{}.{}'.format(utils.remove_ext(local_file_name),
                                mappings.file_ext_d[audio_format.name])
@@ -83,48 +149,173 @@ class ExtractAudio:
             self.out[mappings.MsgTypes.skipped].add(res_file)
             file_record.add(cur_fileinfo)
             self.finished_ready.append(file_record)
+            return None
+
+        return cur_fileinfo
+
+    def _native_extractor(self, file_record: record.FileRecord):
+        """Returns function for extracting the audio in-process, None if ffmpeg is needed."""
+        if not self.native or file_record.id in self._ffmpeg_only:
+            return None
+        return NATIVE_EXTRACTORS.get((file_record[-1].type, file_record[-1].audio_f))
+
+    def _batchable(self, file_record: record.FileRecord) -> bool:
+        return file_record.id not in self._single and self._native_extractor(file_record) is None
+
+    def _collect_batch(self, first: record.FileRecord, res_files: list) -> list:
+        """Takes records that can be extracted together with the 'first' one from 'to_do'.
+
+        Returns list of (file record, record of the result) pairs.
+        """
+        batch = []
+        kind = (first[-1].type, first[-1].audio_f)
+        while len(batch) + 1 < self.batch_size and len(self.to_do) > 0:
+            file_record = self.to_do.pop()
+            if (file_record[-1].type, file_record[-1].audio_f) != kind or \
+                    not self._batchable(file_record):
+                # keep the order, the batch ends here
+                self.to_do.append(file_record)
+                break
+            cur_fileinfo = self._result_fileinfo(file_record)
+            if cur_fileinfo is None:
+                continue
+            if cur_fileinfo.path in res_files:
+                self.to_do.append(file_record)
+                break
+            res_files.append(cur_fileinfo.path)
+            batch.append((file_record, cur_fileinfo))
+        return batch
+
+    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
+        """Runs command for extracting the audio in the background.
+
+        Record corresponding metadata. When 'batch_size' is bigger than one,
+        records of the same type waiting in 'to_do' are extracted by the same
+        ffmpeg command.
+        """
+        local_file_name = file_record[-1].path
+        cur_fileinfo = self._result_fileinfo(file_record)
+        if cur_fileinfo is None:
             return
+        res_file = cur_fileinfo.path
+
+        batch = []
+        extractor = self._native_extractor(file_record)
+        if extractor is not None:
+            if self.executor is None:
+                # needed only by native extracting, not worth importing at startup
+                # pylint: disable=import-outside-toplevel
+                import concurrent.futures
 
-        # run the command
-        proc = Popen([self.conf.COMMANDS.ffmpeg, '-i',
-                      local_file_name, '-vn', '-acodec', 'copy', res_file],
-                     stdout=PIPE, stderr=PIPE)
-        # add the file name to 'active' message queue
-        self.out[mappings.MsgTypes.active].add(res_file)
-        # update file history
-        file_record.add(cur_fileinfo)
+                self.executor = concurrent.futures.ThreadPoolExecutor()
+            proc = perform.FutureProc(self.executor.submit(extractor, local_file_name, res_file))
+        else:
+            if self.batch_size > 1 and self._batchable(file_record):
+                batch = self._collect_batch(file_record, [res_file])
+            if batch:
+                # one input and one output per record, each output gets audio of its input
+                outputs = [(local_file_name, res_file)] + [
+                    (rec[-1].path, fileinfo.path) for rec, fileinfo in batch]
+                command = [self.conf.COMMANDS.ffmpeg]
+                for src, _ in outputs:
+                    command += ['-i', src]
+                for num, (_, dest) in enumerate(outputs):
+                    command += ['-map', '{}:a'.format(num), '-acodec', 'copy', dest]
+            else:
+                command = [self.conf.COMMANDS.ffmpeg, '-i',
+                           local_file_name, '-vn', '-acodec', 'copy', res_file]
+            # run the command
+            proc = Popen(command, stdout=PIPE, stderr=PIPE, **self.priority.popen_kwargs())
+            if batch:
+                self._batches[proc] = [rec for rec, _ in batch]
+        for rec, fileinfo in [(file_record, cur_fileinfo)] + batch:
+            # add the file name to 'active' message queue
+            self.out[mappings.MsgTypes.active].add(fileinfo.path)
+            # update file history
+            rec.add(fileinfo)
         return mappings.Procinfo(proc, file_record)
 
+    def _failed(self, file_record: record.FileRecord, err: str, fields: dict):
+        filepath = file_record[-1].path
+        try:
+            os.remove(filepath)
+            log.logit('[delete] {}'.format(filepath), 'error', **fields)
+        except FileNotFoundError as emsg:
+            self.out[mappings.MsgTypes.errors].add(str(emsg))
+        self.out[mappings.MsgTypes.failed].add(filepath)
+        self.out[mappings.MsgTypes.errors].add(
+            'Error extracting {}: {}'.format(filepath, err))
+        # the record doesn't reach cleanup, its cached files can be evicted
+        cache.release([fileinfo.path for fileinfo in file_record])
+        # remove last entry from file_record
+        file_record.delete()
+
+    def _requeue(self, file_record: record.FileRecord):
+        """Removes the result of the last attempt and returns the record to 'to_do'."""
+        try:
+            os.remove(file_record[-1].path)
+        except FileNotFoundError:
+            pass
+        file_record.delete()
+        self.to_do.append(file_record)
+
     def finished_handler(self, procinfo: mappings.Procinfo) -> int:
         """Actions performed when extracting is finished."""
         proc = procinfo.proc
         filepath = procinfo.file_record[-1].path
         retcode = proc.poll()
+        batch = [procinfo.file_record] + self._batches.pop(proc, [])
+
+        # structured fields of log records
+        fields = {'job': procinfo.file_record.id, 'stage': 'extract_audio', 'file': filepath,
+                  'duration': round(time.time() - procinfo.file_record.tstamp, 3)}
+        if len(batch) > 1:
+            fields['batch'] = [rec.id for rec in batch]
 
         # get stdout and stderr of the command
         (out, err) = proc.communicate()
         if out:
-            log.logit('[extracting] stdout for {}:'.format(filepath))
-            log.logit(out.decode('utf-8'))
+            log.logit('[extracting] stdout for {}:\n{}'.format(filepath, out.decode('utf-8')),
+                      stream='stdout', **fields)
         if err:
-            log.logit('[extracting] stderr for {}'.format(filepath), 'error')
-            log.logit(err.decode('utf-8'), 'error')
-
-        # check if extracting was successful
-        if retcode == 0:
-            self.out[mappings.MsgTypes.finished].add(filepath)
-            # file is ready for further processing by next action in 'pipeline'
-            self.finished_ready.append(procinfo.file_record)
-        else:
-            try:
-                os.remove(filepath)
-                log.logit('[delete] {}'.format(filepath), 'error')
-            except FileNotFoundError as emsg:
-                self.out[mappings.MsgTypes.errors].add(str(emsg))
-            self.out[mappings.MsgTypes.failed].add(filepath)
-            self.out[mappings.MsgTypes.errors].add(
-                'Error extracting {}: {}'.format(filepath, err.decode('utf-8')))
-            # remove last entry from file_record
-            procinfo.file_record.delete()
+            log.logit('[extracting] stderr for {}:\n{}'.format(filepath, err.decode('utf-8')),
+                      'error', stream='stderr', **fields)
+        err = err.decode('utf-8')
+        stalled = getattr(proc, 'watchdog', '')
+
+        for file_record in batch:
+            rec_fields = dict(fields, job=file_record.id, file=file_record[-1].path)
+            if stalled:
+                self.out[mappings.MsgTypes.stalled].add(file_record[-1].path)
+                log.logit('[watchdog] killed {} extracting of {}'.format(
+                    stalled, file_record[-1].path), 'error', watchdog=stalled, **rec_fields)
+            # check if extracting was successful
+            if retcode != 0 and stalled and \
+                    self._retried.get(file_record.id, 0) < self.retries:
+                self._retried[file_record.id] = self._retried.get(file_record.id, 0) + 1
+                self._requeue(file_record)
+            elif (retcode != 0 and isinstance(proc, perform.FutureProc) and
+                    proc.exception() is not None):
+                # native extracting can't handle the file (unsupported codec,
+                # or the parser failed on broken file), try again with ffmpeg
+                log.logit('[extracting] falling back to ffmpeg for {}: {!r}'.format(
+                    file_record[-1].path, proc.exception()), **rec_fields)
+                self._ffmpeg_only.add(file_record.id)
+                self._requeue(file_record)
+            elif retcode == 0:
+                self.out[mappings.MsgTypes.finished].add(file_record[-1].path)
+                # file is ready for further processing by next action in 'pipeline'
+                self.finished_ready.append(file_record)
+            elif len(batch) > 1:
+                # ffmpeg stops all outputs when one input or output fails and the
+                # error output doesn't say reliably which one, every file is tried
+                # alone and only failure of its own command fails it
+                log.logit('[extracting] retrying {} separately'.format(file_record[-1].path),
+                          **rec_fields)
+                self._single.add(file_record.id)
+                self._requeue(file_record)
+            else:
+                self._failed(file_record, err, rec_fields)
 
+        log.logit('[extracting] finished {}'.format(filepath), retcode=retcode, **fields)
         return retcode
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Extracting MP3 audio from FLV container without ffmpeg.
+"""
+
+from replay_downloader.mappings import UnsupportedCodec
+
+# FLV tag types
+TAG_AUDIO = 8
+
+# sound formats of FLV audio tag that are MP3 (MP3 and MP3 8kHz)
+MP3_FORMATS = (2, 14)
+
+# size of output buffer
+WRITE_BUFFER = 1024 * 1024
+
+# size of input buffer for streams
+READ_BUFFER = 1024 * 1024
+
+TAG_HEADER_SIZE = 11
+PREV_TAG_SIZE = 4
+
+
+class _Writer:
+    """Collects small writes into large ones."""
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.buf = bytearray()
+        self.written = 0
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= WRITE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.outfile.write(self.buf)
+            self.written += len(self.buf)
+            self.buf = bytearray()
+
+
+def _check_sound_format(first_byte: int):
+    """Checks sound format of audio tag."""
+    sound_format = first_byte >> 4
+    if sound_format not in MP3_FORMATS:
+        raise UnsupportedCodec('unsupported sound format {}'.format(sound_format))
+
+
+def _header_size(header) -> int:
+    if len(header) < 9 or header[:3] != b'FLV':
+        raise UnsupportedCodec('not a FLV file')
+    return int.from_bytes(header[5:9], 'big')
+
+
+def extract_mp3_file(src: str, dest: str) -> int:
+    """Writes MP3 frames from FLV file 'src' into 'dest', returns number of bytes written.
+
+    The input file is memory-mapped. Raises 'UnsupportedCodec' before
+    anything is written when the audio is not MP3.
+    """
+    # needed only by native extracting, not worth importing at startup
+    # pylint: disable=import-outside-toplevel
+    import mmap
+
+    with open(src, 'rb') as ifl, \
+            mmap.mmap(ifl.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            pos = _header_size(data[:9]) + PREV_TAG_SIZE
+            end = len(view)
+            writer = None
+            ofl = None
+            try:
+                while pos + TAG_HEADER_SIZE <= end:
+                    tag_type = data[pos] & 0x1f
+                    size = int.from_bytes(data[pos + 1:pos + 4], 'big')
+                    start = pos + TAG_HEADER_SIZE
+                    pos = start + size + PREV_TAG_SIZE
+                    if tag_type != TAG_AUDIO or size < 2 or start + size > end:
+                        continue
+                    if writer is None:
+                        # the first audio tag
+                        _check_sound_format(data[start])
+                        ofl = open(dest, 'wb')
+                        writer = _Writer(ofl)
+                    writer.write(view[start + 1:start + size])
+                if writer is None:
+                    raise UnsupportedCodec('no audio found')
+                writer.flush()
+                return writer.written
+            finally:
+                if ofl is not None:
+                    ofl.close()
+        finally:
+            view.release()
+
+
+def _read_exact(infile, size: int, record: bytearray = None) -> bytes:
+    data = infile.read(size)
+    while len(data) < size:
+        chunk = infile.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    if record is not None:
+        record += data
+    return data
+
+
+def extract_mp3(infile, outfile, fallback=None) -> int:
+    """Writes MP3 frames from FLV stream 'infile' into 'outfile'.
+
+    Reads the stream as it comes, so it can be used on output of rtmpdump.
+
+    Args:
+        infile: Readable binary file object.
+        outfile: Writable binary file object.
+        fallback (callable): Returns writable binary file object where the whole
+            FLV stream is copied when the audio is not MP3. 'UnsupportedCodec'
+            is raised when the fallback is not specified.
+
+    Returns:
+        int: Number of audio bytes written, -1 if the fallback was used.
+    """
+    # everything read is recorded until it's known that the audio is MP3
+    record = bytearray()
+    writer = _Writer(outfile)
+    try:
+        header_size = _header_size(_read_exact(infile, 9, record))
+        _read_exact(infile, header_size - 9 + PREV_TAG_SIZE, record)
+        while True:
+            tag_header = _read_exact(infile, TAG_HEADER_SIZE, record)
+            if len(tag_header) < TAG_HEADER_SIZE:
+                break
+            size = int.from_bytes(tag_header[1:4], 'big')
+            data = _read_exact(infile, size + PREV_TAG_SIZE, record)[:size]
+            if (tag_header[0] & 0x1f) != TAG_AUDIO or len(data) < 2:
+                continue
+            if record is not None:
+                # the first audio tag
+                _check_sound_format(data[0])
+                record = None
+            writer.write(memoryview(data)[1:])
+        if record is not None:
+            raise UnsupportedCodec('no audio found')
+    except UnsupportedCodec:
+        if fallback is None or record is None:
+            raise
+        flvfile = fallback()
+        flvfile.write(record)
+        while True:
+            chunk = infile.read(READ_BUFFER)
+            if not chunk:
+                break
+            flvfile.write(chunk)
+        return -1
+
+    writer.flush()
+    return writer.written
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Hedged downloads from classic (RTMP) and mobile (HLS) replay.
+
+Most recordings are listed in both replays. When download from one of them
+is slow or fails, the same recording is downloaded from the other one too
+and the download that finishes first wins.
+"""
+
+import collections
+import os
+import time
+
+from replay_downloader import log, mappings, perform, utils
+
+
+# running download: process, remote file and the file being downloaded
+Candidate = collections.namedtuple('Candidate', 'proc source fileinfo')
+
+
+class SourceMap:
+    """Remote files of the same recording in both replays, by recording name."""
+
+    def __init__(self):
+        self._sources = {}
+
+    def __len__(self):
+        return len(self._sources)
+
+    def add(self, remote: mappings.Fileinfo):
+        """Adds remote file (stream) from replay listing."""
+        name = utils.recording_name(remote.path)
+        self._sources.setdefault(name, {})[remote.type] = remote
+
+    def alternative(self, remote: mappings.Fileinfo) -> mappings.Fileinfo:
+        """Returns the same recording in the other replay, None if it's not there."""
+        sources = self._sources.get(utils.recording_name(remote.path), {})
+        for rtype, other in sources.items():
+            if rtype is not remote.type:
+                return other
+        return None
+
+
+def remove_download(fileinfo: mappings.Fileinfo):
+    """Deletes the downloaded file and its unfinished version."""
+    for path in (fileinfo.path, fileinfo.path + mappings.PART_EXT):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class HedgedProc:
+    """Download that starts backup download from the other source.
+
+    The backup is started when the first download fails or when its average
+    rate is below 'min_rate' bytes per second after 'delay' seconds. The
+    first successful download wins, the other one is killed and its files
+    are deleted. Looks like process to 'ProcScheduler'; when finished,
+    'source' and 'fileinfo' describe the download that won.
+    """
+
+    def __init__(self, primary: Candidate, start_backup, min_rate: int = 0,
+                 delay: float = 60, clock=time.monotonic):
+        """
+        Args:
+            primary (Candidate): The running download.
+            start_backup: Callable that starts the backup download and returns
+                'Candidate', or None when it can't be started.
+            min_rate (int): Minimal average rate in bytes per second, 0 = don't check.
+            delay (float): Seconds after start when the rate is checked first.
+        """
+        self.primary = primary
+        self.backup = None
+        self.running = [primary]
+        # candidates that failed and their return codes
+        self.failed = []
+        # candidates killed because the other one won
+        self.lost = []
+        self.start_backup = start_backup
+        self.backup_started = False
+        self.min_rate = min_rate
+        self.delay = delay
+        self.clock = clock
+        self.started = clock()
+        self.killed = False
+        self.returncode = None
+        self.winner = None
+        self.source = None
+        self.fileinfo = None
+
+    @staticmethod
+    def _size(candidate: Candidate) -> int:
+        fileinfo = getattr(candidate.proc, 'fileinfo', None) or candidate.fileinfo
+        try:
+            return os.path.getsize(fileinfo.path + mappings.PART_EXT)
+        except OSError:
+            return 0
+
+    def progress(self) -> int:
+        """Returns number of bytes downloaded by all running downloads."""
+        return sum(self._size(candidate) for candidate in self.running)
+
+    def _slow(self) -> bool:
+        if not self.min_rate or not self.running:
+            return False
+        elapsed = self.clock() - self.started
+        return elapsed >= self.delay and self._size(self.running[0]) / elapsed < self.min_rate
+
+    def _backup(self, reason: str):
+        self.backup_started = True
+        primary = (self.running or [candidate for candidate, _ in self.failed])[0]
+        log.logit('[hedge] download of {} {}, trying the other source'.format(
+            primary.source.path, reason), 'error', file=primary.fileinfo.path, hedge=reason)
+        try:
+            backup = self.start_backup()
+        # pylint: disable=broad-except
+        except Exception as emsg:
+            log.logit('[hedge] backup download failed to start: {}'.format(emsg), 'error')
+            backup = None
+        if backup is not None:
+            self.backup = backup
+            self.running.append(backup)
+
+    def _finish(self, winner: Candidate, retcode: int):
+        self.winner = winner
+        self.source = winner.source
+        self.fileinfo = getattr(winner.proc, 'fileinfo', None) or winner.fileinfo
+        self.returncode = retcode
+        for candidate in self.running + [candidate for candidate, _ in self.failed]:
+            if candidate is winner:
+                continue
+            if candidate.proc.poll() is None:
+                perform.kill_proc(candidate.proc)
+                self.lost.append(candidate)
+            # wait for the process and close its pipes
+            candidate.proc.communicate()
+            fileinfo = getattr(candidate.proc, 'fileinfo', None) or candidate.fileinfo
+            if fileinfo.path != self.fileinfo.path:
+                remove_download(fileinfo)
+        if len(self.running) + len(self.failed) > 1:
+            log.logit('[hedge] {} won'.format(winner.source.path), file=self.fileinfo.path,
+                      retcode=retcode)
+        self.running = []
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        for candidate in list(self.running):
+            retcode = candidate.proc.poll()
+            if retcode == 0:
+                self._finish(candidate, 0)
+                return 0
+            if retcode is not None:
+                self.running.remove(candidate)
+                self.failed.append((candidate, retcode))
+        if not self.backup_started and not self.killed:
+            if self.failed:
+                self._backup('failed')
+            elif self._slow():
+                self._backup('is too slow')
+        if not self.running:
+            self._finish(*self.failed[-1])
+        return self.returncode
+
+    def outcome(self, candidate: Candidate) -> bool:
+        """Returns True if the candidate succeeded, False if it failed.
+
+        Returns None when it was killed only because the other one won.
+        """
+        if candidate is self.winner:
+            return self.returncode == 0
+        if any(candidate is lost for lost in self.lost):
+            return None
+        return False
+
+    def communicate(self):
+        """Returns output of the download that won."""
+        if self.winner is None:
+            return b'', b''
+        return self.winner.proc.communicate()
+
+    def kill(self):
+        self.killed = True
+        for candidate in self.running:
+            perform.kill_proc(candidate.proc)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+HLS playlists.
+"""
+
+import collections
+import re
+
+from urllib.parse import urljoin
+
+
+# variant stream of master playlist; attrs is dict of attributes from EXT-X-STREAM-INF
+Variant = collections.namedtuple('Variant', 'url bandwidth codecs attrs')
+
+# alternative rendition from EXT-X-MEDIA (e.g. audio-only stream)
+Rendition = collections.namedtuple('Rendition', 'url type group name attrs')
+
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attrs(attr_list: str) -> dict:
+    """Parses attribute list like 'BANDWIDTH=1280000,CODECS="mp4a.40.2"'."""
+    return {key: value.strip('"') for key, value in _ATTR_RE.findall(attr_list)}
+
+
+class Playlist:
+    """Parsed HLS playlist, either master or media playlist."""
+
+    def __init__(self, text: str, url: str = ''):
+        self.url = url
+        self.variants = []
+        self.renditions = []
+        # durations of media segments
+        self.segments = []
+        self.segment_urls = []
+
+        stream_attrs = None
+        duration = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXT-X-STREAM-INF:'):
+                stream_attrs = parse_attrs(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MEDIA:'):
+                attrs = parse_attrs(line.split(':', 1)[1])
+                self.renditions.append(Rendition(
+                    urljoin(url, attrs['URI']) if 'URI' in attrs else '',
+                    attrs.get('TYPE', ''), attrs.get('GROUP-ID', ''), attrs.get('NAME', ''),
+                    attrs))
+            elif line.startswith('#EXTINF:'):
+                duration = float(line.split(':', 1)[1].split(',')[0])
+            elif line.startswith('#'):
+                continue
+            elif stream_attrs is not None:
+                self.variants.append(Variant(urljoin(url, line),
+                                             int(stream_attrs.get('BANDWIDTH', 0)),
+                                             stream_attrs.get('CODECS', ''), stream_attrs))
+                stream_attrs = None
+            elif duration is not None:
+                self.segments.append(duration)
+                self.segment_urls.append(urljoin(url, line))
+                duration = None
+
+    @property
+    def is_master(self) -> bool:
+        return bool(self.variants)
+
+    @property
+    def duration(self) -> float:
+        """Total duration of media segments in seconds."""
+        return sum(self.segments)
+
+
+# rendition policies for 'select_rendition'
+POLICIES = ('audio', 'lowest', 'highest', 'master')
+
+_VIDEO_CODECS = ('avc', 'hvc', 'hev', 'vp0', 'vp9', 'av01', 'mp4v')
+
+
+def is_audio_only(variant: Variant) -> bool:
+    """Checks if the variant stream has audio codecs only (known from CODECS)."""
+    codecs = [codec.strip() for codec in variant.codecs.split(',') if codec.strip()]
+    return bool(codecs) and not any(codec.startswith(_VIDEO_CODECS) for codec in codecs)
+
+
+def select_rendition(playlist: Playlist, policy: str, max_bandwidth: int = 0) -> tuple:
+    """Chooses stream of master playlist to download.
+
+    Policies:
+    - 'audio' - audio rendition (EXT-X-MEDIA) or audio-only variant, the
+      lowest bandwidth variant when there's no audio-only stream,
+    - 'lowest' - variant with the lowest bandwidth,
+    - 'highest' - variant with the highest bandwidth not exceeding
+      'max_bandwidth' (bits per second, 0 means no limit),
+    - 'master' - leave the choice to ffmpeg.
+
+    Returns:
+        tuple: URL of the stream and its description, (None, '') when the
+            master playlist should be used.
+    """
+    if policy not in POLICIES:
+        raise ValueError("unknown rendition policy '{}'".format(policy))
+    if policy == 'master' or not playlist.is_master:
+        return None, ''
+
+    if policy == 'audio':
+        audio = [rend for rend in playlist.renditions if rend.type == 'AUDIO' and rend.url]
+        # prefer the default rendition
+        audio.sort(key=lambda rend: rend.attrs.get('DEFAULT') != 'YES')
+        if audio:
+            return audio[0].url, 'audio rendition {}'.format(audio[0].name or audio[0].group)
+
+    variants = sorted(playlist.variants, key=lambda variant: variant.bandwidth)
+    if max_bandwidth:
+        variants = [variant for variant in variants
+                    if variant.bandwidth <= max_bandwidth] or variants[:1]
+    if policy == 'audio':
+        variants = [variant for variant in variants if is_audio_only(variant)] or variants
+    chosen = variants[-1] if policy == 'highest' else variants[0]
+    return chosen.url, 'variant {} b/s {}'.format(chosen.bandwidth, chosen.codecs).strip()
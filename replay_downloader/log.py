@@ -1,38 +1,109 @@
 # -*- coding: utf-8 -*-
 """
 Logging.
+
+Log records are passed through a queue to a background thread that does
+the actual writing, so logging doesn't slow down the scheduling loop.
+Every record is written as one line of JSON.
 """
 
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 
 
 # path to the log file
 LOGFILE = None
 
+_LOGGER = logging.getLogger('replay_downloader')
+_LISTENER = None
+
+_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log record as JSON line.
+
+    Structured fields passed to 'logit' (job, stage, file, duration, ...)
+    are included in the output.
+    """
 
-def log_init(logfile: str):
-    """Initializes logging."""
+    def format(self, record):
+        entry = {'time': round(record.created, 3),
+                 'level': record.levelname.lower(),
+                 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+def log_init(logfile: str, max_bytes: int = 0, backup_count: int = 0):
+    """Initializes logging, replaces logging set up by earlier call.
+
+    Args:
+        logfile (str): Path to the log file.
+        max_bytes (int): Rotate the log file when it reaches this size, 0 means never.
+        backup_count (int): Number of rotated log files to keep.
+    """
     if not logfile:
         return
 
     try:
-        logging.basicConfig(filename=logfile, level=logging.DEBUG)
-        global LOGFILE
-        LOGFILE = logfile
+        if max_bytes:
+            handler = logging.handlers.RotatingFileHandler(
+                logfile, maxBytes=max_bytes, backupCount=backup_count)
+        else:
+            handler = logging.FileHandler(logfile)
     except EnvironmentError as emsg:
         print(str(emsg), file=sys.stderr)
+        return
+    handler.setFormatter(JsonFormatter())
+    # only one log file is written to
+    log_shutdown()
 
+    log_queue = queue.Queue()
+    _LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
+    _LOGGER.setLevel(logging.DEBUG)
+    _LOGGER.propagate = False
 
-def logit(message: str, level='info'):
-    """Logs message."""
-    if not LOGFILE:
+    global LOGFILE, _LISTENER
+    _LISTENER = logging.handlers.QueueListener(log_queue, handler)
+    _LISTENER.start()
+    LOGFILE = logfile
+    atexit.register(log_shutdown)
+
+
+def log_shutdown():
+    """Writes all queued records and stops logging."""
+    global LOGFILE, _LISTENER
+    if _LISTENER is None:
         return
 
-    method = getattr(logging, level.lower())
+    _LISTENER.stop()
+    for handler in _LISTENER.handlers:
+        handler.close()
+    for handler in list(_LOGGER.handlers):
+        _LOGGER.removeHandler(handler)
+    _LISTENER = None
+    LOGFILE = None
+    atexit.unregister(log_shutdown)
 
-    try:
-        for each_line in message.splitlines():
-            method(each_line)
-    except EnvironmentError as emsg:
-        print(str(emsg), file=sys.stderr)
+
+def logit(message: str, level='info', **fields):
+    """Logs message.
+
+    Keyword arguments are structured fields of the record, e.g.
+    'job', 'stage', 'file' and 'duration'.
+    """
+    if not LOGFILE:
+        return
+
+    _LOGGER.log(_LEVELS.get(level.lower(), logging.INFO), message, extra={'fields': fields})
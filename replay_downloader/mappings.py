@@ -4,6 +4,7 @@ Values mappings.
 """
 
 import collections
+import sys
 
 from enum import Enum
 
@@ -11,11 +12,66 @@ from enum import Enum
 # extension of file that is not ready yet
 PART_EXT = '.part'
 
-# file path, type, class that created the record, audio format, video format
-Fileinfo = collections.namedtuple('Fileinfo', 'path type clname audio_f video_f')
 
-# clname, audio_f and video_f are optional
-Fileinfo.__new__.__defaults__ = ('', '', '')
+class Fileinfo:
+    """File path, type, class that created the record, audio format, video format.
+
+    Compact replacement of namedtuple - there can be hundreds of thousands
+    of these. The directory part of the path, file extension and the class
+    name are interned, so they are shared by all records with the same values.
+    File name without extension can be shared inside 'FileRecord'.
+    """
+    __slots__ = ('_prefix', '_stem', '_ext', 'type', 'clname', 'audio_f', 'video_f')
+
+    _fields = ('path', 'type', 'clname', 'audio_f', 'video_f')
+
+    # clname, audio_f and video_f are optional
+    def __init__(self, path: str, type, clname: str = '', audio_f='', video_f=''):
+        # pylint: disable=redefined-builtin
+        # split the path after last '/', e.g. 'rtmp://' + 'foo'
+        sep = path.rfind('/') + 1
+        dot = path.rfind('.', sep)
+        if dot < 0:
+            dot = len(path)
+        self._prefix = sys.intern(path[:sep])
+        self._stem = path[sep:dot]
+        self._ext = sys.intern(path[dot:])
+        self.type = type
+        self.clname = sys.intern(clname)
+        self.audio_f = audio_f
+        self.video_f = video_f
+
+    @property
+    def path(self) -> str:
+        return self._prefix + self._stem + self._ext
+
+    def _astuple(self) -> tuple:
+        return (self.path, self.type, self.clname, self.audio_f, self.video_f)
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __eq__(self, other):
+        if not isinstance(other, Fileinfo):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __repr__(self):
+        return 'Fileinfo({})'.format(', '.join(
+            '{}={!r}'.format(field, value) for field, value in zip(self._fields, self)))
+
+    def _replace(self, **kwargs):
+        values = dict(zip(self._fields, self))
+        values.update(kwargs)
+        return Fileinfo(**values)
+
+
+class UnsupportedCodec(Exception):
+    """The audio can't be extracted natively (unsupported codec or container)."""
+
 
 # proc is an object returned by Popen, file_record is an instance of FileRecord
 Procinfo = collections.namedtuple('Procinfo', 'proc file_record')
@@ -34,6 +90,8 @@ class Rtypes(Enum):
     """Protocols used for downloading the remote file."""
     RTMP = 0
     HTTP = 1
+    # direct URL of media file
+    HTTPFILE = 2
 
 
 class Ftypes(Enum):
@@ -60,3 +118,5 @@ class MsgTypes(Enum):
     skipped = 2
     failed = 3
     errors = 4
+    # killed by watchdog
+    stalled = 5
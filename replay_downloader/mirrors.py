@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Choosing between mirrors of the replay server.
+"""
+
+import socket
+import threading
+import time
+
+from urllib.parse import urlsplit, urlunsplit
+
+from replay_downloader import config, log, session
+
+
+DEFAULT_PORTS = {'rtmp': 1935, 'http': 80, 'https': 443}
+
+
+class Mirror:
+    """Base URL of one mirror and its measured quality."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        parts = urlsplit(self.url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or DEFAULT_PORTS.get(parts.scheme, 80)
+        # connect time in seconds, None when not probed or unreachable
+        self.latency = None
+        # bytes per second, None when not measured
+        self.throughput = None
+        self.reachable = True
+        # number of downloads from the mirror that are running
+        self.active = 0
+        # consecutive failed downloads
+        self.failures = 0
+        self.demoted_until = 0.0
+
+    def __repr__(self):
+        return 'Mirror({!r})'.format(self.url)
+
+    def score(self) -> tuple:
+        """Returns sort key, better mirrors are first."""
+        if not self.reachable:
+            return (2, 0.0)
+        if self.throughput:
+            return (0, -self.throughput)
+        if self.latency is not None:
+            return (1, self.latency)
+        # not probed yet, keep the configured order
+        return (1, float('inf'))
+
+    def rebase(self, url: str) -> str:
+        """Returns 'url' with scheme and host replaced by those of the mirror."""
+        parts = urlsplit(url)
+        base = urlsplit(self.url)
+        return urlunsplit((base.scheme, base.netloc, base.path + parts.path, parts.query,
+                           parts.fragment))
+
+
+def _probe_http(mirror: Mirror, timeout: float, probe_bytes: int, ses: 'requests.Session'):
+    """Requests up to 'probe_bytes' from the base URL of HTTP mirror."""
+    start = time.time()
+    if probe_bytes <= 0:
+        ses.head(mirror.url, timeout=timeout).close()
+        mirror.latency = time.time() - start
+        return
+    response = ses.get(mirror.url, headers={'Range': 'bytes=0-{}'.format(probe_bytes - 1)},
+                       stream=True, timeout=timeout)
+    try:
+        mirror.latency = time.time() - start
+        received = 0
+        for chunk in response.iter_content(probe_bytes):
+            received += len(chunk)
+            if received >= probe_bytes:
+                break
+        elapsed = time.time() - start
+    finally:
+        response.close()
+    mirror.throughput = received / elapsed if received and elapsed > 0 else None
+
+
+def probe(mirror: Mirror, timeout: float, probe_bytes: int, ses: 'requests.Session' = None):
+    """Measures latency of the mirror and throughput of HTTP mirrors.
+
+    HTTP mirrors are probed by the session 'ses' (so proxy, TLS and cookie
+    settings apply): latency is time until response headers, throughput is
+    measured by downloading up to 'probe_bytes' from the base URL. Latency of
+    other mirrors is time needed to open TCP connection.
+    """
+    try:
+        if mirror.scheme in ('http', 'https') and ses is not None:
+            _probe_http(mirror, timeout, probe_bytes, ses)
+        else:
+            start = time.time()
+            socket.create_connection((mirror.host, mirror.port), timeout=timeout).close()
+            mirror.latency = time.time() - start
+        mirror.reachable = True
+    # errors of 'requests' are subclasses of IOError
+    except EnvironmentError as emsg:
+        mirror.latency = None
+        mirror.throughput = None
+        mirror.reachable = False
+        log.logit('[mirrors] {} is unreachable: {}'.format(mirror.url, emsg), 'error')
+
+
+class MirrorPool:
+    """Spreads downloads across mirrors.
+
+    The best mirror with free capacity that is not demoted is used for every
+    download. Mirrors are probed at start and every 'probe_interval' seconds
+    in background; mirror that failed 'max_failures' downloads in a row is
+    not used for 'demote_time' seconds.
+    """
+
+    def __init__(self, urls: list, max_jobs: int = 0, probe_interval: float = 600,
+                 probe_timeout: float = 5, probe_bytes: int = 65536, max_failures: int = 3,
+                 demote_time: float = 600, clock=time.time, conf: config.Config = None):
+        self.mirrors = [Mirror(url) for url in urls]
+        # configuration of the session used for probing HTTP mirrors
+        self.conf = conf
+        # maximal number of parallel downloads from one mirror, 0 means unlimited
+        self.max_jobs = max_jobs
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.probe_bytes = probe_bytes
+        self.max_failures = max_failures
+        self.demote_time = demote_time
+        self.clock = clock
+        self.last_probe = None
+        self._probing = None
+
+    @classmethod
+    def from_config(cls, conf: config.Config, urls: list):
+        opts = conf.MIRRORS
+        return cls(urls, max_jobs=int(opts.max_jobs),
+                   probe_interval=float(opts.probe_interval),
+                   probe_timeout=float(opts.probe_timeout),
+                   probe_bytes=int(opts.probe_bytes),
+                   max_failures=int(opts.max_failures),
+                   demote_time=float(opts.demote_time),
+                   conf=conf)
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def probe_all(self):
+        """Probes all mirrors in parallel and waits for results."""
+        # needed only when there are several mirrors, not worth importing at startup
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+
+        self.last_probe = self.clock()
+        ses = None
+        if any(mirror.scheme in ('http', 'https') for mirror in self.mirrors):
+            ses = session.get_session(self.conf or config.Config())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.mirrors)) as executor:
+            for mirror in self.mirrors:
+                executor.submit(probe, mirror, self.probe_timeout, self.probe_bytes, ses)
+        for mirror in self.mirrors:
+            log.logit('[mirrors] {} latency {} throughput {}'.format(
+                mirror.url, mirror.latency, mirror.throughput),
+                      mirror=mirror.url, latency=mirror.latency, throughput=mirror.throughput)
+
+    def maybe_probe(self):
+        """Probes mirrors in background when it's time."""
+        if len(self.mirrors) < 2:
+            return
+        if self._probing is not None and self._probing.is_alive():
+            return
+        if self.last_probe is not None and \
+                self.clock() - self.last_probe < self.probe_interval:
+            return
+        self.last_probe = self.clock()
+        self._probing = threading.Thread(target=self.probe_all, daemon=True)
+        self._probing.start()
+
+    def _candidates(self) -> list:
+        now = self.clock()
+        healthy = [mirror for mirror in self.mirrors
+                   if mirror.reachable and mirror.demoted_until <= now]
+        # better to try bad mirror than to stop downloading
+        return sorted(healthy or self.mirrors, key=Mirror.score)
+
+    def _has_capacity(self, mirror: Mirror) -> bool:
+        return not self.max_jobs or mirror.active < self.max_jobs
+
+    def available(self) -> bool:
+        """Checks if there's a mirror that can take another download."""
+        return any(self._has_capacity(mirror) for mirror in self._candidates())
+
+    def acquire(self) -> Mirror:
+        """Returns mirror for new download, None if all are busy."""
+        for mirror in self._candidates():
+            if self._has_capacity(mirror):
+                mirror.active += 1
+                return mirror
+        return None
+
+    def release(self, mirror: Mirror, success: bool):
+        """Records that download from the mirror finished.
+
+        'success' None means the download was stopped before it could
+        succeed or fail (e.g. it lost the hedge race), the score is kept.
+        """
+        mirror.active -= 1
+        if success is None:
+            return
+        if success:
+            mirror.failures = 0
+            return
+        mirror.failures += 1
+        if mirror.failures >= self.max_failures:
+            mirror.failures = 0
+            mirror.demoted_until = self.clock() + self.demote_time
+            log.logit('[mirrors] demoting {} for {:.0f} s'.format(mirror.url, self.demote_time),
+                      'error', mirror=mirror.url)
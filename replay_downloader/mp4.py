@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Extracting AAC audio from MP4 container without ffmpeg.
+
+The sample tables of the audio track are read from the 'moov' box and the
+samples are written with ADTS headers (the same output as
+'ffmpeg -i file.mp4 -vn -acodec copy file.aac').
+"""
+
+import os
+import struct
+
+from replay_downloader.mappings import UnsupportedCodec
+
+
+# size of output buffer
+WRITE_BUFFER = 1024 * 1024
+
+# object type indications of AAC in decoder config descriptor
+# (MPEG-4 audio, MPEG-2 AAC Main, LC and SSR)
+AAC_OBJECT_TYPES = (0x40, 0x66, 0x67, 0x68)
+
+# ADTS header can't describe longer frames
+MAX_FRAME_SIZE = 0x1fff
+
+ADTS_HEADER_SIZE = 7
+
+
+def iter_boxes(data, start: int, end: int):
+    """Generates (type, payload start, payload end) of boxes in 'data[start:end]'."""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise UnsupportedCodec('truncated {} box'.format(box_type.decode('latin-1')))
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def find_box(data, start: int, end: int, box_type: bytes):
+    """Returns (payload start, payload end) of the first box of given type, None if missing."""
+    for found, box_start, box_end in iter_boxes(data, start, end):
+        if found == box_type:
+            return box_start, box_end
+    return None
+
+
+def _descriptor(data, pos: int):
+    """Returns tag, payload start and payload end of MPEG-4 descriptor."""
+    tag = data[pos]
+    pos += 1
+    size = 0
+    for _ in range(4):
+        byte = data[pos]
+        pos += 1
+        size = (size << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + size
+
+
+def _bits(config: bytes):
+    """Reads big-endian bit fields of AudioSpecificConfig."""
+    value = int.from_bytes(config, 'big')
+    remaining = [len(config) * 8]
+
+    def read(num: int) -> int:
+        if remaining[0] < num:
+            raise UnsupportedCodec('truncated audio specific config')
+        remaining[0] -= num
+        return (value >> remaining[0]) & ((1 << num) - 1)
+    return read
+
+
+def parse_audio_config(config: bytes) -> tuple:
+    """Returns (ADTS profile, sampling frequency index, channel configuration)."""
+    read = _bits(config)
+
+    def object_type():
+        otype = read(5)
+        return 32 + read(6) if otype == 31 else otype
+
+    otype = object_type()
+    freq_index = read(4)
+    if freq_index == 15:
+        raise UnsupportedCodec('explicit sampling frequency')
+    channels = read(4)
+    if otype in (5, 29):
+        # SBR / PS signalled explicitly, ADTS carries the core AAC config
+        if read(4) == 15:
+            read(24)
+        otype = object_type()
+    if not 1 <= otype <= 4:
+        raise UnsupportedCodec('audio object type {} is not supported by ADTS'.format(otype))
+    if channels == 0:
+        raise UnsupportedCodec('channel configuration in program config element')
+    return otype - 1, freq_index, channels
+
+
+def parse_esds(data, start: int, end: int) -> bytes:
+    """Returns AudioSpecificConfig from 'esds' box payload."""
+    # skip version and flags
+    tag, pos, desc_end = _descriptor(data, start + 4)
+    if tag != 3:
+        raise UnsupportedCodec('missing ES descriptor')
+    flags = data[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + data[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, desc_end = _descriptor(data, pos)
+    if tag != 4:
+        raise UnsupportedCodec('missing decoder config descriptor')
+    if data[pos] not in AAC_OBJECT_TYPES:
+        raise UnsupportedCodec('object type 0x{:02x} is not AAC'.format(data[pos]))
+    tag, pos, desc_end = _descriptor(data, pos + 13)
+    if tag != 5 or desc_end > end:
+        raise UnsupportedCodec('missing audio specific config')
+    return bytes(data[pos:desc_end])
+
+
+def _table(data, start: int, fmt: str, count: int) -> tuple:
+    return struct.unpack_from('>{}{}'.format(count, fmt), data, start)
+
+
+class AudioTrack:
+    """Sample tables of AAC track."""
+
+    def __init__(self, data, start: int, end: int):
+        """Reads the tables from 'stbl' box payload in 'data[start:end]'."""
+        boxes = {box_type: (box_start, box_end)
+                 for box_type, box_start, box_end in iter_boxes(data, start, end)}
+        for required in (b'stsd', b'stsz', b'stsc'):
+            if required not in boxes:
+                raise UnsupportedCodec('missing {} box'.format(required.decode('ascii')))
+
+        # the first sample description: version, flags, entry count, entry header
+        stsd_start, stsd_end = boxes[b'stsd']
+        entry_type = data[stsd_start + 12:stsd_start + 16]
+        if entry_type != b'mp4a':
+            raise UnsupportedCodec('unsupported sample entry {}'.format(entry_type))
+        # 'mp4a' box header, sample entry and audio sample entry fields
+        esds = find_box(data, stsd_start + 8 + 8 + 28, stsd_end, b'esds')
+        if esds is None:
+            raise UnsupportedCodec('missing esds box')
+        self.profile, self.freq_index, self.channels = parse_audio_config(
+            parse_esds(data, esds[0], esds[1]))
+
+        pos = boxes[b'stsz'][0]
+        sample_size, count = struct.unpack_from('>II', data, pos + 4)
+        if sample_size:
+            self.sizes = (sample_size, ) * count
+        else:
+            self.sizes = _table(data, pos + 12, 'I', count)
+
+        pos = boxes[b'stsc'][0]
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        stsc = _table(data, pos + 8, 'I', count * 3)
+        # (first chunk, samples per chunk) pairs
+        self.chunk_runs = list(zip(stsc[0::3], stsc[1::3]))
+
+        if b'stco' in boxes:
+            pos = boxes[b'stco'][0]
+            fmt = 'I'
+        elif b'co64' in boxes:
+            pos = boxes[b'co64'][0]
+            fmt = 'Q'
+        else:
+            raise UnsupportedCodec('missing chunk offsets')
+        count = struct.unpack_from('>I', data, pos + 4)[0]
+        self.chunk_offsets = _table(data, pos + 8, fmt, count)
+
+    def chunks(self):
+        """Generates (offset, sample sizes) of chunks - samples of a chunk are contiguous."""
+        sample = 0
+        runs = self.chunk_runs + [(len(self.chunk_offsets) + 1, 0)]
+        for (first, per_chunk), (next_first, _) in zip(runs, runs[1:]):
+            for chunk in range(first, next_first):
+                yield self.chunk_offsets[chunk - 1], self.sizes[sample:sample + per_chunk]
+                sample += per_chunk
+
+    def adts_header(self, size: int) -> bytes:
+        """Returns ADTS header of frame with 'size' bytes of raw data."""
+        length = size + ADTS_HEADER_SIZE
+        # syncword, MPEG-4, layer 0, no CRC; buffer fullness 0x7ff (VBR)
+        return bytes((0xff, 0xf1,
+                      (self.profile << 6) | (self.freq_index << 2) | (self.channels >> 2),
+                      ((self.channels & 3) << 6) | (length >> 11),
+                      (length >> 3) & 0xff,
+                      ((length & 7) << 5) | 0x1f,
+                      0xfc))
+
+
+def find_audio_track(data) -> AudioTrack:
+    """Returns the first sound track of the MP4 file."""
+    moov = find_box(data, 0, len(data), b'moov')
+    if moov is None:
+        raise UnsupportedCodec('not a MP4 file')
+    for box_type, trak_start, trak_end in iter_boxes(data, moov[0], moov[1]):
+        if box_type != b'trak':
+            continue
+        mdia = find_box(data, trak_start, trak_end, b'mdia')
+        if mdia is None:
+            continue
+        hdlr = find_box(data, mdia[0], mdia[1], b'hdlr')
+        # version, flags and pre-defined field precede handler type
+        if hdlr is None or data[hdlr[0] + 8:hdlr[0] + 12] != b'soun':
+            continue
+        minf = find_box(data, mdia[0], mdia[1], b'minf')
+        stbl = minf and find_box(data, minf[0], minf[1], b'stbl')
+        if stbl is None:
+            continue
+        return AudioTrack(data, stbl[0], stbl[1])
+    raise UnsupportedCodec('no audio found')
+
+
+def read_audio_track(data) -> AudioTrack:
+    """Returns the audio track, checks that its samples can be written as ADTS.
+
+    Errors of parsing broken file are raised as 'UnsupportedCodec'.
+    """
+    try:
+        track = find_audio_track(data)
+        if not track.sizes:
+            # e.g. fragmented MP4, samples are not in the 'moov' box
+            raise UnsupportedCodec('no samples in sample table')
+        if max(track.sizes) + ADTS_HEADER_SIZE > MAX_FRAME_SIZE:
+            raise UnsupportedCodec('frame too long for ADTS')
+        end = len(data)
+        for offset, sizes in track.chunks():
+            if offset + sum(sizes) > end:
+                raise UnsupportedCodec('sample table points outside of the file')
+    except (struct.error, IndexError, ValueError) as emsg:
+        raise UnsupportedCodec('broken MP4 file: {}'.format(emsg))
+    return track
+
+
+def _write_adts(data, track: AudioTrack, dest: str) -> int:
+    written = 0
+    view = memoryview(data)
+    try:
+        with open(dest, 'wb', buffering=WRITE_BUFFER) as ofl:
+            for offset, sizes in track.chunks():
+                for size in sizes:
+                    ofl.write(track.adts_header(size))
+                    ofl.write(view[offset:offset + size])
+                    offset += size
+                written += sum(sizes) + ADTS_HEADER_SIZE * len(sizes)
+    finally:
+        view.release()
+    return written
+
+
+def extract_aac_file(src: str, dest: str) -> int:
+    """Writes AAC frames from MP4 file 'src' into ADTS file 'dest', returns bytes written.
+
+    The input file is memory-mapped. Raises 'UnsupportedCodec' before
+    anything is written when the audio can't be extracted this way.
+    """
+    # needed only by native extracting, not worth importing at startup
+    # pylint: disable=import-outside-toplevel
+    import mmap
+
+    with open(src, 'rb') as ifl:
+        if os.fstat(ifl.fileno()).st_size == 0:
+            # empty file can't be memory-mapped
+            raise UnsupportedCodec('empty file')
+        with mmap.mmap(ifl.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _write_adts(data, read_audio_track(data), dest)
@@ -34,6 +34,9 @@ class MsgList:
     def add(self, message: str):
         self.msglist.append((message, time.time()))
 
+    def clear(self):
+        self.msglist = []
+
     def get_new(self):
         """New messages iterator."""
         # get messages that were not displayed (requested) yet
@@ -103,6 +106,7 @@ class Msgs:
         _print(mappings.MsgTypes.finished)
         _print(mappings.MsgTypes.failed)
         _print(mappings.MsgTypes.skipped)
+        _print(mappings.MsgTypes.stalled)
 
 
 def out_add(out: dict):
@@ -113,6 +117,16 @@ def out_add(out: dict):
         _OUT.setdefault(key, []).append(out[key])
 
 
+def out_remove(out: dict):
+    """Removes message queues added by 'out_add' from dictionary."""
+    for key in out:
+        msglists = [msglist for msglist in _OUT.get(key, []) if msglist is not out[key]]
+        if msglists:
+            _OUT[key] = msglists
+        else:
+            _OUT.pop(key, None)
+
+
 def setup_messages(args):
     """Instantiates "messages" and choose how its output will be presented."""
     messages = Msgs()
@@ -5,13 +5,16 @@ Handling processes execution.
 
 import signal
 import sys
+import threading
 import time
 import traceback
 import os
 
-from subprocess import Popen
+from replay_downloader import log, mappings, tools, trace, utils
 
-from replay_downloader import mappings
+
+# seconds between iterations of the main loop
+LOOP_DELAY = 0.5
 
 
 class CleanExit:
@@ -21,6 +24,9 @@ class CleanExit:
         self.pipeline = pipeline
 
     def __enter__(self):
+        # signal handlers can be set only in the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
         signal.signal(signal.SIGTERM, lambda *args: sys.exit(mappings.ExitCodes.INTERRUPTED))
 
     def __exit__(self, exc_type, value, trace):
@@ -32,7 +38,11 @@ class CleanExit:
                 for proc_info in task.running_procs:
                     proc_o = proc_info.proc
                     if proc_o.poll() is None:
-                        proc_o.kill()
+                        kill_proc(proc_o)
+                # stop pool of workers used by the task
+                executor = getattr(getattr(task, 'obj', None), 'executor', None)
+                if executor is not None:
+                    executor.shutdown(wait=exc_type is None)
         # pylint: disable=broad-except
         except Exception:
             traceback.print_exc()
@@ -43,36 +53,225 @@ class CleanExit:
         return exc_type is None
 
 
+class FutureProc:
+    """Wraps 'concurrent.futures.Future' so it looks like process to 'ProcScheduler'.
+
+    Return code is 0 when the function finished without exception, 1 otherwise.
+    """
+    def __init__(self, future, stop=None):
+        """The optional 'stop' callable asks the running function to stop early."""
+        self.future = future
+        self.stop = stop
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and self.future.done():
+            self.returncode = 1 if self.future.cancelled() or self.future.exception() else 0
+        return self.returncode
+
+    def communicate(self):
+        """Returns empty stdout and description of exception as stderr."""
+        if self.poll() == 1:
+            if self.future.cancelled():
+                return b'', b'cancelled'
+            exc = self.future.exception()
+            return b'', ''.join(traceback.format_exception_only(type(exc), exc)).encode('utf-8')
+        return b'', b''
+
+    def result(self):
+        """Returns value returned by the function."""
+        return self.future.result()
+
+    def exception(self):
+        """Returns exception raised by the function, None if there was none."""
+        if self.future.cancelled():
+            return None
+        return self.future.exception()
+
+    def kill(self):
+        if not self.future.cancel() and self.stop is not None:
+            self.stop()
+
+
+class ChainedProc:
+    """Process started with result of function running in pool of workers.
+
+    Lets blocking preparation of the process (e.g. reading of playlist) run
+    outside of the main loop. Looks like process to 'ProcScheduler'; return
+    code is 1 when the function or 'start' fails.
+    """
+    def __init__(self, future, start):
+        """
+        Args:
+            future (Future): The running function.
+            start (callable): Takes result of the function, starts and returns the process.
+        """
+        self.future = future
+        self.start = start
+        self.proc = None
+        self.returncode = None
+        self._error = b''
+
+    @property
+    def fileinfo(self):
+        return getattr(self.proc, 'fileinfo', None)
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.proc is None:
+            if not self.future.done():
+                return None
+            try:
+                self.proc = self.start(self.future.result())
+            # pylint: disable=broad-except
+            except Exception as exc:
+                self._error = ''.join(
+                    traceback.format_exception_only(type(exc), exc)).encode('utf-8')
+                self.returncode = 1
+                return self.returncode
+        self.returncode = self.proc.poll()
+        return self.returncode
+
+    def communicate(self):
+        if self.proc is None:
+            return b'', self._error
+        return self.proc.communicate()
+
+    def kill(self):
+        if self.proc is not None:
+            kill_proc(self.proc)
+        elif self.returncode is None:
+            # the process is never started
+            self.future.cancel()
+            self.returncode = -signal.SIGKILL
+
+
+def kill_proc(proc) -> bool:
+    """Kills the process together with its children.
+
+    Processes are started in new session, so the whole process group is
+    killed. Returns False when the process can't be killed (function running
+    in a pool of workers that can't be stopped).
+    """
+    if isinstance(proc, FutureProc):
+        if proc.stop is None and not proc.future.cancel():
+            return False
+        proc.kill()
+        return True
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        proc.kill()
+    return True
+
+
+class Watchdog:
+    """Finds jobs of 'ProcScheduler' that are stalled or run for too long.
+
+    Job is stalled when its progress (e.g. size of the output file) didn't
+    change for 'stall_timeout' seconds. Job runs for too long when it runs
+    for more than 'timeout' seconds plus its expected size divided by
+    'min_rate'. Zero turns the check off.
+    """
+
+    def __init__(self, stall_timeout: float = 0, timeout: float = 0, min_rate: int = 0,
+                 clock=time.monotonic):
+        self.stall_timeout = stall_timeout
+        self.timeout = timeout
+        self.min_rate = min_rate
+        self.clock = clock
+        # start, last progress and time of last change of progress, by process
+        self._jobs = {}
+
+    @classmethod
+    def from_config(cls, section):
+        """Creates watchdog from stage config section, returns None if it's turned off."""
+        stall_timeout = float(getattr(section, 'stall_timeout', '') or 0)
+        timeout = float(getattr(section, 'timeout', '') or 0)
+        if not (stall_timeout or timeout):
+            return None
+        return cls(stall_timeout, timeout, utils.parse_size(getattr(section, 'min_rate', '0')))
+
+    def check(self, procinfo: mappings.Procinfo, progress: int = None,
+              expected_size: int = None) -> str:
+        """Returns 'stalled' or 'timeout' if the job should be killed, empty string otherwise."""
+        now = self.clock()
+        job = self._jobs.setdefault(id(procinfo.proc), [now, progress, now])
+        if progress != job[1]:
+            job[1] = progress
+            job[2] = now
+        if self.stall_timeout and progress is not None and now - job[2] > self.stall_timeout:
+            return 'stalled'
+        if self.timeout:
+            limit = self.timeout
+            if expected_size and self.min_rate:
+                limit += expected_size / self.min_rate
+            if now - job[0] > limit:
+                return 'timeout'
+        return ''
+
+    def forget(self, procinfo: mappings.Procinfo):
+        self._jobs.pop(id(procinfo.proc), None)
+
+
 class ProcScheduler:
     """Runs processes in parallel via schedulable object.
 
     Callable object for work pipeline.
     """
     def __init__(self, schedulable_obj, avail_slots=3):
-        """The schedulable_obj has 'spawn' and 'finished_handler' methods and 'to_do' stack."""
+        """The schedulable_obj has 'spawn' and 'finished_handler' methods and 'to_do' stack.
+
+        Optional 'can_spawn' method of the schedulable_obj can postpone spawning
+        of new processes (e.g. because of bandwidth limits).
+
+        When 'watchdog' is set, processes that are stalled are killed and
+        finished as usual, with the reason in the 'watchdog' attribute of the
+        process. Optional 'progress' and 'expected_size' methods of the
+        schedulable_obj tell the watchdog how the process is doing.
+        """
         self.avail_slots = avail_slots
+        self.max_slots = avail_slots
+        self.paused = False
         self.running_procs = []
         self.obj = schedulable_obj
+        # name of the stage in trace
+        self.name = type(schedulable_obj).__name__
         self.to_do = self.obj.to_do
         self.spawn_callback = self.obj.spawn
         self.finish_callback = self.obj.finished_handler
+        self.can_spawn_callback = getattr(self.obj, 'can_spawn', None)
+        self.watchdog = None
+        self.progress_callback = getattr(self.obj, 'progress', None)
+        self.expected_size_callback = getattr(self.obj, 'expected_size', None)
 
     def _spawn(self) -> bool:
         """Runs the 'spawn' method of the schedulable_obj.
 
         Runs it for every item in the 'to_do' stack.
         Runs up-to 'avail_slots' processes in parallel.
+        Stops early when the 'can_spawn' method of the schedulable_obj says so.
         """
-        len_todo = len(self.to_do)
-        while (self.avail_slots > 0) and (len_todo > 0):
-            procinfo = self.spawn_callback(self.to_do.pop())
-            len_todo -= 1
+        if self.paused:
+            return len(self.to_do) == 0
+
+        while (self.avail_slots > 0) and (len(self.to_do) > 0):
+            if self.can_spawn_callback is not None and not self.can_spawn_callback():
+                break
+            file_record = self.to_do.pop()
+            trace.job_dequeued(file_record, self.name)
+            with trace.job_span(file_record, 'spawn', self.name):
+                procinfo = self.spawn_callback(file_record)
             if procinfo is not None:
+                trace.job_started(file_record, self.name)
                 self.running_procs.append(procinfo)
                 self.avail_slots -= 1
+            else:
+                trace.job_queued(file_record)
 
         # return True if there is nothing left to do
-        return len_todo == 0
+        return len(self.to_do) == 0
 
     def _check_running_procs(self) -> bool:
         """Checks all running processes.
@@ -80,19 +279,71 @@ class ProcScheduler:
         Calls the 'finished_handler' method of the schedulable_obj
         on those that are finished.
         """
-        for procinfo in self.running_procs:
+        for procinfo in list(self.running_procs):
             retcode = procinfo.proc.poll()
-            if retcode is not None:
+            if retcode is None and self.watchdog is not None:
+                self._watch(procinfo)
+            elif retcode is not None:
+                if self.watchdog is not None:
+                    self.watchdog.forget(procinfo)
                 self.running_procs.remove(procinfo)
                 self.avail_slots += 1
-                self.finish_callback(procinfo)
+                trace.job_ended(procinfo.file_record, self.name)
+                with trace.job_span(procinfo.file_record, 'finish', self.name):
+                    retcode = self.finish_callback(procinfo)
+                if not retcode:
+                    # failed job is dropped or waits for retry, it's not in the next queue
+                    trace.job_queued(procinfo.file_record)
 
         # return True if all running processes are finished
         return len(self.running_procs) == 0
 
+    def _watch(self, procinfo: mappings.Procinfo):
+        """Kills the process when the watchdog says so."""
+        if getattr(procinfo.proc, 'watchdog', ''):
+            # already killed, waiting for it to exit
+            return
+        progress = self.progress_callback(procinfo) if self.progress_callback else None
+        expected_size = (self.expected_size_callback(procinfo)
+                         if self.expected_size_callback else None)
+        reason = self.watchdog.check(procinfo, progress, expected_size)
+        if reason and kill_proc(procinfo.proc):
+            procinfo.proc.watchdog = reason
+
+    def set_slots(self, num: int):
+        """Changes number of processes that can run in parallel.
+
+        Running processes are not affected when the number is decreased,
+        no new processes are spawned until enough of them finish.
+        """
+        self.avail_slots += num - self.max_slots
+        self.max_slots = num
+
     def __call__(self) -> bool:
         """Returns True if there's nothing to do at the moment."""
-        return all((self._spawn(), self._check_running_procs()))
+        done = all((self._spawn(), self._check_running_procs()))
+        if trace.enabled():
+            trace.counter(self.name, running=len(self.running_procs), queued=len(self.to_do))
+        return done
+
+
+class Discard:
+    """Drops records that went through the whole pipeline.
+
+    Callable object for work pipeline. Optional 'done' is called with every
+    dropped record.
+    """
+    def __init__(self, to_do: list, done=None):
+        self.to_do = to_do
+        self.done = done
+
+    def __call__(self) -> bool:
+        for file_record in self.to_do:
+            trace.job_done(file_record)
+            if self.done is not None:
+                self.done(file_record)
+        del self.to_do[:]
+        return True
 
 
 class Work():
@@ -111,24 +362,39 @@ class Work():
         self.pipeline.append(action)
 
 
-def do_the_work(work, msg_handler):
-    """The main thing. Loop until all work is done."""
+def do_the_work(work, msg_handler, controller=None):
+    """The main thing. Loop until all work is done.
+
+    Optional 'controller' (see 'control.Controller') applies configuration
+    changes and ends the loop early when the work is drained.
+    """
     with CleanExit(work):
         # loop until there's no work left to do
         done = False
         while not done:
+            if controller is not None:
+                controller.check()
             done = True
             for task in work:
-                if not task():
-                    done = False
+                with trace.span(type(getattr(task, 'obj', task)).__name__, 'main loop'):
+                    if not task():
+                        done = False
 
             # print messages produced during this iterration
             msg_handler()
-            time.sleep(0.5)
+            if controller is not None and controller.drained():
+                controller.save_state()
+                break
+            with trace.span('sleep', 'main loop'):
+                time.sleep(LOOP_DELAY)
+
 
+def check_required_tools(work, cache_file: str = ''):
+    """Checks if it's possible to run all required tools.
 
-def check_required_tools(work):
-    """Checks if it's possible to run all required tools."""
+    Versions of the tools are logged, they are probed only when the tools
+    change (see 'tools.ToolCache').
+    """
     all_required_tools = set()
     for task in work:
         if hasattr(task, 'required_tools'):
@@ -136,15 +402,12 @@ def check_required_tools(work):
         elif hasattr(task, 'obj') and hasattr(task.obj, 'required_tools'):
             all_required_tools.update(task.obj.required_tools)
 
-    all_available = True
-    for tool in all_required_tools:
-        try:
-            with open(os.devnull, 'w') as devnull:
-                Popen([tool], stdout=devnull, stderr=devnull)
-        except OSError as emsg:
-            print("Cannot {} the '{}' command".format(
-                'find' if emsg.errno == os.errno.ENOENT else 'run', tool), file=sys.stderr)
-            all_available = False
-
-    if not all_available:
+    found, missing = tools.find_tools(sorted(all_required_tools), cache_file)
+    for command, info in sorted(found.items()):
+        log.logit('[tools] {} {}'.format(info['path'], info.get('version', '')).rstrip(),
+                  tool=command)
+    for command in missing:
+        print("Cannot find the '{}' command".format(command), file=sys.stderr)
+
+    if missing:
         sys.exit(mappings.ExitCodes.CONFIG)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Planning of downloads - longest job first.
+
+The input is planned in windows of limited size, so it doesn't have to be
+read at once and lazily loaded queues stay lazy.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import time
+
+from replay_downloader import config, hls, log, mappings, record, session, utils
+
+
+class History:
+    """Download times and media durations of recordings from earlier runs."""
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self.entries = {}
+        try:
+            with open(self.path) as ifl:
+                self.entries = json.load(ifl)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, name: str) -> float:
+        """Returns download time of the recording, None if not known."""
+        return self.entries.get(name, {}).get('duration')
+
+    def update(self, name: str, duration: float = None, media: float = None,
+               size: int = None):
+        entry = self.entries.setdefault(name, {})
+        if duration is not None:
+            old = entry.get('duration')
+            # smooth out the variations between runs
+            entry['duration'] = duration if old is None else (old + duration) / 2
+        if media is not None:
+            entry['media'] = media
+        if size is not None:
+            entry['size'] = size
+
+    def speed_ratio(self) -> float:
+        """Returns download time per second of media, None if not known."""
+        downloaded = [(entry['duration'], entry['media']) for entry in self.entries.values()
+                      if entry.get('duration') and entry.get('media')]
+        if not downloaded:
+            return None
+        return sum(d for d, _ in downloaded) / sum(m for _, m in downloaded)
+
+    def byte_ratio(self) -> float:
+        """Returns download time per byte, None if not known."""
+        downloaded = [(entry['duration'], entry['size']) for entry in self.entries.values()
+                      if entry.get('duration') and entry.get('size')]
+        if not downloaded:
+            return None
+        return sum(d for d, _ in downloaded) / sum(s for _, s in downloaded)
+
+    def save(self):
+        hist_dir = os.path.dirname(self.path)
+        if hist_dir:
+            os.makedirs(hist_dir, exist_ok=True)
+        with open(self.path, 'w') as ofl:
+            json.dump(self.entries, ofl)
+
+
+def predict_makespan(durations: list, slots: int) -> float:
+    """Predicts total time of running jobs in 'slots' parallel slots.
+
+    The jobs are started in the order given by 'durations'.
+    """
+    if not durations:
+        return 0.0
+    ends = [0.0] * max(1, slots)
+    for duration in durations:
+        heapq.heappush(ends, heapq.heappop(ends) + duration)
+    return max(ends)
+
+
+class Planner:
+    """Orders the downloads longest-first to minimise total time.
+
+    Sizes of the downloads are estimated by probing the remote files
+    concurrently, or from the download times of earlier runs.
+    """
+
+    # download time per second of media when nothing else is known
+    default_speed_ratio = 0.1
+    # download time per byte when nothing else is known (1 MiB/s)
+    default_byte_ratio = 1 / (1024 * 1024)
+
+    def __init__(self, conf: config.Config, slots: int):
+        self.conf = conf
+        self.slots = slots
+        self.history = History(conf.PLANNER.history_file)
+        self.workers = int(conf.PLANNER.workers)
+        self.timeout = float(conf.PLANNER.probe_timeout)
+        self.window = int(conf.PLANNER.window)
+        self.predicted = None
+        self.started = None
+        self.last_finished = None
+        # estimated download times of planned records, in the planned order
+        self.durations = []
+        # True when all the input was planned
+        self.complete = False
+        self._known = []
+
+    def _probe_playlist(self, ses, url: str) -> float:
+        playlist = hls.Playlist(ses.get(url, timeout=self.timeout).text, url)
+        if playlist.is_master:
+            url = playlist.variants[0].url
+            playlist = hls.Playlist(ses.get(url, timeout=self.timeout).text, url)
+        return playlist.duration or None
+
+    def _probe_size(self, ses, url: str) -> int:
+        response = ses.head(url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        return int(response.headers.get('Content-Length', '')) or None
+
+    def probe(self, file_record: record.FileRecord) -> tuple:
+        """Returns duration of the media in seconds and size of the file in bytes.
+
+        Values that can't be found out are None.
+        """
+        fileinfo = file_record[0]
+        if fileinfo.type not in (mappings.Rtypes.HTTP, mappings.Rtypes.HTTPFILE):
+            return None, None
+        url = fileinfo.path
+        try:
+            ses = session.get_session(self.conf)
+            if fileinfo.type is mappings.Rtypes.HTTPFILE:
+                return None, self._probe_size(ses, url)
+            return self._probe_playlist(ses, url), None
+        # pylint: disable=broad-except
+        except Exception as emsg:
+            log.logit('[planner] probe of {} failed: {}'.format(url, emsg), 'error')
+            return None, None
+
+    def estimate(self, file_record: record.FileRecord, media: float,
+                 size: int = None) -> float:
+        """Returns estimated download time, None if not known."""
+        name = utils.recording_name(file_record[0].path)
+        known = self.history.get(name)
+        if known is not None:
+            return known
+        if media is not None:
+            self.history.update(name, media=media)
+            return media * (self.history.speed_ratio() or self.default_speed_ratio)
+        if size is not None:
+            self.history.update(name, size=size)
+            return size * (self.history.byte_ratio() or self.default_byte_ratio)
+        return None
+
+    def plan_window(self, records: list) -> list:
+        """Returns the records ordered as 'to_do' stack with the longest download on top."""
+        # needed only with '--plan', not worth importing at startup
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            probes = list(executor.map(self.probe, records))
+        estimates = [self.estimate(rec, media, size)
+                     for rec, (media, size) in zip(records, probes)]
+
+        # unknown download times are replaced by the median of known ones
+        self._known.extend(est for est in estimates if est is not None)
+        known = sorted(self._known)
+        default = known[len(known) // 2] if known else 0.0
+        estimates = [default if est is None else est for est in estimates]
+
+        planned = sorted(zip(estimates, range(len(records))), reverse=True)
+        self.durations.extend(est for est, _ in planned)
+        self.predicted = predict_makespan(self.durations, self.slots)
+        # the stack is processed from the end
+        return [records[num] for _, num in reversed(planned)]
+
+    def plan(self, records) -> 'PlannedQueue':
+        """Returns 'to_do' stack with the longest downloads on top."""
+        return PlannedQueue(self, records)
+
+    def start(self):
+        self.started = time.time()
+
+    def finished(self, file_record: record.FileRecord, retcode: int, duration: float):
+        """Records download time of successfully downloaded file."""
+        self.last_finished = time.time()
+        if retcode == 0:
+            self.history.update(utils.recording_name(file_record[0].path), duration=duration)
+
+    def actual(self) -> float:
+        """Returns actual time of all downloads, None if nothing was downloaded."""
+        if self.started is None or self.last_finished is None:
+            return None
+        return self.last_finished - self.started
+
+    def save(self):
+        try:
+            self.history.save()
+        except OSError as emsg:
+            log.logit('[planner] cannot save history: {}'.format(emsg), 'error')
+
+
+class PlannedQueue:
+    """The 'to_do' stack planned by the planner window by window.
+
+    Next window of records is taken from the source and planned when all the
+    records of the previous one were started. Records added by 'append'
+    (e.g. returned for retry) are processed first. Methods of the source
+    queue ('done', 'flush', 'spool') are available as well.
+    """
+
+    def __init__(self, plan: Planner, records):
+        self.plan = plan
+        self.source = records
+        self.records = iter(records)
+        self.pending = []
+        # the first window is planned right away, so the prediction is known
+        self._load()
+
+    def _load(self) -> bool:
+        if not self.pending and not self.plan.complete:
+            window = list(itertools.islice(self.records, max(1, self.plan.window)))
+            if len(window) < max(1, self.plan.window):
+                self.plan.complete = True
+            if window:
+                self.pending = self.plan.plan_window(window)
+        return bool(self.pending)
+
+    @property
+    def spool(self):
+        return getattr(self.source, 'spool', None)
+
+    def done(self, file_record):
+        done = getattr(self.source, 'done', None)
+        if done is not None:
+            done(file_record)
+
+    def flush(self):
+        flush = getattr(self.source, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def __len__(self):
+        """Returns number of planned records, it's zero only when the queue is exhausted."""
+        self._load()
+        return len(self.pending)
+
+    def __iter__(self):
+        while self._load():
+            yield self.pending.pop()
+
+    def __getitem__(self, index):
+        """Returns planned record, [-1] is the one returned by next 'pop'."""
+        self._load()
+        return self.pending[index]
+
+    def append(self, file_record):
+        self.pending.append(file_record)
+
+    def pop(self):
+        if not self._load():
+            raise IndexError('pop from empty queue')
+        return self.pending.pop()
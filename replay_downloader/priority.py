@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+CPU and IO priority of spawned processes.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+
+from replay_downloader import config
+
+
+# IO scheduling classes, see ioprio_set(2)
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# number of the ioprio_set syscall on different architectures
+_IOPRIO_SET_SYSCALL = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+}
+
+_LIBC = None
+
+
+def _get_libc():
+    """Loads C library. Must be done in parent process, before fork."""
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _LIBC
+
+
+def _ioprio_set(ioprio: int):
+    """Sets IO priority of the current process. Does nothing when not supported."""
+    syscall_num = _IOPRIO_SET_SYSCALL.get(platform.machine())
+    if syscall_num is None:
+        return
+    _get_libc().syscall(syscall_num, IOPRIO_WHO_PROCESS, 0, ioprio)
+
+
+def parse_cpu_list(cpu_list: str) -> set:
+    """Converts CPU list like '0-3,6' to set of CPU numbers."""
+    cpus = set()
+    for item in cpu_list.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            if '-' in item:
+                first, last = item.split('-')
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(item))
+        except ValueError:
+            raise ValueError("invalid CPU list '{}'".format(cpu_list))
+    return cpus
+
+
+class Priority:
+    """CPU and IO priority and CPU affinity for processes of one stage."""
+
+    def __init__(self, nice: int = 0, ioclass: str = '', iolevel: int = None,
+                 affinity: set = None, background: bool = False):
+        """
+        Args:
+            nice (int): Niceness increment.
+            ioclass (str): IO scheduling class ('realtime', 'best-effort' or 'idle').
+            iolevel (int): Priority inside the IO scheduling class (0-7).
+            affinity (set): CPUs the process can run on.
+            background (bool): Lowest CPU priority and idle IO class.
+        """
+        if ioclass and ioclass not in IOPRIO_CLASSES:
+            raise ValueError("unknown IO scheduling class '{}'".format(ioclass))
+        if background:
+            nice = 19
+            ioclass = 'idle'
+            iolevel = None
+        self.nice = nice
+        self.ioclass = ioclass
+        self.iolevel = iolevel
+        self.affinity = affinity
+
+    @classmethod
+    def from_config(cls, conf: config.Config, section: str):
+        """Creates priority settings according to config section (e.g. 'DOWNLOAD')."""
+        opts = getattr(conf, section)
+        return cls(nice=int(opts.nice or 0),
+                   ioclass=opts.ionice_class,
+                   iolevel=int(opts.ionice_level) if opts.ionice_level else None,
+                   affinity=parse_cpu_list(opts.cpu_affinity) or None,
+                   background=opts.background.lower() in ('yes', 'true', 'on', '1'))
+
+    def ioprio(self) -> int:
+        """Returns IO priority value for the ioprio_set syscall, 0 if not set."""
+        if not self.ioclass:
+            return 0
+        # the level doesn't matter for idle class
+        level = self.iolevel if self.iolevel is not None else 4
+        return (IOPRIO_CLASSES[self.ioclass] << IOPRIO_CLASS_SHIFT) | level
+
+    def apply(self):
+        """Applies the settings to the current process.
+
+        Runs in the child process between fork and exec.
+        """
+        if self.nice:
+            os.nice(self.nice)
+        if self.affinity:
+            os.sched_setaffinity(0, self.affinity)
+        ioprio = self.ioprio()
+        if ioprio:
+            _ioprio_set(ioprio)
+
+    def popen_kwargs(self) -> dict:
+        """Returns keyword arguments for 'Popen'.
+
+        Every process runs in its own session (and process group), so it can
+        be terminated together with all its children.
+        """
+        kwargs = {'start_new_session': True}
+        if self.ioclass:
+            _get_libc()
+        if self.nice or self.affinity or self.ioclass:
+            kwargs['preexec_fn'] = self.apply
+        return kwargs
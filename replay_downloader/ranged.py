@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Downloading files over HTTP in parallel byte ranges.
+"""
+
+import json
+import os
+import threading
+
+from replay_downloader import log
+
+
+# completed ranges of unfinished download are saved to 'file.part' + RANGES_EXT
+RANGES_EXT = '.ranges'
+
+# size of chunks read from the network
+READ_SIZE = 64 * 1024
+
+
+class RangeIgnored(Exception):
+    """The server sent the whole file instead of requested range."""
+
+
+class Stopped(Exception):
+    """The download was stopped."""
+
+
+def split_ranges(size: int, range_size: int) -> list:
+    """Returns list of (first byte, last byte) ranges covering 'size' bytes."""
+    return [(start, min(start + range_size, size) - 1)
+            for start in range(0, size, range_size)]
+
+
+def _preallocate(fdesc: int, size: int):
+    try:
+        os.posix_fallocate(fdesc, 0, size)
+    except (AttributeError, OSError):
+        # not supported by the platform or by the file system
+        os.ftruncate(fdesc, size)
+
+
+class RangedDownload:
+    """Downloads file to 'part_path' using several connections.
+
+    The file is preallocated and every range is written at its offset by
+    'os.pwrite'. Completed ranges are recorded, so unfinished download is
+    resumed. When the server doesn't support ranges, the file is downloaded
+    as single stream.
+    """
+
+    def __init__(self, ses, url: str, part_path: str, connections: int = 4,
+                 range_size: int = 4 * 1024 * 1024, bucket=None, timeout: float = 30):
+        """
+        Args:
+            ses (requests.Session): Session used for all requests.
+            url (str): URL of the file.
+            part_path (str): Where the file is written.
+            connections (int): Number of ranges downloaded in parallel.
+            range_size (int): Size of one range in bytes.
+            bucket (TokenBucket): Bandwidth limit of the download.
+            timeout (float): Timeout of network operations in seconds.
+        """
+        self.ses = ses
+        self.url = url
+        self.part_path = part_path
+        self.state_path = part_path + RANGES_EXT
+        self.connections = max(connections, 1)
+        self.range_size = range_size
+        self.bucket = bucket
+        self.timeout = timeout
+        self.size = None
+        # bytes downloaded so far by this process
+        self.transferred = 0
+        # first bytes of completed ranges
+        self.done = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Asks the download to stop, it fails with 'Stopped'."""
+        self._stop.set()
+
+    def _received(self, data: bytes):
+        if self._stop.is_set():
+            raise Stopped('download of {} stopped'.format(self.url))
+        if self.bucket is not None:
+            self.bucket.consume(len(data))
+        with self._lock:
+            self.transferred += len(data)
+
+    def _load_state(self):
+        """Loads completed ranges of previous attempt to download the same file."""
+        try:
+            with open(self.state_path) as ifl:
+                state = json.load(ifl)
+        except (EnvironmentError, ValueError):
+            return
+        # the ranges are known by their first bytes, they must have the same size
+        if state.get('url') == self.url and state.get('size') == self.size and \
+                state.get('range_size') == self.range_size and \
+                os.path.isfile(self.part_path):
+            self.done = set(state.get('done', []))
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as ofl:
+            json.dump({'url': self.url, 'size': self.size, 'range_size': self.range_size,
+                       'done': sorted(self.done)}, ofl)
+        os.replace(tmp_path, self.state_path)
+
+    def _remove_state(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def _probe(self) -> bool:
+        """Finds out size of the file, returns True if ranges can be used."""
+        response = self.ses.head(self.url, allow_redirects=True, timeout=self.timeout)
+        if response.status_code >= 400:
+            return False
+        if response.url:
+            self.url = response.url
+        try:
+            self.size = int(response.headers.get('Content-Length', ''))
+        except ValueError:
+            return False
+        return 'bytes' in response.headers.get('Accept-Ranges', '') and \
+            self.size > self.range_size
+
+    def _fetch_range(self, fdesc: int, start: int, end: int):
+        if self._stop.is_set():
+            raise Stopped('download of {} stopped'.format(self.url))
+        try:
+            self._fetch_range_data(fdesc, start, end)
+        except BaseException:
+            # the first failure stops the other ranges
+            self.stop()
+            raise
+
+    def _fetch_range_data(self, fdesc: int, start: int, end: int):
+        response = self.ses.get(self.url, headers={'Range': 'bytes={}-{}'.format(start, end)},
+                                stream=True, timeout=self.timeout)
+        with response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RangeIgnored('server ignored range request for {}'.format(self.url))
+            offset = start
+            for data in response.iter_content(READ_SIZE):
+                self._received(data)
+                os.pwrite(fdesc, data, offset)
+                offset += len(data)
+        if offset != end + 1:
+            raise EnvironmentError('incomplete range {}-{} of {}'.format(start, end, self.url))
+        with self._lock:
+            self.done.add(start)
+            self._save_state()
+
+    def _download_ranges(self):
+        # the module is imported at startup, the pool is needed only here
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+
+        self._load_state()
+        to_fetch = [rng for rng in split_ranges(self.size, self.range_size)
+                    if rng[0] not in self.done]
+        fdesc = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            _preallocate(fdesc, self.size)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.connections) as executor:
+                futures = [executor.submit(self._fetch_range, fdesc, start, end)
+                           for start, end in to_fetch]
+                try:
+                    done = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_EXCEPTION)[0]
+                    errors = [future.exception() for future in done
+                              if future.exception() is not None]
+                    if errors:
+                        # the other ranges may fail just because they were stopped
+                        raise next((error for error in errors
+                                    if not isinstance(error, Stopped)), errors[0])
+                except BaseException:
+                    # don't wait for the other ranges, the running ones stop
+                    # at their next chunk and the pending ones don't start
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fdesc)
+
+    def _download_stream(self):
+        response = self.ses.get(self.url, stream=True, timeout=self.timeout)
+        with response, open(self.part_path, 'wb') as ofl:
+            response.raise_for_status()
+            for data in response.iter_content(READ_SIZE):
+                self._received(data)
+                ofl.write(data)
+
+    def run(self) -> int:
+        """Downloads the file, returns its size."""
+        if self._probe():
+            try:
+                self._download_ranges()
+                self._remove_state()
+                return self.size
+            except RangeIgnored as emsg:
+                log.logit('[download] {}, downloading as single stream'.format(emsg),
+                          file=self.part_path)
+                self._stop.clear()
+                self.done = set()
+                self._remove_state()
+        self._download_stream()
+        return os.path.getsize(self.part_path)
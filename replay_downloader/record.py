@@ -3,13 +3,28 @@
 Records history of transformations.
 """
 
+import itertools
+import time
+
 from replay_downloader import mappings
 
 
+# source of unique job ids
+_IDS = itertools.count(1)
+
+
 class FileRecord:
-    """Records complete history of file transformations."""
+    """Records complete history of file transformations.
+
+    Each record has unique 'id' and 'tstamp' - time when the last
+    transformation was recorded.
+    """
+    __slots__ = ('rec', 'id', 'tstamp')
+
     def __init__(self, file_info: mappings.Fileinfo):
         self.rec = [file_info]
+        self.id = next(_IDS)
+        self.tstamp = time.time()
 
     def __str__(self):
         return str(self.rec)
@@ -21,7 +36,18 @@ class FileRecord:
         return self.rec[position]
 
     def add(self, file_info: mappings.Fileinfo):
+        # pylint: disable=protected-access
+        # share the file name with previous record (usually the same, only the
+        # directory and extension differ)
+        last = self.rec[-1] if self.rec else None
+        if last is not None and file_info._stem == last._stem:
+            file_info._stem = last._stem
         self.rec.append(file_info)
+        self.tstamp = time.time()
+
+    def replace(self, file_info: mappings.Fileinfo, position: int = -1):
+        """Replaces the entry (the last one by default), keeps time of the transformation."""
+        self.rec[position] = file_info
 
     def delete(self):
         try:
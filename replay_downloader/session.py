@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP session with persistent login.
+"""
+
+import os
+import re
+import threading
+import time
+
+from replay_downloader import config, log
+
+
+# the session shared by everything in this process
+_SESSION = None
+_LOCK = threading.Lock()
+
+# matches password field of the login form
+_LOGIN_FORM_RE = re.compile(r'<input[^>]*name=["\']?password', re.IGNORECASE)
+
+
+def get_session(conf: config.Config) -> 'requests.Session':
+    """Returns the shared session, creates it on first use.
+
+    Cookies are loaded from the cookie file unless they are too old.
+    """
+    global _SESSION
+    with _LOCK:
+        if _SESSION is not None:
+            return _SESSION
+
+        # slow to import and not needed when nothing is downloaded over HTTP
+        # pylint: disable=import-outside-toplevel
+        import http.cookiejar
+        import requests
+
+        ses = requests.Session()
+        pool_size = int(conf.HTTP.pool_size)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        ses.mount('http://', adapter)
+        ses.mount('https://', adapter)
+
+        cookie_file = os.path.expanduser(conf.AUTH.cookie_file)
+        ses.cookies = http.cookiejar.LWPCookieJar(cookie_file)
+        try:
+            if time.time() - os.path.getmtime(cookie_file) < int(conf.AUTH.cookie_max_age):
+                ses.cookies.load(ignore_discard=True)
+        except (OSError, http.cookiejar.LoadError):
+            pass
+
+        _SESSION = ses
+        return ses
+
+
+def close_session():
+    """Closes the shared session."""
+    global _SESSION
+    with _LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = None
+
+
+def save_cookies(ses: 'requests.Session'):
+    """Stores session cookies on disk."""
+    cookie_file = ses.cookies.filename
+    try:
+        cookie_dir = os.path.dirname(cookie_file)
+        if cookie_dir:
+            os.makedirs(cookie_dir, exist_ok=True)
+        ses.cookies.save(ignore_discard=True)
+        os.chmod(cookie_file, 0o600)
+    except OSError as emsg:
+        log.logit('[session] cannot save cookies: {}'.format(emsg), 'error')
+
+
+def needs_login(response: 'requests.Response', login_url: str) -> bool:
+    """Checks if the response is redirect to login page or login form."""
+    if response.history and response.url.split('?')[0] == login_url.split('?')[0]:
+        return True
+    return bool(_LOGIN_FORM_RE.search(response.text))
+
+
+def login(ses: 'requests.Session', conf: config.Config, login_url: str):
+    """Logs in and stores the cookies."""
+    if not (conf.AUTH.login and conf.AUTH.password):
+        raise ValueError('Login or password are not configured')
+
+    payload = {
+        'login': conf.AUTH.login,
+        'password': conf.AUTH.password
+    }
+    ses.post(login_url, data=payload)
+    log.logit('[session] logged in at {}'.format(login_url))
+    save_cookies(ses)
+
+
+def get_page(conf: config.Config, url: str, login_url: str) -> 'requests.Response':
+    """Gets page that requires login.
+
+    Logs in only when the cached cookies are not valid anymore.
+    """
+    ses = get_session(conf)
+    response = ses.get(url)
+    if needs_login(response, login_url):
+        login(ses, conf, login_url)
+        response = ses.get(url)
+    return response
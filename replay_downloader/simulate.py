@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Simulation of the download and extract pipeline.
+
+The real 'ProcScheduler' and 'Work' run with simulated processes and
+virtual clock, so different settings can be compared in seconds.
+"""
+
+import abc
+import collections
+import json
+import random
+
+from replay_downloader import mappings, perform, record
+
+
+# size of downloaded file in bytes, download and extract time in seconds;
+# download time is computed from the size when it's None
+Job = collections.namedtuple('Job', 'name size download extract')
+
+# outcome of one simulation run
+SimResult = collections.namedtuple(
+    'SimResult', 'download_slots extract_slots makespan download_util extract_util peak_disk')
+
+
+class VirtualClock:
+    """Simulated time."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.running = []
+        # number of started and finished processes
+        self.changes = 0
+
+    def next_event(self) -> float:
+        """Returns time when next simulated process finishes, None if nothing runs."""
+        self.running = [proc for proc in self.running if proc.returncode is None]
+        if not self.running:
+            return None
+        return min(proc.end for proc in self.running)
+
+
+class SimProc:
+    """Simulated process, has the subset of 'Popen' interface used by the pipeline."""
+
+    def __init__(self, clock: VirtualClock, duration: float):
+        self.clock = clock
+        self.start = clock.now
+        self.end = clock.now + duration
+        self.returncode = None
+        clock.running.append(self)
+        clock.changes += 1
+
+    def poll(self):
+        if self.returncode is None and self.clock.now >= self.end:
+            self.returncode = 0
+            self.clock.changes += 1
+        return self.returncode
+
+    def communicate(self):
+        return b'', b''
+
+    def kill(self):
+        self.returncode = -9
+
+
+class Model:
+    """Network and disk model shared by the simulated stages."""
+
+    def __init__(self, clock: VirtualClock, bandwidth: float, job_bandwidth: float = 0,
+                 extract_rate: float = 0):
+        """
+        Args:
+            bandwidth (float): Total bandwidth in bytes per second.
+            job_bandwidth (float): Maximal bandwidth of single download, 0 means unlimited.
+            extract_rate (float): Bytes per second processed by audio extracting.
+        """
+        self.clock = clock
+        self.bandwidth = bandwidth
+        self.job_bandwidth = job_bandwidth
+        self.extract_rate = extract_rate
+        # jobs by id of file record
+        self.jobs = {}
+        self.downloading = 0
+        self.disk = 0
+        self.peak_disk = 0
+        self.busy = collections.Counter()
+
+    def disk_add(self, size: int):
+        self.disk += size
+        self.peak_disk = max(self.peak_disk, self.disk)
+
+
+class SimStage(abc.ABC):
+    """Simulated schedulable object for 'ProcScheduler'."""
+
+    def __init__(self, name: str, model: Model, to_do: list):
+        self.name = name
+        self.model = model
+        self.to_do = to_do
+        self.finished_ready = []
+
+    @abc.abstractmethod
+    def duration(self, job: Job) -> float:
+        """Returns how long the stage runs the job, in seconds."""
+
+    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
+        job = self.model.jobs[file_record.id]
+        duration = self.duration(job)
+        self.model.busy[self.name] += duration
+        file_record.add(mappings.Fileinfo(job.name, None, self.name))
+        return mappings.Procinfo(SimProc(self.model.clock, duration), file_record)
+
+    def finished_handler(self, procinfo: mappings.Procinfo) -> int:
+        self.finished_ready.append(procinfo.file_record)
+        return 0
+
+
+class SimDownload(SimStage):
+    def duration(self, job: Job) -> float:
+        if job.download is not None:
+            return job.download
+        # bandwidth is shared with downloads running at the time of spawn
+        rate = self.model.bandwidth / (self.model.downloading + 1)
+        if self.model.job_bandwidth:
+            rate = min(rate, self.model.job_bandwidth)
+        return job.size / rate
+
+    def spawn(self, file_record: record.FileRecord) -> mappings.Procinfo:
+        self.model.disk_add(self.model.jobs[file_record.id].size)
+        procinfo = super().spawn(file_record)
+        self.model.downloading += 1
+        return procinfo
+
+    def finished_handler(self, procinfo: mappings.Procinfo) -> int:
+        self.model.downloading -= 1
+        return super().finished_handler(procinfo)
+
+
+class SimExtract(SimStage):
+    def duration(self, job: Job) -> float:
+        if job.extract is not None:
+            return job.extract
+        return job.size / self.model.extract_rate if self.model.extract_rate else 0.0
+
+    def finished_handler(self, procinfo: mappings.Procinfo) -> int:
+        # intermediate file is deleted by cleanup
+        self.model.disk -= self.model.jobs[procinfo.file_record.id].size
+        return super().finished_handler(procinfo)
+
+
+def simulate(jobs: list, download_slots: int, extract_slots: int, bandwidth: float,
+             job_bandwidth: float = 0, extract_rate: float = 0,
+             tick: float = perform.LOOP_DELAY) -> SimResult:
+    """Runs simulation of the whole pipeline.
+
+    The main loop is repeated while anything changes, then the clock jumps
+    to the time when next process finishes, but at least by 'tick'.
+    """
+    if download_slots < 1 or extract_slots < 1:
+        raise ValueError('concurrency must be at least 1, got {} and {}'.format(
+            download_slots, extract_slots))
+    clock = VirtualClock()
+    model = Model(clock, bandwidth, job_bandwidth, extract_rate)
+    # the stack is processed from the end
+    to_do = []
+    for job in reversed(jobs):
+        file_record = record.FileRecord(mappings.Fileinfo(job.name, None))
+        model.jobs[file_record.id] = job
+        to_do.append(file_record)
+
+    work = perform.Work()
+    downloads = SimDownload('download', model, to_do)
+    work.add(perform.ProcScheduler(downloads, download_slots))
+    extracting = SimExtract('extract', model, downloads.finished_ready)
+    work.add(perform.ProcScheduler(extracting, extract_slots))
+    work.add(perform.Discard(extracting.finished_ready))
+
+    while True:
+        changes = clock.changes
+        done = True
+        for task in work:
+            if not task():
+                done = False
+        if done:
+            break
+        if clock.changes != changes:
+            continue
+        next_event = clock.next_event()
+        clock.now = max(clock.now + tick, next_event if next_event is not None else 0)
+
+    makespan = clock.now
+    return SimResult(download_slots, extract_slots, makespan,
+                     model.busy['download'] / (download_slots * makespan) if makespan else 0,
+                     model.busy['extract'] / (extract_slots * makespan) if makespan else 0,
+                     model.peak_disk)
+
+
+def synthetic_jobs(num: int, mean_size: float, extract_rate: float = 0, seed: int = 0) -> list:
+    """Generates jobs with log-normally distributed sizes."""
+    rand = random.Random(seed)
+    jobs = []
+    for i in range(num):
+        # mean of the lognormvariate(0, 0.8) is exp(0.32) ~ 1.377
+        size = int(mean_size * rand.lognormvariate(0, 0.8) / 1.377)
+        jobs.append(Job('job{}'.format(i), size, None,
+                        size / extract_rate if extract_rate else None))
+    return jobs
+
+
+def jobs_from_log(logfile: str) -> list:
+    """Reads sizes and download and extract times of jobs from JSON log of previous run."""
+    times = collections.OrderedDict()
+    with open(logfile) as ifl:
+        for line in ifl:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'retcode' not in entry or entry.get('retcode') != 0:
+                continue
+            job = times.setdefault(entry.get('job'), {})
+            job[entry.get('stage')] = entry.get('duration', 0.0)
+            if entry.get('stage') == 'download':
+                job['file'] = entry.get('file')
+                job['size'] = entry.get('size', 0)
+
+    return [Job(str(job['file']), job['size'], job['download'], job.get('extract_audio', 0.0))
+            for job in times.values() if 'download' in job]
+
+
+def sweep(jobs: list, concurrencies: list, bandwidth: float, job_bandwidth: float = 0,
+          extract_rate: float = 0, extract_slots: list = None) -> list:
+    """Runs simulation for every combination of download and extract concurrency."""
+    invalid = [num for num in list(concurrencies) + list(extract_slots or []) if num < 1]
+    if invalid:
+        raise ValueError('concurrency must be at least 1, got {}'.format(invalid[0]))
+    results = []
+    for download_slots in concurrencies:
+        for ext_slots in (extract_slots or [download_slots]):
+            results.append(simulate(jobs, download_slots, ext_slots, bandwidth,
+                                    job_bandwidth, extract_rate))
+    return results
+
+
+def format_results(results: list) -> str:
+    lines = ['{:>9} {:>8} {:>12} {:>10} {:>10} {:>12}'.format(
+        'download', 'extract', 'makespan [s]', 'down util', 'ext util', 'peak disk')]
+    for res in results:
+        lines.append('{:>9} {:>8} {:>12.0f} {:>9.0f}% {:>9.0f}% {:>8.1f} MiB'.format(
+            res.download_slots, res.extract_slots, res.makespan, res.download_util * 100,
+            res.extract_util * 100, res.peak_disk / 1024 / 1024))
+    return '\n'.join(lines)
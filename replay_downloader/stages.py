@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline stages.
+
+Stage is a class with:
+- 'config_section' - name of config section with 'backend' and 'concurrency'
+  options of the stage,
+- 'backends' - supported execution backends, the first one is default,
+- 'create(conf, to_do, context)' - classmethod that creates the stage,
+- 'to_do' stack of file records and 'finished_ready' list for the next stage.
+
+Stage that handles several records by one process has 'records(procinfo)'
+method returning all of them.
+
+Stages scheduled by 'ProcScheduler' can have 'stall_timeout', 'timeout' and
+'min_rate' options in their config section to kill stalled processes
+(see 'perform.Watchdog').
+
+Execution backends:
+- 'inline' - the stage is callable object executed by the main loop,
+- 'subprocess' - the stage has 'spawn' and 'finished_handler' methods
+  and is scheduled by 'ProcScheduler',
+- 'thread' and 'process' - as 'subprocess', but the stage submits the work
+  to the pool of workers in its 'executor' attribute.
+
+Stages can be added by other packages via the 'replay_downloader.stages'
+entry point group.
+"""
+
+from replay_downloader import cleanup, config, download, extract_audio, perform
+
+
+ENTRY_POINT_GROUP = 'replay_downloader.stages'
+
+# built-in stages
+STAGES = {
+    'download': download.Download,
+    'extract_audio': extract_audio.ExtractAudio,
+    'cleanup': cleanup.Cleanup,
+}
+
+# pools of workers by backend, looked up when needed as the process pool is slow to import
+_EXECUTORS = {
+    'thread': 'ThreadPoolExecutor',
+    'process': 'ProcessPoolExecutor',
+}
+
+
+def _entry_points() -> list:
+    try:
+        from importlib import metadata
+    except ImportError:
+        return []
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=ENTRY_POINT_GROUP))
+    return list(entry_points.get(ENTRY_POINT_GROUP, []))
+
+
+def get_stage(name: str):
+    """Returns stage class registered under 'name'."""
+    if name in STAGES:
+        return STAGES[name]
+    for entry_point in _entry_points():
+        if entry_point.name == name:
+            return entry_point.load()
+    raise ValueError("unknown stage '{}'".format(name))
+
+
+def make_task(stage_obj, backend: str, slots: int):
+    """Returns task for work pipeline that runs the stage using the backend."""
+    if backend not in getattr(stage_obj, 'backends', ('subprocess', )):
+        raise ValueError("stage '{}' doesn't support '{}' backend".format(
+            type(stage_obj).__name__, backend))
+    if backend == 'inline':
+        return stage_obj
+    if backend in _EXECUTORS:
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+
+        stage_obj.executor = getattr(concurrent.futures, _EXECUTORS[backend])(max_workers=slots)
+    return perform.ProcScheduler(stage_obj, slots)
+
+
+def build_pipeline(conf: config.Config, stage_names: list, to_do, context: dict):
+    """Creates work pipeline.
+
+    When one stage of the pipeline is finished with processing one item
+    from it's stack, the outcome is passed to next stage.
+
+    Args:
+        conf (Config): Configuration.
+        stage_names (list): Names of the stages in order.
+        to_do: The 'to_do' stack of the first stage.
+        context (dict): Options for stages ('work_dir', 'destination'),
+            'concurrency' is the default number of parallel jobs,
+            'concurrency_override' (if set) is number of parallel jobs of every
+            stage that wins over the config file (e.g. set on command line).
+
+    Returns:
+        tuple: Work pipeline and dictionary of its tasks by stage name.
+    """
+    work = perform.Work()
+    tasks = {}
+    # e.g. 'TodoQueue' with spool file needs to know what is finished
+    done = getattr(to_do, 'done', None)
+    for name in stage_names:
+        stage_cls = get_stage(name)
+        section = getattr(conf, getattr(stage_cls, 'config_section', ''), None)
+        backend = getattr(section, 'backend', '') or stage_cls.backends[0]
+        slots = context.get('concurrency_override') or \
+            int(getattr(section, 'concurrency', '') or context['concurrency'])
+
+        stage_obj = stage_cls.create(conf, to_do, context)
+        task = make_task(stage_obj, backend, slots)
+        if isinstance(task, perform.ProcScheduler) and section is not None:
+            task.watchdog = perform.Watchdog.from_config(section)
+        work.add(task)
+        tasks[name] = task
+        to_do = stage_obj.finished_ready
+
+    # records that went through the whole pipeline are no longer needed
+    work.add(perform.Discard(to_do, done))
+    return work, tasks
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Downloads that are processed while they are being downloaded.
+"""
+
+import os
+import tempfile
+import threading
+
+from subprocess import DEVNULL, Popen, PIPE
+
+from replay_downloader import flv, mappings, perform
+
+
+class DemuxProc:
+    """Runs download command that writes FLV to stdout and extracts MP3 from it on the fly.
+
+    Looks like process to 'ProcScheduler'. When the audio is not MP3, the FLV
+    stream is saved to 'fallback.path' instead and 'fileinfo' is set to
+    'fallback', so the audio can be extracted by ffmpeg later.
+    """
+
+    def __init__(self, command: list, out_path: str, fallback: mappings.Fileinfo,
+                 popen_kwargs: dict = None):
+        """
+        Args:
+            command (list): Download command writing FLV to stdout.
+            out_path (str): Where the MP3 is written.
+            fallback (Fileinfo): Where the FLV is written when the audio is not MP3.
+            popen_kwargs (dict): Additional arguments for 'Popen'.
+        """
+        self.out_path = out_path
+        self.fallback = fallback
+        # file record entry of the outcome if it's different from the expected one
+        self.fileinfo = None
+        self.error = None
+        self.returncode = None
+        # stderr is not read until the end, it must not fill the pipe
+        self._stderr = tempfile.TemporaryFile()
+        self.proc = Popen(command, stdout=PIPE, stderr=self._stderr, bufsize=flv.READ_BUFFER,
+                          **(popen_kwargs or {}))
+        self.pid = self.proc.pid
+        self._thread = threading.Thread(target=self._demux, daemon=True)
+        self._thread.start()
+
+    def _open_fallback(self):
+        self.fileinfo = self.fallback
+        return open(self.fallback.path + mappings.PART_EXT, 'wb')
+
+    def _demux(self):
+        fallback_file = []
+        try:
+            with open(self.out_path, 'wb') as ofl:
+                flv.extract_mp3(self.proc.stdout,
+                                ofl, lambda: fallback_file.append(self._open_fallback()) or
+                                fallback_file[0])
+            if self.fileinfo is not None:
+                os.remove(self.out_path)
+        # pylint: disable=broad-except
+        except Exception as emsg:
+            self.error = emsg
+            # the download can't continue without reader
+            self.proc.kill()
+        finally:
+            for ofl in fallback_file:
+                ofl.close()
+            self.proc.stdout.close()
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        if self.proc.poll() is None or self._thread.is_alive():
+            return None
+        self.returncode = self.proc.returncode
+        if self.error is not None and self.returncode == 0:
+            self.returncode = 1
+        return self.returncode
+
+    def communicate(self):
+        """Waits until finished, returns empty stdout and stderr of the download command."""
+        self.proc.wait()
+        self._thread.join()
+        self._stderr.seek(0)
+        err = self._stderr.read()
+        self._stderr.close()
+        if self.error is not None:
+            err += '\nError extracting audio: {}\n'.format(self.error).encode('utf-8')
+        return b'', err
+
+    def kill(self):
+        self.proc.kill()
+
+
+class PipeProc:
+    """Runs download command that writes to stdout piped to extracting command.
+
+    Looks like one process to 'ProcScheduler'. It's successful only when both
+    commands are; when the extracting command fails, the download is killed
+    as nobody reads its output. The download failing is noticed by the
+    extracting command as end of input. Return codes of both commands are in
+    'returncodes' when finished, 'extract_failed' is True when the extracting
+    command failed on its own (e.g. it can't handle the audio codec).
+    """
+
+    def __init__(self, download_command: list, extract_command: list,
+                 popen_kwargs: dict = None):
+        """
+        Args:
+            download_command (list): Download command writing to stdout.
+            extract_command (list): Command reading stdin and writing the outcome.
+            popen_kwargs (dict): Additional arguments for 'Popen'.
+        """
+        self.returncode = None
+        self.returncodes = (None, None)
+        self.extract_failed = False
+        # stderr is not read until the end, it must not fill the pipe
+        self._stderr = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+        self.download = Popen(download_command, stdout=PIPE, stderr=self._stderr[0],
+                              bufsize=flv.READ_BUFFER, **(popen_kwargs or {}))
+        try:
+            self.extract = Popen(extract_command, stdin=self.download.stdout, stdout=DEVNULL,
+                                 stderr=self._stderr[1], **(popen_kwargs or {}))
+        except OSError:
+            perform.kill_proc(self.download)
+            self.download.wait()
+            raise
+        finally:
+            # only the extracting command reads the pipe
+            self.download.stdout.close()
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        download_rc = self.download.poll()
+        extract_rc = self.extract.poll()
+        if extract_rc not in (None, 0) and download_rc is None:
+            self.extract_failed = True
+            perform.kill_proc(self.download)
+            download_rc = self.download.wait()
+        if download_rc is None or extract_rc is None:
+            return None
+        if extract_rc != 0 and download_rc == 0:
+            self.extract_failed = True
+        self.returncodes = (download_rc, extract_rc)
+        # failed extracting wins, e.g. rtmpdump's "incomplete download" can be fine
+        self.returncode = extract_rc or download_rc
+        return self.returncode
+
+    def communicate(self):
+        """Waits until finished, returns empty stdout and stderr of both commands."""
+        self.download.wait()
+        self.extract.wait()
+        err = []
+        for errfile in self._stderr:
+            errfile.seek(0)
+            err.append(errfile.read())
+            errfile.close()
+        if err[1]:
+            err[1] = b'\nExtracting audio:\n' + err[1]
+        return b'', b''.join(err)
+
+    def kill(self):
+        for proc in (self.download, self.extract):
+            perform.kill_proc(proc)
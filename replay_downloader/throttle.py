@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Bandwidth limiting.
+"""
+
+import datetime
+import threading
+import time
+
+from replay_downloader import config, utils
+
+
+class FullSpeedSchedule:
+    """Time-of-day windows when bandwidth is not limited.
+
+    The windows are specified like '20:00-07:00, 12:00-13:00'.
+    Windows that span midnight are allowed.
+    """
+
+    def __init__(self, spec: str = '', now=datetime.datetime.now):
+        self.windows = []
+        self._now = now
+        for window in spec.split(','):
+            window = window.strip()
+            if not window:
+                continue
+            try:
+                start, end = window.split('-')
+                self.windows.append((self._parse_time(start), self._parse_time(end)))
+            except ValueError:
+                raise ValueError("invalid time window '{}'".format(window))
+
+    @staticmethod
+    def _parse_time(hhmm: str) -> datetime.time:
+        hours, minutes = hhmm.strip().split(':')
+        return datetime.time(int(hours), int(minutes))
+
+    def active(self, now: datetime.datetime = None) -> bool:
+        """Returns True if 'now' falls into any of the full speed windows."""
+        cur = (now or self._now()).time()
+        for start, end in self.windows:
+            if start <= end:
+                if start <= cur < end:
+                    return True
+            elif cur >= start or cur < end:
+                return True
+        return False
+
+
+class TokenBucket:
+    """Token bucket rate limiter for in-process transfers.
+
+    Tokens are bytes. Consuming from the bucket blocks until enough tokens
+    are available. Bucket can have a parent bucket (e.g. per-job bucket
+    with global parent) - the tokens are then consumed from both.
+    """
+
+    def __init__(self, rate: int, burst: int = 0, parent=None, unlimited=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            rate (int): Bytes per second, 0 means unlimited.
+            burst (int): Size of the bucket, one second worth of tokens by default.
+            parent (TokenBucket): Bucket that is consumed as well.
+            unlimited (callable): Returns True when limiting is suspended.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.parent = parent
+        self.unlimited = unlimited
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self, amount: int):
+        """Takes 'amount' of tokens, waits if there are not enough of them."""
+        if self.parent is not None:
+            self.parent.consume(amount)
+        if self.rate <= 0 or (self.unlimited is not None and self.unlimited()):
+            return
+
+        with self._lock:
+            self._refill()
+            # it's possible to go into debt, the debt is paid by waiting
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+
+
+class RateMeter:
+    """Measures transfer rate from samples of total transferred bytes."""
+
+    def __init__(self, min_interval: float = 1.0, clock=time.monotonic):
+        self.min_interval = min_interval
+        self._clock = clock
+        self._last = None
+        self.rate = 0.0
+
+    def sample(self, total: int) -> float:
+        """Records new sample, returns smoothed rate in bytes per second."""
+        now = self._clock()
+        if self._last is not None:
+            last_time, last_total = self._last
+            # too short interval gives unreliable results
+            if now - last_time < self.min_interval:
+                return self.rate
+            cur_rate = max(0, total - last_total) / (now - last_time)
+            self.rate = 0.5 * self.rate + 0.5 * cur_rate
+        self._last = (now, total)
+        return self.rate
+
+
+class Throttle:
+    """Global and per-job bandwidth limits for the download stage.
+
+    External tools (rtmpdump, ffmpeg) can't be limited directly, so their
+    spawning is paced - new download is started only when the measured
+    aggregate rate is below the limit and when the average rate since the
+    limits apply is below the limit, so downloads running one at a time are
+    limited too (by waiting before the next one). In-process transfers
+    consume tokens from 'job_bucket()'. The per-job limit of external tools
+    is enforced only together with the global limit, by 'max_jobs'.
+    """
+
+    # seconds to wait after spawn before the effect can be measured
+    settle_time = 5.0
+
+    def __init__(self, rate: int = 0, job_rate: int = 0, schedule: FullSpeedSchedule = None,
+                 clock=time.monotonic):
+        """
+        Args:
+            rate (int): Global limit in bytes per second, 0 means unlimited.
+            job_rate (int): Per-job limit in bytes per second, 0 means unlimited.
+            schedule (FullSpeedSchedule): Windows when limits don't apply.
+        """
+        self.rate = rate
+        self.job_rate = job_rate
+        self.schedule = schedule or FullSpeedSchedule()
+        self._clock = clock
+        self.bucket = TokenBucket(rate, unlimited=self.full_speed, clock=clock)
+        self.meter = RateMeter(clock=clock)
+        self._last_spawn = None
+        # time and transferred bytes when the limits started to apply
+        self._budget_start = None
+
+    @classmethod
+    def from_config(cls, conf: config.Config):
+        """Creates throttle according to the BANDWIDTH config section."""
+        return cls(utils.parse_size(conf.BANDWIDTH.limit),
+                   utils.parse_size(conf.BANDWIDTH.job_limit),
+                   FullSpeedSchedule(conf.BANDWIDTH.full_speed_hours))
+
+    def reconfigure(self, conf: config.Config):
+        """Applies the BANDWIDTH config section, running transfers get the new global limit."""
+        self.rate = utils.parse_size(conf.BANDWIDTH.limit)
+        self.job_rate = utils.parse_size(conf.BANDWIDTH.job_limit)
+        self.schedule = FullSpeedSchedule(conf.BANDWIDTH.full_speed_hours)
+        self.bucket.rate = self.bucket.burst = self.rate
+        self._budget_start = None
+
+    def full_speed(self) -> bool:
+        return self.schedule.active()
+
+    def limited(self) -> bool:
+        """Returns True if any limit applies at the moment."""
+        return bool(self.rate or self.job_rate) and not self.full_speed()
+
+    def job_bucket(self) -> TokenBucket:
+        """Returns token bucket for single in-process transfer."""
+        return TokenBucket(self.job_rate, parent=self.bucket, unlimited=self.full_speed,
+                           clock=self._clock)
+
+    def max_jobs(self) -> int:
+        """Maximal number of concurrent downloads allowed by the limits, 0 if unlimited.
+
+        The number is known only when both global and per-job limit are set;
+        per-job limit alone applies only to in-process transfers.
+        """
+        if not (self.rate and self.job_rate) or not self.limited():
+            return 0
+        return max(1, self.rate // self.job_rate)
+
+    def _below_limits(self, running: int, cur_rate: float) -> bool:
+        if self.max_jobs() and running >= self.max_jobs():
+            return False
+        if running == 0:
+            return True
+        if self._last_spawn is not None and \
+                self._clock() - self._last_spawn < self.settle_time:
+            return False
+        return not self.rate or cur_rate < self.rate
+
+    def can_spawn(self, running: int, transferred: int) -> bool:
+        """Decides if new download of external tool can be started.
+
+        Args:
+            running (int): Number of running downloads.
+            transferred (int): Total number of bytes transferred by all downloads.
+        """
+        now = self._clock()
+        cur_rate = self.meter.sample(transferred)
+        if not self.limited():
+            self._budget_start = None
+            allowed = True
+        else:
+            if self._budget_start is None:
+                self._budget_start = (now, transferred)
+            start_time, start_transferred = self._budget_start
+            # average rate over the limit is paid off by waiting
+            allowed = not (self.rate and transferred - start_transferred >
+                           self.rate * (now - start_time)) and \
+                self._below_limits(running, cur_rate)
+        if allowed:
+            self._last_spawn = now
+        return allowed
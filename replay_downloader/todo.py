@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Lazily loaded queue of work.
+"""
+
+import itertools
+
+
+class SpoolFile:
+    """On-disk FIFO queue of lines (SQLite database).
+
+    Line is removed only when it's acknowledged by 'ack', i.e. when its record
+    went through the whole pipeline. Lines that were taken but not
+    acknowledged (being processed when the program was stopped or crashed)
+    are returned to the queue when the spool is opened again, so the work can
+    be resumed by using the same spool file. Number of lines already read
+    from the source is recorded as well.
+    """
+
+    def __init__(self, path: str):
+        # needed only with spool file, not worth importing at startup
+        # pylint: disable=import-outside-toplevel
+        import sqlite3
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS queue '
+                          '(id INTEGER PRIMARY KEY, line TEXT, taken INTEGER NOT NULL DEFAULT 0)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(queue)')]
+        if 'taken' not in columns:
+            # spool created by older version
+            self.conn.execute('ALTER TABLE queue ADD COLUMN taken INTEGER NOT NULL DEFAULT 0')
+        self.conn.execute('UPDATE queue SET taken = 0')
+        self.conn.commit()
+
+    def __len__(self):
+        """Returns number of lines that were not acknowledged yet."""
+        return self.conn.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+
+    @property
+    def source_lines(self) -> int:
+        """Number of lines read from the source so far (by all runs)."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'source_lines'").fetchone()
+        return row[0] if row else 0
+
+    def extend(self, lines, from_source: bool = False):
+        """Adds lines to the end of the queue.
+
+        With 'from_source' the lines are counted as read from the source.
+        """
+        lines = list(lines)
+        self.conn.executemany('INSERT INTO queue (line) VALUES (?)', ((l, ) for l in lines))
+        if from_source:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source_lines', ?)",
+                              (self.source_lines + len(lines), ))
+        self.conn.commit()
+
+    def take(self) -> tuple:
+        """Returns id and the oldest line that was not taken yet, None if there's none."""
+        row = self.conn.execute(
+            'SELECT id, line FROM queue WHERE taken = 0 ORDER BY id LIMIT 1').fetchone()
+        if row is None:
+            return None
+        self.conn.execute('UPDATE queue SET taken = 1 WHERE id = ?', (row[0], ))
+        self.conn.commit()
+        return row
+
+    def ack(self, line_id: int):
+        """Removes the line, it's processed."""
+        self.conn.execute('DELETE FROM queue WHERE id = ?', (line_id, ))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class TodoQueue:
+    """The 'to_do' stack for 'ProcScheduler' fed on demand from iterator of lines.
+
+    Lines are parsed into file records only when they are needed, so memory
+    usage doesn't depend on the length of the input. Records added by
+    'append' (e.g. returned for retry) are processed first.
+
+    With spool file, lines of records are kept in the spool until 'done' is
+    called with the record. Lines read from the source by earlier runs are
+    skipped, so the resumed run can be given the same source.
+    """
+
+    # number of lines moved from source to spool file at once
+    chunk_size = 1000
+
+    def __init__(self, lines, parse, spool: SpoolFile = None):
+        """
+        Args:
+            lines (iterable): Source of lines.
+            parse (callable): Turns line into file record, returns None for lines to skip.
+            spool (SpoolFile): Optional on-disk queue for lines that are not processed yet.
+        """
+        self.lines = iter(lines)
+        self.parse = parse
+        self.spool = spool
+        self.pending = []
+        self._exhausted = False
+        # spool line ids by record id
+        self._line_ids = {}
+        if spool is not None:
+            # already in the spool or processed
+            for _ in itertools.islice(self.lines, spool.source_lines):
+                pass
+
+    def _spool_chunk(self) -> bool:
+        chunk = list(itertools.islice(self.lines, self.chunk_size))
+        if chunk:
+            self.spool.extend(chunk, from_source=True)
+        return bool(chunk)
+
+    def _next_line(self) -> tuple:
+        """Returns spool line id (None without spool) and the line, None when exhausted."""
+        if self.spool is None:
+            line = next(self.lines, None)
+            return None if line is None else (None, line)
+
+        row = self.spool.take()
+        if row is None and self._spool_chunk():
+            row = self.spool.take()
+        return row
+
+    def _load(self) -> bool:
+        """Makes sure there's at least one pending record if possible."""
+        while not self.pending and not self._exhausted:
+            row = self._next_line()
+            if row is None:
+                self._exhausted = True
+                break
+            line_id, line = row
+            file_record = self.parse(line)
+            if file_record is not None:
+                self.pending.append(file_record)
+                if line_id is not None:
+                    self._line_ids[file_record.id] = line_id
+            elif line_id is not None:
+                # nothing to do for the line
+                self.spool.ack(line_id)
+        return bool(self.pending)
+
+    def done(self, file_record):
+        """Marks the record as processed, its line is removed from the spool."""
+        line_id = self._line_ids.pop(file_record.id, None)
+        if line_id is not None:
+            self.spool.ack(line_id)
+
+    def flush(self):
+        """Moves all lines that were not read from the source yet to the spool."""
+        if self.spool is not None:
+            while self._spool_chunk():
+                pass
+
+    def __len__(self):
+        """Returns number of loaded records, it's zero only when the queue is exhausted."""
+        self._load()
+        return len(self.pending)
+
+    def __iter__(self):
+        while self._load():
+            yield self.pending.pop()
+
+    def __getitem__(self, index):
+        """Returns loaded record, [-1] is the one returned by next 'pop'."""
+        self._load()
+        return self.pending[index]
+
+    def append(self, file_record):
+        self.pending.append(file_record)
+
+    def pop(self):
+        if not self._load():
+            raise IndexError('pop from empty queue')
+        return self.pending.pop()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+External tools used by the pipeline (rtmpdump, ffmpeg).
+
+Tools are found by path lookup. Their version and capabilities are probed by
+running them, the results are cached on disk by path of the binary together
+with its modification time, so the tools are run again only when they change.
+"""
+
+import json
+import os
+import re
+import shutil
+
+from subprocess import DEVNULL, PIPE, STDOUT, Popen, TimeoutExpired
+
+
+# seconds to wait for probing command
+PROBE_TIMEOUT = 10
+
+
+def _output(command: list) -> str:
+    """Returns output of the command, empty string when it can't be run."""
+    try:
+        proc = Popen(command, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT)
+    except OSError:
+        return ''
+    try:
+        out = proc.communicate(timeout=PROBE_TIMEOUT)[0]
+    except TimeoutExpired:
+        proc.kill()
+        out = proc.communicate()[0]
+    return out.decode('utf-8', 'replace')
+
+
+def probe_ffmpeg(binary: str) -> dict:
+    """Returns version of ffmpeg and formats it can write."""
+    version = re.search(r'version (\S+)', _output([binary, '-hide_banner', '-version']))
+    muxers = set()
+    for line in _output([binary, '-hide_banner', '-formats']).splitlines():
+        # e.g. ' DE mp3             MP2/3 (MPEG audio layer 2/3)'
+        match = re.match(r'^ [D ]E\s+(\S+)', line)
+        if match:
+            muxers.update(match.group(1).split(','))
+    return {'version': version.group(1) if version else '', 'muxers': sorted(muxers)}
+
+
+def probe_rtmpdump(binary: str) -> dict:
+    """Returns version of rtmpdump and its options."""
+    out = _output([binary, '--help'])
+    version = re.search(r'RTMPDump v?(\S+)', out)
+    return {'version': version.group(1) if version else '',
+            'options': sorted(set(re.findall(r'--(\w+)', out)))}
+
+
+# probes by tool name
+PROBES = {
+    'ffmpeg': probe_ffmpeg,
+    'rtmpdump': probe_rtmpdump,
+}
+
+
+def _get_probe(binary: str):
+    name = os.path.basename(binary).lower()
+    for tool, probe in PROBES.items():
+        if name.startswith(tool):
+            return probe
+    return None
+
+
+class ToolCache:
+    """Results of probes by path of the binary, stored in JSON file."""
+
+    def __init__(self, path: str = ''):
+        """
+        Args:
+            path (str): The cache file, nothing is stored if empty.
+        """
+        self.path = os.path.expanduser(path) if path else ''
+        self.tools = {}
+        self._changed = False
+        if self.path:
+            try:
+                with open(self.path) as ifl:
+                    self.tools = json.load(ifl)
+            except (EnvironmentError, ValueError):
+                pass
+
+    def get(self, binary: str) -> dict:
+        """Returns result of probe of the binary, it's probed if it's not cached or changed."""
+        mtime = os.path.getmtime(binary)
+        info = self.tools.get(binary)
+        if info is not None and info.get('mtime') == mtime:
+            return info
+        probe = _get_probe(binary)
+        info = probe(binary) if probe is not None else {}
+        info['mtime'] = mtime
+        self.tools[binary] = info
+        self._changed = True
+        return info
+
+    def save(self):
+        if not (self.path and self._changed):
+            return
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as ofl:
+            json.dump(self.tools, ofl)
+        os.replace(tmp_path, self.path)
+        self._changed = False
+
+
+def find_tools(commands, cache_file: str = '') -> tuple:
+    """Finds the commands and probes them.
+
+    Returns:
+        tuple: Probe results by command and list of commands that were not found.
+    """
+    tool_cache = ToolCache(cache_file)
+    found = {}
+    missing = []
+    for command in commands:
+        binary = shutil.which(os.path.expanduser(command))
+        if binary is None:
+            missing.append(command)
+            continue
+        found[command] = dict(tool_cache.get(os.path.abspath(binary)), path=binary)
+    try:
+        tool_cache.save()
+    except OSError:
+        pass
+    return found, missing
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Timeline of the pipeline in Chrome trace event format.
+
+The trace file can be opened in Perfetto (https://ui.perfetto.dev) or
+chrome://tracing. Every job has its own track with spans of waiting in
+queue, spawning, running and finishing in every stage; the main loop has
+a track with the time spent in every task and in sleep. Counter tracks show
+number of running and queued jobs of every stage.
+
+Tracing is off unless 'trace_init' is called, all functions do nothing then.
+The events are kept in memory until the trace file is written, so tracing is
+not meant for long-running daemon.
+"""
+
+import atexit
+import json
+import os
+import time
+
+
+# track of the main loop
+MAIN_TID = 0
+
+# recorded events, None when tracing is off
+_EVENTS = None
+_TRACEFILE = None
+_START = 0.0
+# last values of counters
+_COUNTERS = {}
+# tracks that already have a name
+_NAMED = set()
+# time when job started to wait in queue, by job id
+_QUEUED = {}
+# time when job started to run, by (stage, job id)
+_RUNNING = {}
+
+
+def enabled() -> bool:
+    return _EVENTS is not None
+
+
+def _timestamp(when: float) -> float:
+    """Returns microseconds since the start of tracing."""
+    return round((when - _START) * 1e6, 1)
+
+
+def now() -> float:
+    return time.perf_counter()
+
+
+def trace_init(tracefile: str):
+    """Starts recording, the trace is written to 'tracefile' on exit."""
+    global _EVENTS, _TRACEFILE, _START
+    if not tracefile:
+        return
+    _EVENTS = []
+    _TRACEFILE = tracefile
+    _START = now()
+    _COUNTERS.clear()
+    _NAMED.clear()
+    _QUEUED.clear()
+    _RUNNING.clear()
+    name_track(MAIN_TID, 'main loop')
+    atexit.register(trace_shutdown)
+
+
+def trace_shutdown():
+    """Stops recording and writes the trace file."""
+    global _EVENTS
+    if _EVENTS is None:
+        return
+    events, _EVENTS = _EVENTS, None
+    with open(os.path.expanduser(_TRACEFILE), 'w') as ofl:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, ofl)
+
+
+def name_track(tid: int, name: str):
+    """Sets name of the track (thread in trace format)."""
+    if _EVENTS is None or tid in _NAMED:
+        return
+    _NAMED.add(tid)
+    _EVENTS.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                    'args': {'name': name}})
+
+
+def complete(name: str, cat: str, start: float, end: float = None, tid: int = MAIN_TID,
+             **args):
+    """Records span that started at 'start' and ended at 'end' (now if not specified)."""
+    if _EVENTS is None:
+        return
+    end = now() if end is None else end
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid,
+             'ts': _timestamp(start), 'dur': round((end - start) * 1e6, 1)}
+    if args:
+        event['args'] = args
+    _EVENTS.append(event)
+
+
+def counter(name: str, **values):
+    """Records values of counter track when they changed."""
+    if _EVENTS is None or _COUNTERS.get(name) == values:
+        return
+    _COUNTERS[name] = values
+    _EVENTS.append({'name': name, 'ph': 'C', 'pid': 1, 'ts': _timestamp(now()),
+                    'args': values})
+
+
+class _Span:
+    def __init__(self, name, cat, tid, args):
+        self.name = name
+        self.cat = cat
+        self.tid = tid
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, *exc):
+        complete(self.name, self.cat, self.start, tid=self.tid, **self.args)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, cat: str, tid: int = MAIN_TID, **args):
+    """Context manager that records span of the enclosed code."""
+    if _EVENTS is None:
+        return _NULL_SPAN
+    return _Span(name, cat, tid, args)
+
+
+def _job_track(file_record) -> int:
+    name_track(file_record.id, 'job {} {}'.format(
+        file_record.id, os.path.basename(file_record[0].path)))
+    return file_record.id
+
+
+def job_queued(file_record):
+    """Records that the job started to wait for the next stage."""
+    if _EVENTS is not None:
+        _QUEUED[file_record.id] = now()
+
+
+def job_dequeued(file_record, stage: str):
+    """Records span of waiting in queue of the stage."""
+    if _EVENTS is None:
+        return
+    start = _QUEUED.pop(file_record.id, None)
+    if start is None and file_record.id in _NAMED:
+        # retried after failure, the time it waited is not known
+        return
+    # jobs that were never queued waited since the start
+    complete('queue', stage, _START if start is None else start,
+             tid=_job_track(file_record))
+
+
+def job_started(file_record, stage: str):
+    if _EVENTS is not None:
+        _RUNNING[(stage, file_record.id)] = now()
+
+
+def job_ended(file_record, stage: str):
+    """Records span of running the job in the stage."""
+    if _EVENTS is None:
+        return
+    start = _RUNNING.pop((stage, file_record.id), None)
+    if start is not None:
+        complete('run', stage, start, tid=_job_track(file_record))
+
+
+def job_done(file_record):
+    """Forgets the job that went through the whole pipeline."""
+    if _EVENTS is not None:
+        _QUEUED.pop(file_record.id, None)
+        _NAMED.discard(file_record.id)
+
+
+def job_span(file_record, name: str, stage: str):
+    """Context manager that records span of the job."""
+    if _EVENTS is None:
+        return _NULL_SPAN
+    return _Span(name, stage, _job_track(file_record), {})
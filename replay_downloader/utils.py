@@ -4,6 +4,8 @@ Common utility functions.
 """
 
 import os
+import re
+import sys
 
 
 def remove_ext(filename: str):
@@ -16,3 +18,44 @@ def get_list_from_file(list_file: str) -> list:
     """Returns list of lines in file."""
     with open(list_file) as ifl:
         return ifl.read().splitlines()
+
+
+def iter_lines_from_files(list_files: list):
+    """Generator of lines from all files, '-' stands for stdin."""
+    for list_file in list_files:
+        if list_file == '-':
+            for line in sys.stdin:
+                yield line.rstrip('\n')
+            continue
+        with open(list_file) as ifl:
+            for line in ifl:
+                yield line.rstrip('\n')
+
+
+# multipliers for size suffixes
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """Converts size like '512K' or '2M' to number of bytes."""
+    size = str(size).strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    if not size:
+        return 0
+    unit = size[-1] if size[-1] in _SIZE_UNITS else ''
+    number = size[:-1] if unit else size
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError("invalid size '{}'".format(size))
+
+
+def recording_name(remote_file: str) -> str:
+    """Returns name of the recording, e.g. '20151205_TS_Teaching' for both
+    'rtmp://20151205_TS_Teaching.mp3' and
+    'http://host/replay/mp4:20151205_TS_Teaching.mp4/playlist.m3u8'.
+    """
+    match = re.search(r'mp4:([^\/]*)\/', remote_file)
+    name = match.group(1) if match else remote_file.rstrip('/').rsplit('/', 1)[-1]
+    return remove_ext(name)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Local imitation of the replay web site for tests and benchmarks.
+
+Serves:
+- login form ('/login-exec.php', POST logs in),
+- classic replay listing ('/index.php?id=replay') and mobile replay listing
+  ('/index.php?id=mobilereplay'), both matching 'list_regex' in 'Config',
+- HLS master playlist, media playlists and TS segments of every recording
+  ('/replay/mp4:NAME.mp4/playlist.m3u8'),
+- direct links to FLV files with MP3 audio ('/media/NAME.flv'), with support
+  for byte ranges.
+
+Size of segments, latency of every response and rate of failed segment
+requests are configurable. Usage:
+
+    with FakeReplayServer(recordings=10, segment_size=256 * 1024) as server:
+        server.configure(conf)
+        ...
+"""
+
+import collections
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+
+SESSION_COOKIE = 'PHPSESSID'
+
+# TS packet size and sync byte
+TS_PACKET = 188
+TS_SYNC = 0x47
+
+# variant streams of every recording: name, bandwidth, codecs
+VARIANTS = (
+    ('audio', 64000, 'mp4a.40.2'),
+    ('low', 400000, 'avc1.42001e,mp4a.40.2'),
+    ('high', 1200000, 'avc1.4d401f,mp4a.40.2'),
+)
+
+
+def make_ts(size: int, seed: int) -> bytes:
+    """Returns 'size' bytes that look like MPEG-TS packets."""
+    rnd = random.Random(seed)
+    packet = bytes([TS_SYNC]) + bytes(rnd.getrandbits(8) for _ in range(TS_PACKET - 1))
+    return (packet * (size // TS_PACKET + 1))[:size]
+
+
+def make_flv(size: int, frame_size: int = 1000) -> bytes:
+    """Returns FLV file of about 'size' bytes with MP3 audio tags."""
+    out = bytearray(b'FLV\x01\x04' + (9).to_bytes(4, 'big') + bytes(4))
+    frame = b'\xff\xfb' + bytes(range(256)) * (frame_size // 256 + 1)
+    frame = frame[:frame_size]
+    while len(out) < size:
+        # sound format 2 (MP3), 44 kHz, 16 bit, stereo
+        data = b'\x2f' + frame
+        out += bytes([8]) + len(data).to_bytes(3, 'big') + bytes(7) + data
+        out += (len(data) + 11).to_bytes(4, 'big')
+    return bytes(out)
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent separately, don't wait for delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _send(self, status: int, body: bytes = b'', headers: dict = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.fake.count('bytes', len(body))
+
+    def _logged_in(self) -> bool:
+        cookie = self.headers.get('Cookie', '')
+        return '{}={}'.format(SESSION_COOKIE, self.fake.session_id) in cookie
+
+    def do_POST(self):
+        self.fake.delay()
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        form = parse_qs(data)
+        self.fake.count('login')
+        if form.get('login') == [self.fake.login] and \
+                form.get('password') == [self.fake.password]:
+            self._send(302, headers={
+                'Set-Cookie': '{}={}; Path=/'.format(SESSION_COOKIE, self.fake.session_id),
+                'Location': '/index.php?id=replay'})
+        else:
+            self._send(200, self.fake.login_form())
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.fake.delay()
+        url = urlsplit(self.path)
+        page = parse_qs(url.query).get('id', [''])[0]
+        if url.path == '/index.php' and page in ('replay', 'mobilereplay'):
+            self.fake.count('listing')
+            if not self._logged_in():
+                self._send(200, self.fake.login_form())
+            elif page == 'replay':
+                self._send(200, self.fake.replay_page())
+            else:
+                self._send(200, self.fake.mobile_page())
+            return
+
+        match = re.match(r'/replay/mp4:([^/]+)\.mp4/(.+)$', url.path)
+        if match and match.group(1) in self.fake.recordings:
+            self._hls(match.group(1), match.group(2))
+            return
+
+        match = re.match(r'/media/([^/]+)\.flv$', url.path)
+        if match and match.group(1) in self.fake.recordings:
+            self._media(match.group(1))
+            return
+
+        self._send(404, b'not found')
+
+    def _hls(self, name: str, fname: str):
+        if fname == 'playlist.m3u8':
+            self.fake.count('playlist')
+            self._send(200, self.fake.master_playlist().encode('utf-8'))
+            return
+        match = re.match(r'chunklist_(\w+)\.m3u8$', fname)
+        if match:
+            self.fake.count('playlist')
+            self._send(200, self.fake.media_playlist(match.group(1)).encode('utf-8'))
+            return
+        match = re.match(r'media_(\w+)_(\d+)\.ts$', fname)
+        if match and int(match.group(2)) < self.fake.segments:
+            if self.fake.fail():
+                self.fake.count('errors')
+                self._send(503, b'overloaded')
+                return
+            self.fake.count('segment')
+            self._send(200, self.fake.segment(name, int(match.group(2))),
+                       {'Content-Type': 'video/mp2t'})
+            return
+        self._send(404, b'not found')
+
+    def _media(self, name: str):
+        body = self.fake.media(name)
+        self.fake.count('media')
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'video/x-flv'}
+        if match and self.command == 'GET':
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(body))
+            self._send(206, body[start:end + 1], headers)
+        else:
+            self._send(200, body, headers)
+
+
+class FakeReplayServer:
+    """Threaded HTTP server imitating the replay web site."""
+
+    def __init__(self, recordings=3, segments: int = 4, segment_size: int = 64 * 1024,
+                 segment_duration: float = 10.0, media_size: int = 256 * 1024,
+                 latency: float = 0.0, error_rate: float = 0.0, login: str = 'user',
+                 password: str = 'pass', seed: int = 0):
+        """
+        Args:
+            recordings: Number of recordings or list of their names.
+            segments (int): Number of HLS segments of every recording.
+            segment_size (int): Size of one segment in bytes.
+            segment_duration (float): Duration of one segment in seconds.
+            media_size (int): Size of FLV file of every recording.
+            latency (float): Seconds waited before every response.
+            error_rate (float): Probability that segment request fails with 503.
+        """
+        if isinstance(recordings, int):
+            recordings = ['2015{:04d}_TS_ChNN_Teaching_{}'.format(num + 1001, num)
+                          for num in range(recordings)]
+        self.recordings = list(recordings)
+        self.segments = segments
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+        self.media_size = media_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.login = login
+        self.password = password
+        self.session_id = 'fake{}'.format(seed)
+        self.stats = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._server = _ThreadingServer(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def configure(self, conf):
+        """Points the configuration to this server."""
+        conf.AUTH.login = self.login
+        conf.AUTH.password = self.password
+        conf.RTMP.replay_url = self.url + '/index.php?id=replay'
+        conf.RTMP.login_url = self.url + '/login-exec.php'
+        conf.HTTP.replay_url = self.url + '/index.php?id=mobilereplay'
+        conf.HTTP.login_url = self.url + '/login-exec.php'
+
+    def count(self, key: str, num: int = 1):
+        with self._lock:
+            self.stats[key] += num
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def playlist_url(self, name: str) -> str:
+        return '{}/replay/mp4:{}.mp4/playlist.m3u8'.format(self.url, name)
+
+    def media_url(self, name: str) -> str:
+        return '{}/media/{}.flv'.format(self.url, name)
+
+    @staticmethod
+    def login_form() -> bytes:
+        return (b'<form action="login-exec.php" method="post">'
+                b'<input type="text" name="login"><input type="password" name="password">'
+                b'</form>')
+
+    def replay_page(self) -> bytes:
+        lines = ["<script>so.addVariable('file','/{}.mp3');</script>".format(name)
+                 for name in self.recordings]
+        return '\n'.join(lines).encode('utf-8')
+
+    def mobile_page(self) -> bytes:
+        lines = ['<li><a href="{}">{}</a></li>'.format(self.playlist_url(name), name)
+                 for name in self.recordings]
+        return '\n'.join(lines).encode('utf-8')
+
+    @staticmethod
+    def master_playlist() -> str:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3',
+                 '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",NAME="audio",DEFAULT=YES,'
+                 'URI="chunklist_audio.m3u8"']
+        for name, bandwidth, codecs in VARIANTS:
+            lines.append('#EXT-X-STREAM-INF:BANDWIDTH={},CODECS="{}"{}'.format(
+                bandwidth, codecs, ',AUDIO="aac"' if name != 'audio' else ''))
+            lines.append('chunklist_{}.m3u8'.format(name))
+        return '\n'.join(lines) + '\n'
+
+    def media_playlist(self, variant: str) -> str:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3',
+                 '#EXT-X-TARGETDURATION:{:.0f}'.format(self.segment_duration),
+                 '#EXT-X-MEDIA-SEQUENCE:0']
+        for num in range(self.segments):
+            lines.append('#EXTINF:{:.3f},'.format(self.segment_duration))
+            lines.append('media_{}_{}.ts'.format(variant, num))
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def segment(self, name: str, num: int) -> bytes:
+        # all segments have the same content, it's generated only once
+        key = ('segment', self.segment_size)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = make_ts(self.segment_size, 0)
+        return self._cache[key]
+
+    def media(self, name: str) -> bytes:
+        key = ('media', self.media_size)
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = make_flv(self.media_size)
+        return self._cache[key]
@@ -4,18 +4,66 @@
 # pylint: disable=missing-docstring
 # pylint: disable=invalid-name
 
+import concurrent.futures
+import datetime
+import json
 import unittest
 import os
+import re
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
 import time
 
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from subprocess import DEVNULL, PIPE, Popen, call
+
+from replay_downloader import (
+    api,
+    cache,
+    control,
+    daemon,
+    flv,
+    hedge,
+    hls,
+    log,
+    mirrors,
+    mp4,
+    msgs,
+    perform,
+    planner,
+    ranged,
+    session,
+    simulate,
+    stages,
+    tools,
+    trace
+)
+from replay_downloader.cleanup import Cleanup
 from replay_downloader.config import Config
-from replay_downloader.download import Download
+from replay_downloader.download import Download, iter_replay_list
 from replay_downloader.extract_audio import ExtractAudio
-from replay_downloader.mappings import Fileinfo, Ftypes, MsgTypes, Procinfo, Rtypes
+from replay_downloader.mappings import (
+    Fileinfo, Ftypes, MsgTypes, Procinfo, Rtypes, UnsupportedCodec)
 from replay_downloader.msgs import MsgList
-from replay_downloader.perform import Work
+from replay_downloader.perform import ProcScheduler, Watchdog, Work
+from replay_downloader.priority import Priority, parse_cpu_list
 from replay_downloader.record import FileRecord
-from replay_downloader.utils import get_list_from_file
+from replay_downloader.streaming import DemuxProc, PipeProc
+from replay_downloader.throttle import FullSpeedSchedule, Throttle, TokenBucket
+from replay_downloader.todo import SpoolFile, TodoQueue
+from replay_downloader.utils import (
+    get_list_from_file,
+    iter_lines_from_files,
+    parse_size,
+    recording_name
+)
+from tests.fake_replay_server import FakeReplayServer
 
 
 class TestDownloads(unittest.TestCase):
@@ -54,6 +102,11 @@ class TestDownloads(unittest.TestCase):
                           '20151207_TS_ChNN_Atiyoga_Teachings_Tashigar_South_es_parcial.mp3',
                           '20151208_TS_ChNN_Atiyoga_Teachings_Tashigar_South.mp3'])
 
+    def test_iter_lines_from_files(self):
+        os.chdir(os.path.dirname(__file__))
+        lines = list(iter_lines_from_files(['test_replay_list', 'test_replay_list']))
+        self.assertEqual(lines, get_list_from_file('test_replay_list') * 2)
+
     def test_spawn_http(self):
         conf = Config()
         conf.COMMANDS.rtmpdump = '/bin/true'
@@ -131,6 +184,7 @@ class TestExtractAudio(unittest.TestCase):
         conf = Config()
         conf.COMMANDS.rtmpdump = '/bin/true'
         conf.COMMANDS.ffmpeg = '/bin/true'
+        conf.EXTRACT.native = 'no'
         extracting = ExtractAudio(conf, [])
 
         file_record = FileRecord(Fileinfo('20150816.flv', Ftypes.FLV,
@@ -169,6 +223,7 @@ class TestExtractAudio(unittest.TestCase):
         conf = Config()
         conf.COMMANDS.rtmpdump = '/bin/true'
         conf.COMMANDS.ffmpeg = '/bin/true'
+        conf.EXTRACT.native = 'no'
         extracting = ExtractAudio(conf, [])
 
         file_record = FileRecord(Fileinfo('20150816.flv', Ftypes.FLV,
@@ -282,3 +337,2169 @@ class TestFileRecord(unittest.TestCase):
         self.assertEqual(file_record[-1], Fileinfo('file', Rtypes.HTTP))
         file_record.add(Fileinfo('file2', Rtypes.RTMP))
         self.assertEqual(file_record[-1], Fileinfo('file2', Rtypes.RTMP))
+
+    def test_shared_strings(self):
+        # pylint: disable=protected-access
+        file_record = FileRecord(Fileinfo('rtmp://' + 'foo.mp3', Rtypes.RTMP))
+        file_record.add(Fileinfo('/tmp/work/' + 'foo.flv', Ftypes.FLV, 'Down' + 'load'))
+        other = Fileinfo('/tmp/work/' + 'bar.flv', Ftypes.FLV, 'Down' + 'load')
+        self.assertEqual(file_record[0].path, 'rtmp://foo.mp3')
+        self.assertEqual(file_record[1].path, '/tmp/work/foo.flv')
+        self.assertIs(file_record[1]._prefix, other._prefix)
+        self.assertIs(file_record[1]._ext, other._ext)
+        self.assertIs(file_record[1].clname, other.clname)
+        self.assertIs(file_record[0]._stem, file_record[1]._stem)
+
+    def test_fileinfo(self):
+        finfo = Fileinfo('20150816', Ftypes.MP4, audio_f=Ftypes.AAC)
+        self.assertEqual(finfo.path, '20150816')
+        self.assertEqual(finfo._replace(path='x/y.mp4').path, 'x/y.mp4')
+        self.assertNotEqual(finfo, finfo._replace(audio_f=Ftypes.MP3))
+        self.assertEqual(len({finfo, Fileinfo('20150816', Ftypes.MP4, audio_f=Ftypes.AAC)}), 1)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class TestThrottle(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size('0'), 0)
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('512K'), 512 * 1024)
+        self.assertEqual(parse_size('1.5M'), 1536 * 1024)
+        self.assertEqual(parse_size('2mb'), 2 * 1024 * 1024)
+        with self.assertRaises(ValueError):
+            parse_size('foo')
+
+    def test_schedule(self):
+        sched = FullSpeedSchedule('20:00-07:00, 12:00-13:00')
+        self.assertTrue(sched.active(datetime.datetime(2017, 1, 1, 23, 0)))
+        self.assertTrue(sched.active(datetime.datetime(2017, 1, 1, 6, 59)))
+        self.assertTrue(sched.active(datetime.datetime(2017, 1, 1, 12, 30)))
+        self.assertFalse(sched.active(datetime.datetime(2017, 1, 1, 10, 0)))
+        self.assertFalse(FullSpeedSchedule('').active())
+        with self.assertRaises(ValueError):
+            FullSpeedSchedule('foo')
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1000, clock=clock, sleep=clock.sleep)
+        # the burst is available immediately
+        bucket.consume(1000)
+        self.assertEqual(clock.now, 0)
+        bucket.consume(2000)
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_token_bucket_parent(self):
+        clock = FakeClock()
+        parent = TokenBucket(1000, clock=clock, sleep=clock.sleep)
+        bucket = TokenBucket(0, parent=parent, clock=clock, sleep=clock.sleep)
+        bucket.consume(3000)
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_token_bucket_unlimited(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, unlimited=lambda: True, clock=clock, sleep=clock.sleep)
+        bucket.consume(10000)
+        self.assertEqual(clock.now, 0)
+
+    def test_max_jobs(self):
+        self.assertEqual(Throttle(1000, 300).max_jobs(), 3)
+        self.assertEqual(Throttle(1000).max_jobs(), 0)
+        noon = datetime.datetime(2017, 1, 1, 12, 0)
+        self.assertEqual(Throttle(1000, 300, FullSpeedSchedule('00:00-23:59',
+                                                               now=lambda: noon)).max_jobs(), 0)
+        self.assertEqual(Throttle(1000, 300, FullSpeedSchedule('13:00-14:00',
+                                                               now=lambda: noon)).max_jobs(), 3)
+
+    def test_can_spawn(self):
+        clock = FakeClock()
+        thr = Throttle(1000, clock=clock)
+        self.assertTrue(thr.can_spawn(0, 0))
+        # wait until the spawned download settles
+        self.assertFalse(thr.can_spawn(1, 0))
+        clock.now += thr.settle_time
+        self.assertTrue(thr.can_spawn(1, 1000))
+        clock.now += thr.settle_time
+        # measured rate is over the limit
+        self.assertFalse(thr.can_spawn(2, 1000000))
+
+    def test_can_spawn_single(self):
+        clock = FakeClock()
+        thr = Throttle(1000, clock=clock)
+        self.assertTrue(thr.can_spawn(0, 0))
+        # single download transferred 10 seconds worth of data in 5 seconds
+        clock.now += 5
+        self.assertFalse(thr.can_spawn(0, 10000))
+        clock.now += 5
+        self.assertTrue(thr.can_spawn(0, 10000))
+
+    def test_scheduler_can_spawn(self):
+        class Schedulable:
+            def __init__(self):
+                self.to_do = ['a', 'b', 'c']
+                self.spawned = []
+
+            def spawn(self, item):
+                self.spawned.append(item)
+
+            def finished_handler(self, procinfo):
+                pass
+
+            def can_spawn(self):
+                return len(self.spawned) < 2
+
+        obj = Schedulable()
+        scheduler = ProcScheduler(obj, 3)
+        self.assertFalse(scheduler())
+        self.assertEqual(obj.spawned, ['c', 'b'])
+        self.assertEqual(obj.to_do, ['a'])
+
+
+class TestTodoQueue(unittest.TestCase):
+    def test_lazy(self):
+        consumed = []
+
+        def _lines():
+            for line in ['# comment', 'foo', '', 'http://bar']:
+                consumed.append(line)
+                yield line
+
+        queue = TodoQueue(_lines(), Download.parse_line)
+        self.assertEqual(consumed, [])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(consumed, ['# comment', 'foo'])
+        self.assertEqual(queue.pop()[-1], Fileinfo('rtmp://foo', Rtypes.RTMP))
+        self.assertEqual(queue.pop()[-1], Fileinfo('http://bar', Rtypes.HTTP))
+        self.assertEqual(len(queue), 0)
+        with self.assertRaises(IndexError):
+            queue.pop()
+
+    def test_append(self):
+        queue = TodoQueue(['foo'], Download.parse_line)
+        queue.append(FileRecord(Fileinfo('http://bar', Rtypes.HTTP)))
+        self.assertEqual([rec[-1].path for rec in queue], ['http://bar', 'rtmp://foo'])
+
+    def test_spool(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spool_path = os.path.join(tmpdir, 'spool')
+            lines = ['foo', '# comment', 'bar', 'baz', 'qux']
+            queue = TodoQueue(lines, Download.parse_line, spool=SpoolFile(spool_path))
+            queue.chunk_size = 3
+            foo = queue.pop()
+            self.assertEqual(foo[-1].path, 'rtmp://foo')
+            # the first chunk is spooled, 'baz' and 'qux' are not read from the source yet
+            self.assertEqual(len(queue.spool), 3)
+            queue.done(foo)
+            self.assertEqual(len(queue.spool), 2)
+            self.assertEqual(queue.pop()[-1].path, 'rtmp://bar')
+            queue.spool.close()
+
+            # resume unfinished work, 'bar' was not finished; lines read from
+            # the source are not read again
+            queue = TodoQueue(lines, Download.parse_line, spool=SpoolFile(spool_path))
+            self.assertEqual([rec[-1].path for rec in queue],
+                             ['rtmp://bar', 'rtmp://baz', 'rtmp://qux'])
+            queue.spool.close()
+
+    def test_spool_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conf = Config()
+            conf.COMMANDS.rtmpdump = '/bin/true'
+            spool_path = os.path.join(tmpdir, 'spool')
+            queue = TodoQueue(['foo', 'bar'], Download.parse_line, spool=SpoolFile(spool_path))
+            work, tasks = stages.build_pipeline(
+                conf, ['download'], queue,
+                {'work_dir': tmpdir, 'destination': tmpdir, 'concurrency': 1})
+            tasks['download'].obj.finished_ready.append(queue.pop())
+            list(work)[-1]()
+            # finished records are removed from the spool
+            self.assertEqual(len(queue.spool), 1)
+            queue.spool.close()
+
+    def test_scheduler(self):
+        class Schedulable:
+            def __init__(self, to_do):
+                self.to_do = to_do
+                self.spawned = []
+
+            def spawn(self, item):
+                self.spawned.append(item[-1].path)
+
+            def finished_handler(self, procinfo):
+                pass
+
+        obj = Schedulable(TodoQueue(['foo', 'bar'], Download.parse_line))
+        self.assertTrue(ProcScheduler(obj, 3)())
+        self.assertEqual(obj.spawned, ['rtmp://foo', 'rtmp://bar'])
+
+
+class TestLog(unittest.TestCase):
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, 'log')
+            log.log_init(logfile)
+            log.logit('line1\nline2', 'error', job=1, stage='download', file='foo.flv',
+                      duration=1.5)
+            log.logit('second')
+            log.log_shutdown()
+            self.assertIsNone(log.LOGFILE)
+            with open(logfile) as ifl:
+                records = [json.loads(line) for line in ifl]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['msg'], 'line1\nline2')
+        self.assertEqual(records[0]['level'], 'error')
+        self.assertEqual(records[0]['job'], 1)
+        self.assertEqual(records[0]['stage'], 'download')
+        self.assertEqual(records[0]['file'], 'foo.flv')
+        self.assertEqual(records[0]['duration'], 1.5)
+        self.assertEqual(records[1]['level'], 'info')
+
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, 'log')
+            log.log_init(logfile, max_bytes=100, backup_count=2)
+            for num in range(10):
+                log.logit('message {}'.format(num))
+            log.log_shutdown()
+            self.assertTrue(os.path.isfile(logfile + '.1'))
+            self.assertTrue(os.path.isfile(logfile + '.2'))
+            self.assertFalse(os.path.isfile(logfile + '.3'))
+
+    def test_init_twice(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = os.path.join(tmpdir, 'first')
+            second = os.path.join(tmpdir, 'second')
+            log.log_init(first)
+            log.log_init(second)
+            log.logit('message')
+            log.log_shutdown()
+            with open(first) as ifl:
+                self.assertEqual(ifl.read(), '')
+            with open(second) as ifl:
+                self.assertEqual(len(ifl.readlines()), 1)
+
+    def test_disabled(self):
+        self.assertIsNone(log.LOGFILE)
+        log.logit('nothing happens')
+
+
+class TestPriority(unittest.TestCase):
+    def test_parse_cpu_list(self):
+        self.assertEqual(parse_cpu_list('0-3,6'), {0, 1, 2, 3, 6})
+        self.assertEqual(parse_cpu_list(''), set())
+        with self.assertRaises(ValueError):
+            parse_cpu_list('a-b')
+
+    def test_from_config(self):
+        conf = Config()
+        prio = Priority.from_config(conf, 'DOWNLOAD')
+        self.assertEqual(prio.popen_kwargs(), {'start_new_session': True})
+        conf.EXTRACT.background = 'yes'
+        prio = Priority.from_config(conf, 'EXTRACT')
+        self.assertEqual(prio.nice, 19)
+        self.assertEqual(prio.ioprio(), 3 << 13 | 4)
+        self.assertIn('preexec_fn', prio.popen_kwargs())
+
+    def test_unknown_ioclass(self):
+        with self.assertRaises(ValueError):
+            Priority(ioclass='foo')
+
+    def test_apply(self):
+        cpu = min(os.sched_getaffinity(0))
+        prio = Priority(nice=5, affinity={cpu})
+        proc = Popen(['/bin/sh', '-c', 'cat /proc/self/stat'], stdout=PIPE,
+                     **prio.popen_kwargs())
+        out = proc.communicate()[0].decode('utf-8')
+        # niceness is the 19th field
+        nice = int(out.rsplit(')', 1)[1].split()[16])
+        self.assertEqual(nice, os.nice(0) + 5)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.conf = Config()
+        self.conf.DAEMON.replay_types = ''
+        self.conf.DAEMON.socket = os.path.join(self.tmpdir.name, 'control.sock')
+        self.conf.DAEMON.seen_file = os.path.join(self.tmpdir.name, 'seen')
+        self.to_do = TodoQueue([], Download.parse_line)
+
+        class Schedulable:
+            to_do = []
+
+            def spawn(self, file_record):
+                pass
+
+            def finished_handler(self, procinfo):
+                pass
+
+        self.scheduler = ProcScheduler(Schedulable(), 3)
+        work = Work()
+        work.add(self.scheduler)
+        self.daemon = daemon.Daemon(self.conf, work, {'download': self.scheduler}, self.to_do)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_handle(self):
+        resp = self.daemon.handle({'cmd': 'enqueue', 'items': ['foo', '# bar']})
+        self.assertEqual(resp, {'ok': True, 'queued': 1})
+        self.assertEqual(self.to_do.pop()[-1].path, 'rtmp://foo')
+        self.assertTrue(self.daemon.handle({'cmd': 'pause', 'stage': 'download'})['ok'])
+        self.assertTrue(self.scheduler.paused)
+        self.assertTrue(self.daemon.handle({'cmd': 'resume', 'stage': 'download'})['ok'])
+        self.assertFalse(self.scheduler.paused)
+        self.assertTrue(
+            self.daemon.handle({'cmd': 'concurrency', 'stage': 'download', 'value': 5})['ok'])
+        self.assertEqual(self.scheduler.avail_slots, 5)
+        status = self.daemon.handle({'cmd': 'status'})
+        self.assertEqual(status['stages']['download']['slots'], 5)
+        for value in (0, -1):
+            resp = self.daemon.handle({'cmd': 'concurrency', 'stage': 'download',
+                                       'value': value})
+            self.assertFalse(resp['ok'])
+            self.assertIn('at least 1', resp['error'])
+        self.assertEqual(self.scheduler.max_slots, 5)
+        self.assertFalse(self.daemon.handle({'cmd': 'pause', 'stage': 'foo'})['ok'])
+        self.assertFalse(self.daemon.handle({'cmd': 'foo'})['ok'])
+        # runtime control needs controller
+        self.assertFalse(self.daemon.handle({'cmd': 'drain'})['ok'])
+
+    def test_enqueue_found(self):
+        with open(self.conf.DAEMON.seen_file, 'w') as ofl:
+            print('old.mp3', file=ofl)
+        self.daemon = daemon.Daemon(self.conf, Work(), {}, self.to_do)
+        for entry in ('old.mp3', 'new.mp3', 'new.mp3'):
+            # pylint: disable=protected-access
+            self.daemon._found.put(entry)
+        self.daemon.enqueue_found()
+        self.assertEqual([rec[-1].path for rec in self.to_do], ['rtmp://new.mp3'])
+        self.assertEqual(get_list_from_file(self.conf.DAEMON.seen_file), ['old.mp3', 'new.mp3'])
+
+    def test_socket(self):
+        thread = threading.Thread(target=self.daemon.run, args=(lambda: None, ))
+        thread.start()
+        try:
+            for _ in range(50):
+                if os.path.exists(self.daemon.socket_path):
+                    break
+                time.sleep(0.05)
+            resp = daemon.send_command(self.daemon.socket_path,
+                                       daemon.parse_command(['pause', 'download']))
+            self.assertEqual(resp, {'ok': True})
+            self.assertTrue(self.scheduler.paused)
+            # second daemon doesn't take over the socket
+            other = daemon.Daemon(self.conf, Work(), {}, self.to_do)
+            with self.assertRaises(FileExistsError):
+                other.run(lambda: None)
+            self.assertEqual(daemon.send_command(self.daemon.socket_path, {'cmd': 'status'})
+                             ['stages']['download']['paused'], True)
+        finally:
+            daemon.send_command(self.daemon.socket_path, {'cmd': 'stop'})
+            thread.join()
+        self.assertFalse(os.path.exists(self.daemon.socket_path))
+
+    def test_stale_socket(self):
+        # socket file left by daemon that was killed
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.daemon.socket_path)
+        sock.close()
+        # pylint: disable=protected-access
+        server = self.daemon._listen()
+        server.close()
+        os.unlink(self.daemon.socket_path)
+
+    def test_parse_command(self):
+        self.assertEqual(daemon.parse_command(['concurrency', 'download', '2']),
+                         {'cmd': 'concurrency', 'stage': 'download', 'value': '2'})
+        with self.assertRaises(ValueError):
+            daemon.parse_command(['pause'])
+
+
+class LoginHandler(BaseHTTPRequestHandler):
+    logins = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        type(self).logins += 1
+        self.send_response(302)
+        self.send_header('Set-Cookie', 'sid=secret; Path=/')
+        self.send_header('Location', '/replay')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/login':
+            self._reply(b'<form><input type="password" name="password"></form>')
+        elif 'sid=secret' not in self.headers.get('Cookie', ''):
+            self.send_response(302)
+            self.send_header('Location', '/login')
+            self.end_headers()
+        else:
+            self._reply(b'recording.mp3')
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = HTTPServer(('127.0.0.1', 0), LoginHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.conf = Config()
+        self.conf.AUTH.login = 'user'
+        self.conf.AUTH.password = 'pass'
+        self.conf.AUTH.cookie_file = os.path.join(self.tmpdir.name, 'cookies')
+        LoginHandler.logins = 0
+        session.close_session()
+
+    def tearDown(self):
+        session.close_session()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_login_once(self):
+        for _ in range(2):
+            resp = session.get_page(self.conf, self.base + '/replay', self.base + '/login')
+            self.assertEqual(resp.text, 'recording.mp3')
+        self.assertEqual(LoginHandler.logins, 1)
+        self.assertIs(session.get_session(self.conf), session.get_session(self.conf))
+
+        # new session uses cookies stored on disk
+        session.close_session()
+        resp = session.get_page(self.conf, self.base + '/replay', self.base + '/login')
+        self.assertEqual(resp.text, 'recording.mp3')
+        self.assertEqual(LoginHandler.logins, 1)
+
+    def test_expired_cookies(self):
+        session.get_page(self.conf, self.base + '/replay', self.base + '/login')
+        session.close_session()
+        self.conf.AUTH.cookie_max_age = '0'
+        session.get_page(self.conf, self.base + '/replay', self.base + '/login')
+        self.assertEqual(LoginHandler.logins, 2)
+
+    def test_missing_credentials(self):
+        self.conf.AUTH.password = ''
+        with self.assertRaises(ValueError):
+            session.get_page(self.conf, self.base + '/replay', self.base + '/login')
+
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",NAME="audio",URI="audio/chunklist.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=1280000,CODECS="avc1.66.30,mp4a.40.2",AUDIO="aac"
+chunklist_w1.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=320000,CODECS="avc1.66.30,mp4a.40.2"
+http://other/chunklist_w2.m3u8
+"""
+
+MEDIA_PLAYLIST = """#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXTINF:10.0,
+media_0.ts
+#EXTINF:9.5,
+media_1.ts
+#EXT-X-ENDLIST
+"""
+
+
+class TestHls(unittest.TestCase):
+    def test_master(self):
+        playlist = hls.Playlist(MASTER_PLAYLIST, 'http://host/replay/mp4:x.mp4/playlist.m3u8')
+        self.assertTrue(playlist.is_master)
+        self.assertEqual(playlist.variants[0].url,
+                         'http://host/replay/mp4:x.mp4/chunklist_w1.m3u8')
+        self.assertEqual(playlist.variants[0].bandwidth, 1280000)
+        self.assertEqual(playlist.variants[0].codecs, 'avc1.66.30,mp4a.40.2')
+        self.assertEqual(playlist.variants[1].url, 'http://other/chunklist_w2.m3u8')
+        self.assertEqual(playlist.renditions[0].type, 'AUDIO')
+        self.assertEqual(playlist.renditions[0].url,
+                         'http://host/replay/mp4:x.mp4/audio/chunklist.m3u8')
+
+    def test_media(self):
+        playlist = hls.Playlist(MEDIA_PLAYLIST, 'http://host/a/chunklist.m3u8')
+        self.assertFalse(playlist.is_master)
+        self.assertEqual(playlist.duration, 19.5)
+        self.assertEqual(playlist.segment_urls[1], 'http://host/a/media_1.ts')
+
+    def test_select_rendition(self):
+        playlist = hls.Playlist(MASTER_PLAYLIST, 'http://host/replay/mp4:x.mp4/playlist.m3u8')
+        self.assertEqual(hls.select_rendition(playlist, 'audio')[0],
+                         'http://host/replay/mp4:x.mp4/audio/chunklist.m3u8')
+        self.assertEqual(hls.select_rendition(playlist, 'lowest')[0],
+                         'http://other/chunklist_w2.m3u8')
+        self.assertEqual(hls.select_rendition(playlist, 'highest')[0],
+                         'http://host/replay/mp4:x.mp4/chunklist_w1.m3u8')
+        self.assertEqual(hls.select_rendition(playlist, 'highest', 1000000)[0],
+                         'http://other/chunklist_w2.m3u8')
+        self.assertEqual(hls.select_rendition(playlist, 'master'), (None, ''))
+        with self.assertRaises(ValueError):
+            hls.select_rendition(playlist, 'foo')
+
+        # no audio rendition, audio-only variant is used
+        playlist = hls.Playlist(MASTER_PLAYLIST.replace('TYPE=AUDIO', 'TYPE=SUBTITLES') +
+                                '#EXT-X-STREAM-INF:BANDWIDTH=640000,CODECS="mp4a.40.2"\n'
+                                'audio.m3u8\n', 'http://host/')
+        self.assertEqual(hls.select_rendition(playlist, 'audio')[0], 'http://host/audio.m3u8')
+
+
+class TestPlanner(unittest.TestCase):
+    def test_recording_name(self):
+        self.assertEqual(recording_name('rtmp://dir/20151205_TS.mp3'), '20151205_TS')
+        self.assertEqual(recording_name('http://h/replay/mp4:20151205_TS.mp4/playlist.m3u8'),
+                         '20151205_TS')
+
+    def test_predict_makespan(self):
+        self.assertEqual(planner.predict_makespan([], 3), 0)
+        self.assertEqual(planner.predict_makespan([5, 4, 3, 3], 2), 8)
+        self.assertEqual(planner.predict_makespan([2, 1, 1], 2), 2)
+        self.assertEqual(planner.predict_makespan([1, 1, 2], 2), 3)
+
+    def test_history(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hist = planner.History(os.path.join(tmpdir, 'hist.json'))
+            self.assertIsNone(hist.speed_ratio())
+            hist.update('a', duration=10, media=100)
+            hist.update('a', duration=20)
+            self.assertEqual(hist.get('a'), 15)
+            self.assertEqual(hist.speed_ratio(), 0.15)
+            hist.save()
+            self.assertEqual(planner.History(hist.path).get('a'), 15)
+
+    def test_plan(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conf = Config()
+            conf.PLANNER.history_file = os.path.join(tmpdir, 'hist.json')
+            plan = planner.Planner(conf, 2)
+            for name, duration in (('short', 1), ('long', 10), ('mid', 5)):
+                plan.history.update(name, duration=duration)
+            to_do = plan.plan(Download.parse_todownload_list(
+                ['short.mp3', 'unknown.mp3', 'long.mp3', 'mid.mp3']))
+            # the longest one is on top of the stack
+            self.assertEqual([rec[0].path for rec in reversed(to_do)],
+                             ['rtmp://long.mp3', 'rtmp://mid.mp3', 'rtmp://unknown.mp3',
+                              'rtmp://short.mp3'])
+            self.assertEqual(plan.predicted, 11)
+
+            plan.start()
+            plan.finished(to_do[-1], 0, 12)
+            self.assertEqual(plan.history.get('long'), 11)
+            self.assertIsNotNone(plan.actual())
+
+    def test_plan_window(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conf = Config()
+            conf.PLANNER.history_file = os.path.join(tmpdir, 'hist.json')
+            conf.PLANNER.window = '2'
+            plan = planner.Planner(conf, 1)
+            for name, duration in (('a', 1), ('b', 2), ('c', 3), ('d', 4), ('e', 5)):
+                plan.history.update(name, duration=duration)
+            spool = SpoolFile(os.path.join(tmpdir, 'spool'))
+            queue = TodoQueue(['a.mp3', 'b.mp3', 'c.mp3', 'd.mp3', 'e.mp3'],
+                              Download.parse_line, spool=spool)
+            queue.chunk_size = 1
+            to_do = plan.plan(queue)
+            # only the first window was read
+            self.assertEqual(spool.source_lines, 2)
+            self.assertFalse(plan.complete)
+            self.assertEqual(plan.predicted, 3)
+            order = []
+            while len(to_do):
+                file_record = to_do.pop()
+                order.append(file_record[0].path)
+                to_do.done(file_record)
+            self.assertEqual(order, ['rtmp://b.mp3', 'rtmp://a.mp3', 'rtmp://d.mp3',
+                                     'rtmp://c.mp3', 'rtmp://e.mp3'])
+            self.assertTrue(plan.complete)
+            self.assertEqual(plan.predicted, 15)
+            self.assertEqual(len(spool), 0)
+            spool.close()
+
+    def test_probe_size(self):
+        server = ThreadingServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                conf = Config()
+                conf.PLANNER.history_file = os.path.join(tmpdir, 'hist.json')
+                plan = planner.Planner(conf, 1)
+                url = 'http://127.0.0.1:{}/files/rec.mp3'.format(server.server_port)
+                file_record = FileRecord(Fileinfo(url, Rtypes.HTTPFILE))
+                self.assertEqual(plan.probe(file_record), (None, len(RangeHandler.body)))
+                self.assertEqual(plan.estimate(file_record, None, 1024 * 1024), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            session.close_session()
+
+
+class TestSimulate(unittest.TestCase):
+    def test_simulate(self):
+        jobs = [simulate.Job('a', 100, 10, 1), simulate.Job('b', 100, 10, 1),
+                simulate.Job('c', 100, 10, 1)]
+        res = simulate.simulate(jobs, 1, 1, 1000, tick=0)
+        self.assertEqual(res.makespan, 31)
+        res = simulate.simulate(jobs, 3, 1, 1000, tick=0)
+        self.assertEqual(res.makespan, 13)
+        self.assertEqual(res.download_util, 30 / 39)
+        self.assertEqual(res.peak_disk, 300)
+
+    def test_bandwidth(self):
+        jobs = [simulate.Job('a', 1000, None, 0), simulate.Job('b', 1000, None, 0)]
+        self.assertEqual(simulate.simulate(jobs, 1, 1, 100, tick=0).makespan, 20)
+        self.assertEqual(
+            simulate.simulate(jobs, 2, 1, 100, job_bandwidth=50, tick=0).makespan, 20)
+        # delay of the main loop
+        jobs = [simulate.Job('a', 100, None, 0), simulate.Job('b', 100, None, 0)]
+        self.assertEqual(simulate.simulate(jobs, 1, 1, 100, tick=3).makespan, 6)
+
+    def test_sweep(self):
+        jobs = simulate.synthetic_jobs(20, 1000, extract_rate=1000)
+        results = simulate.sweep(jobs, [1, 2], 100, extract_slots=[1])
+        self.assertEqual([(res.download_slots, res.extract_slots) for res in results],
+                         [(1, 1), (2, 1)])
+        self.assertIn('makespan', simulate.format_results(results))
+
+    def test_jobs_from_log(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, 'log')
+            log.log_init(logfile)
+            log.logit('finished', job=1, stage='download', file='a.flv', duration=5,
+                      size=300, retcode=0)
+            log.logit('finished', job=2, stage='download', file='b.flv', duration=6,
+                      retcode=1)
+            log.logit('finished', job=1, stage='extract_audio', file='a.mp3', duration=2,
+                      retcode=0)
+            log.log_shutdown()
+            self.assertEqual(simulate.jobs_from_log(logfile),
+                             [simulate.Job('a.flv', 300, 5, 2)])
+            self.assertEqual(simulate.simulate(simulate.jobs_from_log(logfile), 1, 1, 100,
+                                               tick=0).peak_disk, 300)
+
+    def test_invalid_concurrency(self):
+        jobs = [simulate.Job('a', 100, 10, 1)]
+        with self.assertRaises(ValueError):
+            simulate.simulate(jobs, 0, 1, 1000)
+        with self.assertRaises(ValueError):
+            simulate.sweep(jobs, [1, 0], 1000)
+        with self.assertRaises(ValueError):
+            simulate.sweep(jobs, [1], 1000, extract_slots=[0])
+
+    def test_abstract_stage(self):
+        with self.assertRaises(TypeError):
+            simulate.SimStage('stage', None, [])
+
+
+class TestStages(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.conf = Config()
+        self.conf.COMMANDS.rtmpdump = '/bin/true'
+        self.conf.COMMANDS.ffmpeg = '/bin/true'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _records(self):
+        records = []
+        for name in ('a', 'b'):
+            path = os.path.join(self.tmpdir.name, name + '.flv')
+            open(path, 'w').close()
+            file_record = FileRecord(Fileinfo('rtmp://' + name, Rtypes.RTMP))
+            file_record.add(Fileinfo(path, Ftypes.FLV))
+            file_record.add(Fileinfo(path + '.mp3', Ftypes.MP3))
+            records.append(file_record)
+        return records
+
+    def test_build_pipeline(self):
+        work, tasks = stages.build_pipeline(
+            self.conf, ['download', 'extract_audio', 'cleanup'], [],
+            {'work_dir': '', 'destination': '', 'concurrency': 2})
+        self.assertEqual(list(tasks), ['download', 'extract_audio', 'cleanup'])
+        self.assertIsInstance(tasks['download'], ProcScheduler)
+        self.assertEqual(tasks['download'].max_slots, 2)
+        self.assertIsInstance(tasks['cleanup'], Cleanup)
+        self.assertIs(tasks['extract_audio'].to_do, tasks['download'].obj.finished_ready)
+        self.assertEqual(len(work.pipeline), 4)
+
+    def test_concurrency_override(self):
+        self.conf.DOWNLOAD.concurrency = '5'
+        context = {'work_dir': '', 'destination': '', 'concurrency': 2}
+        tasks = stages.build_pipeline(self.conf, ['download'], [], context)[1]
+        self.assertEqual(tasks['download'].max_slots, 5)
+        # e.g. '-p' on command line wins over the config file
+        context['concurrency_override'] = 3
+        tasks = stages.build_pipeline(self.conf, ['download'], [], context)[1]
+        self.assertEqual(tasks['download'].max_slots, 3)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            stages.get_stage('foo')
+        self.conf.DOWNLOAD.backend = 'thread'
+        with self.assertRaises(ValueError):
+            stages.build_pipeline(self.conf, ['download'], [], {'concurrency': 1})
+
+    def test_thread_backend(self):
+        self.conf.CLEANUP.backend = 'thread'
+        self.conf.CLEANUP.concurrency = '2'
+        records = self._records()
+        work, tasks = stages.build_pipeline(self.conf, ['cleanup'], list(records),
+                                            {'concurrency': 1})
+        self.assertIsNotNone(tasks['cleanup'].obj.executor)
+        for _ in range(100):
+            if all(task() for task in work):
+                break
+            time.sleep(0.01)
+        tasks['cleanup'].obj.executor.shutdown()
+        for file_record in records:
+            self.assertFalse(os.path.exists(file_record[1].path))
+        self.assertEqual(len(tasks['cleanup'].obj.out[MsgTypes.finished]), 2)
+
+    def test_inline_backend(self):
+        records = self._records()
+        cleaning = Cleanup(list(records))
+        self.assertTrue(cleaning())
+        self.assertEqual(len(cleaning.finished_ready), 2)
+        for file_record in records:
+            self.assertFalse(os.path.exists(file_record[1].path))
+
+
+def make_flv(frames, sound_format=2, video=True):
+    """Returns FLV file with audio tags containing 'frames'."""
+    def tag(tag_type, data):
+        header = bytes([tag_type]) + len(data).to_bytes(3, 'big') + bytes(7)
+        return header + data + (len(data) + 11).to_bytes(4, 'big')
+
+    out = b'FLV\x01\x05' + (9).to_bytes(4, 'big') + bytes(4)
+    out += tag(18, b'metadata')
+    for frame in frames:
+        if video:
+            out += tag(9, b'\x17video')
+        out += tag(8, bytes([(sound_format << 4) | 0x0f]) + frame)
+    return out
+
+
+class TestFlv(unittest.TestCase):
+    frames = [b'\xff\xfb' + bytes([num]) * 100 for num in range(20)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'rec.flv')
+        self.dest = os.path.join(self.tmpdir.name, 'rec.mp3')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_src(self, data):
+        with open(self.src, 'wb') as ofl:
+            ofl.write(data)
+
+    def test_extract_mp3_file(self):
+        self.write_src(make_flv(self.frames))
+        written = flv.extract_mp3_file(self.src, self.dest)
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), b''.join(self.frames))
+        self.assertEqual(written, sum(len(frame) for frame in self.frames))
+
+    def test_extract_mp3_file_unsupported(self):
+        # AAC audio
+        self.write_src(make_flv(self.frames, sound_format=10))
+        with self.assertRaises(UnsupportedCodec):
+            flv.extract_mp3_file(self.src, self.dest)
+        self.assertFalse(os.path.exists(self.dest))
+        self.write_src(b'not a flv file')
+        with self.assertRaises(UnsupportedCodec):
+            flv.extract_mp3_file(self.src, self.dest)
+
+    def test_extract_mp3_stream(self):
+        self.write_src(make_flv(self.frames))
+        with open(self.src, 'rb') as ifl, open(self.dest, 'wb') as ofl:
+            flv.extract_mp3(ifl, ofl)
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), b''.join(self.frames))
+
+    def test_extract_mp3_stream_fallback(self):
+        data = make_flv(self.frames, sound_format=10)
+        self.write_src(data)
+        fallback_path = os.path.join(self.tmpdir.name, 'copy.flv')
+        with open(self.src, 'rb') as ifl, open(self.dest, 'wb') as ofl, \
+                open(fallback_path, 'wb') as fallback:
+            self.assertEqual(flv.extract_mp3(ifl, ofl, lambda: fallback), -1)
+        with open(fallback_path, 'rb') as ifl:
+            self.assertEqual(ifl.read(), data)
+
+    def test_demux_proc(self):
+        self.write_src(make_flv(self.frames))
+        fallback = Fileinfo(os.path.join(self.tmpdir.name, 'out.flv'), Ftypes.FLV)
+        proc = DemuxProc(['cat', self.src], self.dest, fallback)
+        while proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(proc.returncode, 0)
+        self.assertIsNone(proc.fileinfo)
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), b''.join(self.frames))
+
+    def test_demux_proc_fallback(self):
+        data = make_flv(self.frames, sound_format=10)
+        self.write_src(data)
+        fallback = Fileinfo(os.path.join(self.tmpdir.name, 'out.flv'), Ftypes.FLV)
+        proc = DemuxProc(['cat', self.src], self.dest, fallback)
+        while proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(proc.fileinfo, fallback)
+        self.assertFalse(os.path.exists(self.dest))
+        with open(fallback.path + '.part', 'rb') as ifl:
+            self.assertEqual(ifl.read(), data)
+
+    def script(self, name, body):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as ofl:
+            ofl.write('#!/bin/sh\nfor out; do :; done\n' + body + '\n')
+        os.chmod(path, 0o755)
+        return path
+
+    def test_pipe_proc(self):
+        self.write_src(b'stream data')
+        proc = PipeProc(['cat', self.src], ['sh', '-c', 'tr a-z A-Z > "$0"', self.dest])
+        while proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(proc.returncodes, (0, 0))
+        self.assertEqual(proc.communicate(), (b'', b''))
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), b'STREAM DATA')
+
+    def test_pipe_proc_failed(self):
+        # failed extracting kills the download
+        proc = PipeProc(['sh', '-c', 'echo data; exec sleep 60'], ['sh', '-c', 'exit 3'])
+        deadline = time.time() + 10
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(proc.returncode, 3)
+        self.assertEqual(proc.returncodes[1], 3)
+        self.assertNotEqual(proc.returncodes[0], 0)
+        self.assertTrue(proc.extract_failed)
+        # failed download ends input of the extracting command
+        proc = PipeProc(['sh', '-c', 'echo error >&2; exit 1'], ['cat'])
+        while proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(proc.returncodes, (1, 0))
+        self.assertFalse(proc.extract_failed)
+        self.assertEqual(proc.communicate()[1], b'error\n')
+
+    def test_download_ffmpeg_stream(self):
+        conf = Config()
+        conf.RTMP.stream = 'ffmpeg'
+        conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'test "$out" = - && echo mp3')
+        conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'cat > "$out"')
+        work_dir = os.path.join(self.tmpdir.name, 'work')
+        downloads = Download(conf, [], destination=work_dir, audio_destination=self.tmpdir.name)
+        proc_info = downloads.spawn(FileRecord(Fileinfo('rtmp://rec.mp3', Rtypes.RTMP)))
+        self.assertIsInstance(proc_info.proc, PipeProc)
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(downloads.finished_handler(proc_info), 0)
+        self.assertEqual(proc_info.file_record[-1].type, Ftypes.MP3)
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), b'mp3\n')
+        self.assertEqual(os.listdir(work_dir), [])
+
+    def test_download_ffmpeg_stream_fallback(self):
+        conf = Config()
+        conf.RTMP.stream = 'ffmpeg'
+        conf.COMMANDS.rtmpdump = self.script(
+            'rtmpdump', 'if [ "$out" = - ]; then exec sleep 60; else echo flv > "$out"; fi')
+        # e.g. the audio is AAC
+        conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'exit 1')
+        work_dir = os.path.join(self.tmpdir.name, 'work')
+        to_do = []
+        downloads = Download(conf, to_do, destination=work_dir,
+                             audio_destination=self.tmpdir.name)
+        proc_info = downloads.spawn(FileRecord(Fileinfo('rtmp://rec.mp3', Rtypes.RTMP)))
+        deadline = time.time() + 10
+        while proc_info.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(proc_info.proc.extract_failed)
+        self.assertNotEqual(downloads.finished_handler(proc_info), 0)
+        self.assertEqual(downloads.out[MsgTypes.failed].msglist, [])
+        self.assertEqual(to_do, [proc_info.file_record])
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+        proc_info = downloads.spawn(to_do.pop())
+        self.assertNotIsInstance(proc_info.proc, PipeProc)
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(downloads.finished_handler(proc_info), 0)
+        self.assertEqual(proc_info.file_record[-1],
+                         Fileinfo(os.path.join(work_dir, 'rec.flv'), Ftypes.FLV, 'Download',
+                                  Ftypes.MP3))
+
+    def test_extract_audio_native(self):
+        self.write_src(make_flv(self.frames))
+        conf = Config()
+        conf.COMMANDS.ffmpeg = '/bin/true'
+        extracting = ExtractAudio(conf, [], destination=self.tmpdir.name)
+        file_record = FileRecord(Fileinfo(self.src, Ftypes.FLV, audio_f=Ftypes.MP3))
+        proc_info = extracting.spawn(file_record)
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(extracting.finished_handler(proc_info), 0)
+        self.assertEqual(extracting.finished_ready, [file_record])
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), b''.join(self.frames))
+
+    def test_extract_audio_native_broken(self):
+        # empty file can't be memory-mapped, ffmpeg is used instead
+        self.write_src(b'')
+        conf = Config()
+        conf.COMMANDS.ffmpeg = '/bin/true'
+        to_do = []
+        extracting = ExtractAudio(conf, to_do, destination=self.tmpdir.name)
+        file_record = FileRecord(Fileinfo(self.src, Ftypes.FLV, audio_f=Ftypes.MP3))
+        proc_info = extracting.spawn(file_record)
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        self.assertNotEqual(extracting.finished_handler(proc_info), 0)
+        self.assertEqual(to_do, [file_record])
+        self.assertIsNone(extracting._native_extractor(file_record))
+
+    def test_extract_audio_ffmpeg_fallback(self):
+        self.write_src(make_flv(self.frames, sound_format=10))
+        conf = Config()
+        conf.COMMANDS.ffmpeg = '/bin/true'
+        to_do = []
+        extracting = ExtractAudio(conf, to_do, destination=self.tmpdir.name)
+        file_record = FileRecord(Fileinfo(self.src, Ftypes.FLV, audio_f=Ftypes.MP3))
+        proc_info = extracting.spawn(file_record)
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        extracting.finished_handler(proc_info)
+        # requeued for ffmpeg
+        self.assertEqual(to_do, [file_record])
+        self.assertEqual(len(file_record), 1)
+        proc_info = extracting.spawn(to_do.pop())
+        self.assertIsInstance(proc_info.proc, Popen)
+        proc_info.proc.wait()
+
+
+def make_mp4(samples, chunk_runs, audio_config=b'\x12\x10'):
+    """Returns MP4 file with video track and AAC track containing 'samples'.
+
+    'chunk_runs' are (first chunk, samples per chunk) entries of 'stsc' box.
+    """
+    def box(box_type, *payload):
+        data = b''.join(payload)
+        return struct.pack('>I4s', len(data) + 8, box_type) + data
+
+    def descriptor(tag, payload):
+        return bytes([tag, len(payload)]) + payload
+
+    def trak(handler, stbl):
+        hdlr = box(b'hdlr', bytes(8), handler, bytes(13))
+        return box(b'trak', box(b'mdia', hdlr, box(b'minf', box(b'stbl', *stbl))))
+
+    # number of samples in every chunk, the last run lasts until the end
+    counts = []
+    for (first, per_chunk), (next_first, _) in zip(chunk_runs, chunk_runs[1:]):
+        counts.extend([per_chunk] * (next_first - first))
+    remaining = len(samples) - sum(counts)
+    counts.extend([chunk_runs[-1][1]] * (remaining // chunk_runs[-1][1]))
+    ftyp = box(b'ftyp', b'isom', bytes(4), b'isommp41')
+    mdat = box(b'mdat', b''.join(samples))
+    offsets = []
+    pos = len(ftyp) + 8
+    sample = 0
+    for count in counts:
+        offsets.append(pos)
+        pos += sum(len(smp) for smp in samples[sample:sample + count])
+        sample += count
+
+    esds = box(b'esds', bytes(4), descriptor(3, b'\x00\x01\x00' + descriptor(
+        4, b'\x40\x15' + bytes(11) + descriptor(5, audio_config))))
+    mp4a = box(b'mp4a', bytes(6), b'\x00\x01', bytes(8), b'\x00\x02\x00\x10', bytes(4),
+               struct.pack('>I', 44100 << 16), esds)
+    stsd = box(b'stsd', bytes(4), struct.pack('>I', 1), mp4a)
+    stsz = box(b'stsz', bytes(4), struct.pack('>II', 0, len(samples)),
+               *(struct.pack('>I', len(smp)) for smp in samples))
+    stsc = box(b'stsc', bytes(4), struct.pack('>I', len(chunk_runs)),
+               *(struct.pack('>III', first, per_chunk, 1) for first, per_chunk in chunk_runs))
+    stco = box(b'stco', bytes(4), struct.pack('>I', len(offsets)),
+               *(struct.pack('>I', offset) for offset in offsets))
+    video = trak(b'vide', [box(b'stsd', bytes(8))])
+    audio = trak(b'soun', [stsd, stsz, stsc, stco])
+    return ftyp + mdat + box(b'moov', box(b'mvhd', bytes(100)), video, audio)
+
+
+class TestMp4(unittest.TestCase):
+    # ADTS header of AAC LC, 44.1 kHz, stereo, 100 bytes of raw data
+    header = b'\xff\xf1\x50\x80\x0d\x7f\xfc'
+    samples = [bytes([num]) * 100 for num in range(10)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'rec.mp4')
+        self.dest = os.path.join(self.tmpdir.name, 'rec.aac')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_src(self, data):
+        with open(self.src, 'wb') as ofl:
+            ofl.write(data)
+
+    def test_extract_aac_file(self):
+        self.write_src(make_mp4(self.samples, [(1, 3), (3, 2)]))
+        written = mp4.extract_aac_file(self.src, self.dest)
+        expected = b''.join(self.header + smp for smp in self.samples)
+        with open(self.dest, 'rb') as ifl:
+            self.assertEqual(ifl.read(), expected)
+        self.assertEqual(written, len(expected))
+
+    def test_parse_audio_config(self):
+        # AAC LC, 44.1 kHz, stereo
+        self.assertEqual(mp4.parse_audio_config(b'\x12\x10'), (1, 4, 2))
+        # HE-AAC with explicit SBR: 24 kHz core, 48 kHz extension, mono
+        self.assertEqual(mp4.parse_audio_config(b'\x2b\x09\x88\x00'), (1, 6, 1))
+
+    def test_unsupported(self):
+        # AAC LD can't be described by ADTS header
+        self.write_src(make_mp4(self.samples, [(1, 5)], audio_config=b'\xbb\x90'))
+        with self.assertRaises(UnsupportedCodec):
+            mp4.extract_aac_file(self.src, self.dest)
+        self.assertFalse(os.path.exists(self.dest))
+        self.write_src(b'not a mp4 file')
+        with self.assertRaises(UnsupportedCodec):
+            mp4.extract_aac_file(self.src, self.dest)
+        # parser errors of broken files
+        self.write_src(b'')
+        with self.assertRaises(UnsupportedCodec):
+            mp4.extract_aac_file(self.src, self.dest)
+        data = bytearray(make_mp4(self.samples, [(1, 5)]))
+        # sample count in 'stsz' box larger than the file
+        pos = data.index(b'stsz')
+        data[pos + 8:pos + 16] = struct.pack('>II', 0, 0xffffff)
+        self.write_src(bytes(data))
+        with self.assertRaises(UnsupportedCodec):
+            mp4.extract_aac_file(self.src, self.dest)
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_extract_audio_native(self):
+        self.write_src(make_mp4(self.samples, [(1, 5)]))
+        conf = Config()
+        conf.COMMANDS.ffmpeg = '/bin/true'
+        extracting = ExtractAudio(conf, [], destination=self.tmpdir.name)
+        file_record = FileRecord(Fileinfo(self.src, Ftypes.MP4, audio_f=Ftypes.AAC))
+        proc_info = extracting.spawn(file_record)
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(extracting.finished_handler(proc_info), 0)
+        self.assertEqual(file_record[-1].path, self.dest)
+        self.assertEqual(os.path.getsize(self.dest), 107 * len(self.samples))
+
+    @unittest.skipUnless(shutil.which('ffmpeg'), 'ffmpeg is not installed')
+    def test_same_as_ffmpeg(self):
+        ret = call(['ffmpeg', '-f', 'lavfi', '-i', 'sine=duration=3', '-f', 'lavfi',
+                    '-i', 'testsrc=duration=3:size=64x64', '-c:a', 'aac', self.src],
+                   stdout=DEVNULL, stderr=DEVNULL)
+        self.assertEqual(ret, 0)
+        ffmpeg_out = os.path.join(self.tmpdir.name, 'ffmpeg.aac')
+        call(['ffmpeg', '-i', self.src, '-vn', '-acodec', 'copy', ffmpeg_out],
+             stdout=DEVNULL, stderr=DEVNULL)
+        mp4.extract_aac_file(self.src, self.dest)
+        with open(self.dest, 'rb') as ifl, open(ffmpeg_out, 'rb') as ffl:
+            self.assertEqual(ifl.read(), ffl.read())
+
+
+class TestExtractBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.conf = Config()
+        self.conf.EXTRACT.native = 'no'
+        self.conf.EXTRACT.batch_size = '3'
+        self.conf.COMMANDS.ffmpeg = '/bin/true'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def records(self, names, ftype=Ftypes.FLV, audio_f=Ftypes.MP3):
+        return [FileRecord(Fileinfo(os.path.join(self.tmpdir.name, name), ftype,
+                                    audio_f=audio_f)) for name in names]
+
+    def finish(self, extracting, proc_info):
+        proc_info.proc.wait()
+        return extracting.finished_handler(proc_info)
+
+    def test_batch(self):
+        # the last one is not MP3 and can't be in the same batch
+        to_do = self.records(['d.mp4'], Ftypes.MP4, Ftypes.AAC) + self.records(
+            ['c.flv', 'b.flv', 'a.flv'])
+        first = to_do.pop()
+        extracting = ExtractAudio(self.conf, to_do, destination=self.tmpdir.name)
+        proc_info = extracting.spawn(first)
+        self.assertEqual(proc_info.proc.args.count('-i'), 3)
+        self.assertEqual(len(to_do), 1)
+        self.assertEqual(self.finish(extracting, proc_info), 0)
+        self.assertEqual([rec[-1].path for rec in extracting.finished_ready],
+                         [os.path.join(self.tmpdir.name, name)
+                          for name in ('a.mp3', 'b.mp3', 'c.mp3')])
+        self.assertEqual(len(extracting.out[MsgTypes.finished].msglist), 3)
+
+    def test_batch_failure(self):
+        # like ffmpeg, every input that was opened is in the error output
+        ffmpeg = os.path.join(self.tmpdir.name, 'ffmpeg')
+        with open(ffmpeg, 'w') as ofl:
+            ofl.write('#!/bin/sh\nnum=0\nprev=\nstatus=0\nfor arg; do\n'
+                      '  if [ "$prev" = -i ]; then\n'
+                      '    echo "Input #$num, flv, from \'$arg\':" >&2\n'
+                      '    num=$((num + 1))\n'
+                      '    case "$arg" in *b.flv) status=1;; esac\n'
+                      '  fi\n  prev=$arg\ndone\n'
+                      '[ $status = 0 ] || echo "Error while decoding stream #1:0" >&2\n'
+                      'exit $status\n')
+        os.chmod(ffmpeg, 0o755)
+        self.conf.COMMANDS.ffmpeg = ffmpeg
+        to_do = self.records(['c.flv', 'b.flv', 'a.flv'])
+        extracting = ExtractAudio(self.conf, to_do, destination=self.tmpdir.name)
+        proc_info = extracting.spawn(to_do.pop())
+        self.assertEqual(proc_info.proc.args.count('-i'), 3)
+        self.assertEqual(self.finish(extracting, proc_info), 1)
+        # nothing is failed by the batch, all files are extracted separately
+        self.assertEqual(extracting.out[MsgTypes.failed].msglist, [])
+        self.assertEqual(sorted(rec[-1].path for rec in to_do),
+                         [os.path.join(self.tmpdir.name, name)
+                          for name in ('a.flv', 'b.flv', 'c.flv')])
+        retcodes = {}
+        while to_do:
+            proc_info = extracting.spawn(to_do.pop())
+            self.assertEqual(proc_info.proc.args.count('-i'), 1)
+            name = os.path.basename(proc_info.file_record[-2].path)
+            retcodes[name] = self.finish(extracting, proc_info)
+        self.assertEqual(retcodes, {'a.flv': 0, 'b.flv': 1, 'c.flv': 0})
+        self.assertEqual([msg for msg, _ in extracting.out[MsgTypes.failed].msglist],
+                         [os.path.join(self.tmpdir.name, 'b.mp3')])
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tracefile = os.path.join(self.tmpdir.name, 'trace.json')
+
+    def tearDown(self):
+        trace.trace_shutdown()
+        self.tmpdir.cleanup()
+
+    def test_disabled(self):
+        self.assertFalse(trace.enabled())
+        with trace.span('foo', 'bar'):
+            pass
+        trace.counter('foo', num=1)
+        trace.trace_shutdown()
+        self.assertFalse(os.path.exists(self.tracefile))
+
+    def test_pipeline_trace(self):
+        # the extraction must still run when the main loop records counters
+        ffmpeg = os.path.join(self.tmpdir.name, 'ffmpeg')
+        with open(ffmpeg, 'w') as ofl:
+            ofl.write('#!/bin/sh\nsleep 0.2\n')
+        os.chmod(ffmpeg, 0o755)
+        conf = Config()
+        conf.COMMANDS.ffmpeg = ffmpeg
+        conf.EXTRACT.native = 'no'
+        to_do = [FileRecord(Fileinfo(os.path.join(self.tmpdir.name, name), Ftypes.FLV,
+                                     audio_f=Ftypes.MP3)) for name in ('a.flv', 'b.flv')]
+        context = {'work_dir': '', 'destination': self.tmpdir.name, 'concurrency': 1}
+        work, _ = stages.build_pipeline(conf, ['extract_audio', 'cleanup'], to_do, context)
+
+        trace.trace_init(self.tracefile)
+        delay = perform.LOOP_DELAY
+        perform.LOOP_DELAY = 0.01
+        try:
+            perform.do_the_work(work, lambda: None)
+        finally:
+            perform.LOOP_DELAY = delay
+        # jobs that went through the pipeline are forgotten
+        self.assertEqual(trace._QUEUED, {})
+        self.assertEqual(trace._NAMED, {trace.MAIN_TID})
+        trace.trace_shutdown()
+
+        with open(self.tracefile) as ifl:
+            events = json.load(ifl)['traceEvents']
+        job_spans = {}
+        for event in events:
+            if event['ph'] == 'X' and event['tid'] != trace.MAIN_TID:
+                job_spans.setdefault(event['tid'], []).append((event['cat'], event['name']))
+        self.assertEqual(len(job_spans), 2)
+        for spans in job_spans.values():
+            self.assertEqual(spans, [('ExtractAudio', 'queue'), ('ExtractAudio', 'spawn'),
+                                     ('ExtractAudio', 'run'), ('ExtractAudio', 'finish'),
+                                     ('Cleanup', 'queue'), ('Cleanup', 'cleanup')])
+        main_spans = {event['name'] for event in events
+                      if event['ph'] == 'X' and event['tid'] == trace.MAIN_TID}
+        self.assertEqual(main_spans, {'ExtractAudio', 'Cleanup', 'Discard', 'sleep'})
+        counters = [event['args'] for event in events if event['ph'] == 'C']
+        self.assertIn({'running': 1, 'queued': 1}, counters)
+        self.assertEqual(counters[-1], {'running': 0, 'queued': 0})
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    cookies = []
+
+    def do_GET(self):
+        self.cookies.append(self.headers.get('Cookie'))
+        time.sleep(self.delay)
+        body = bytes(65536)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowMirrorHandler(MirrorHandler):
+    delay = 0.3
+
+
+class TestMirrors(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        self.fast = self.start_server(MirrorHandler)
+        self.slow = self.start_server(SlowMirrorHandler)
+        # nothing listens there
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.dead = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+        sock.close()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.conf = Config()
+        self.conf.AUTH.cookie_file = os.path.join(self.tmpdir.name, 'cookies')
+        session.close_session()
+
+    def tearDown(self):
+        session.close_session()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.tmpdir.cleanup()
+
+    def start_server(self, handler):
+        server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def test_probe_and_caps(self):
+        pool = mirrors.MirrorPool([self.dead, self.slow, self.fast], max_jobs=1,
+                                  probe_timeout=2, conf=self.conf)
+        pool.probe_all()
+        self.assertFalse(pool.mirrors[0].reachable)
+        self.assertGreater(pool.mirrors[2].throughput, pool.mirrors[1].throughput)
+        self.assertEqual(pool.acquire().url, self.fast)
+        self.assertEqual(pool.acquire().url, self.slow)
+        # the unreachable mirror is not used
+        self.assertFalse(pool.available())
+        self.assertIsNone(pool.acquire())
+        pool.release(pool.mirrors[2], True)
+        self.assertEqual(pool.acquire().url, self.fast)
+
+    def test_demote(self):
+        clock = FakeClock()
+        pool = mirrors.MirrorPool(['http://first', 'http://second'], max_failures=2,
+                                  demote_time=100, clock=clock)
+        for _ in range(2):
+            mirror = pool.acquire()
+            self.assertEqual(mirror.url, 'http://first')
+            pool.release(mirror, False)
+        self.assertEqual(pool.acquire().url, 'http://second')
+        clock.now += 100
+        self.assertEqual(pool.acquire().url, 'http://first')
+
+    def test_probe_session(self):
+        # the mirror is probed with headers (and proxy settings) of the session
+        ses = session.get_session(self.conf)
+        ses.headers['Cookie'] = 'login=yes'
+        del MirrorHandler.cookies[:]
+        pool = mirrors.MirrorPool([self.fast, self.dead], probe_timeout=2, conf=self.conf)
+        pool.probe_all()
+        self.assertEqual(MirrorHandler.cookies, ['login=yes'])
+        self.assertIsNotNone(pool.mirrors[0].latency)
+        self.assertTrue(pool.mirrors[0].throughput)
+
+    def test_download_from_mirror(self):
+        conf = self.conf
+        conf.COMMANDS.ffmpeg = '/bin/true'
+        conf.HTTP.mirrors = '{}, {}'.format(self.slow, self.fast)
+        conf.MIRRORS.max_jobs = '1'
+        to_do = [FileRecord(Fileinfo('http://replay/mp4:{}.mp4/playlist.m3u8'.format(name),
+                                     Rtypes.HTTP)) for name in ('b', 'a')]
+        context = {'work_dir': self.tmpdir.name, 'destination': '', 'concurrency': 3}
+        downloads = Download.create(conf, to_do, context)
+        pool = downloads.mirrors[Rtypes.HTTP]
+
+        procs = []
+        while len(to_do) > 0 and downloads.can_spawn():
+            procs.append(downloads.spawn(to_do.pop()))
+        self.assertEqual([proc_info.proc.args[2] for proc_info in procs],
+                         [self.fast + '/mp4:a.mp4/playlist.m3u8',
+                          self.slow + '/mp4:b.mp4/playlist.m3u8'])
+        to_do.append(FileRecord(Fileinfo('http://replay/mp4:c.mp4/playlist.m3u8',
+                                         Rtypes.HTTP)))
+        # all mirrors are busy
+        self.assertFalse(downloads.can_spawn())
+
+        for proc_info in procs:
+            proc_info.proc.wait()
+            downloads.finished_handler(proc_info)
+        # the .part files don't exist, so the downloads failed
+        self.assertEqual([mirror.active for mirror in pool.mirrors], [0, 0])
+        self.assertEqual([mirror.failures for mirror in pool.mirrors], [1, 1])
+        self.assertTrue(downloads.can_spawn())
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    body = bytes(range(256)) * 4096
+    supports_ranges = True
+    requests = []
+
+    def send_body(self, head=False):
+        self.requests.append(self.headers.get('Range'))
+        start, end = 0, len(self.body) - 1
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if match and self.supports_ranges and not head:
+            start, end = int(match.group(1)), int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end,
+                                                                      len(self.body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not head:
+            self.wfile.write(self.body[start:end + 1])
+
+    def do_HEAD(self):
+        self.send_body(head=True)
+
+    def do_GET(self):
+        self.send_body()
+
+    def log_message(self, *args):
+        pass
+
+
+class IgnoringRangeHandler(RangeHandler):
+    # advertises ranges, but always sends the whole file
+    supports_ranges = False
+
+
+class FailingRangeHandler(RangeHandler):
+    def do_GET(self):
+        if (self.headers.get('Range') or '').startswith('bytes=0-'):
+            self.requests.append(self.headers.get('Range'))
+            self.send_error(500)
+            return
+        self.send_body()
+
+
+class TestRangedDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.part = os.path.join(self.tmpdir.name, 'rec.mp3.part')
+        RangeHandler.requests = []
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        session.close_session()
+        self.tmpdir.cleanup()
+
+    def url(self, handler):
+        server = ThreadingServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return 'http://127.0.0.1:{}/files/rec.mp3'.format(server.server_port)
+
+    def read_part(self):
+        with open(self.part, 'rb') as ifl:
+            return ifl.read()
+
+    def test_split_ranges(self):
+        self.assertEqual(ranged.split_ranges(10, 4), [(0, 3), (4, 7), (8, 9)])
+
+    def test_ranges(self):
+        ses = session.get_session(Config())
+        job = ranged.RangedDownload(ses, self.url(RangeHandler), self.part, connections=3,
+                                    range_size=100000)
+        self.assertEqual(job.run(), len(RangeHandler.body))
+        self.assertEqual(self.read_part(), RangeHandler.body)
+        self.assertEqual(len([rng for rng in RangeHandler.requests if rng]), 11)
+        self.assertFalse(os.path.exists(self.part + ranged.RANGES_EXT))
+
+    def test_resume(self):
+        url = self.url(RangeHandler)
+        size = len(RangeHandler.body)
+        # the first two ranges were downloaded before
+        with open(self.part, 'wb') as ofl:
+            ofl.write(RangeHandler.body[:200000] + bytes(size - 200000))
+        with open(self.part + ranged.RANGES_EXT, 'w') as ofl:
+            json.dump({'url': url, 'size': size, 'range_size': 100000, 'done': [0, 100000]},
+                      ofl)
+        ses = session.get_session(Config())
+        job = ranged.RangedDownload(ses, url, self.part, range_size=100000)
+        job.run()
+        self.assertEqual(self.read_part(), RangeHandler.body)
+        self.assertNotIn('bytes=0-99999', RangeHandler.requests)
+        self.assertEqual(job.transferred, size - 200000)
+
+    def test_resume_other_range_size(self):
+        url = self.url(RangeHandler)
+        size = len(RangeHandler.body)
+        # the first range of 50000 bytes was downloaded before
+        with open(self.part, 'wb') as ofl:
+            ofl.write(RangeHandler.body[:50000] + bytes(size - 50000))
+        with open(self.part + ranged.RANGES_EXT, 'w') as ofl:
+            json.dump({'url': url, 'size': size, 'range_size': 50000, 'done': [0]}, ofl)
+        ses = session.get_session(Config())
+        job = ranged.RangedDownload(ses, url, self.part, range_size=100000)
+        job.run()
+        self.assertEqual(self.read_part(), RangeHandler.body)
+        self.assertEqual(job.transferred, size)
+
+    def test_failed_range(self):
+        ses = session.get_session(Config())
+        job = ranged.RangedDownload(ses, self.url(FailingRangeHandler), self.part,
+                                    connections=1, range_size=100000)
+        with self.assertRaises(EnvironmentError):
+            job.run()
+        # the other ranges are not downloaded after the first failure
+        self.assertEqual([rng for rng in RangeHandler.requests if rng], ['bytes=0-99999'])
+
+    def test_single_stream_fallback(self):
+        ses = session.get_session(Config())
+        job = ranged.RangedDownload(ses, self.url(IgnoringRangeHandler), self.part,
+                                    range_size=100000)
+        self.assertEqual(job.run(), len(RangeHandler.body))
+        self.assertEqual(self.read_part(), RangeHandler.body)
+
+    def test_download_direct_url(self):
+        conf = Config()
+        conf.HTTP.range_size = '100K'
+        url = self.url(RangeHandler)
+        file_record = Download.parse_line(url)
+        self.assertEqual(file_record[-1].type, Rtypes.HTTPFILE)
+        downloads = Download(conf, [], destination=self.tmpdir.name)
+        proc_info = downloads.spawn(file_record)
+        self.assertEqual(file_record[-1], Fileinfo(os.path.join(self.tmpdir.name, 'rec.mp3'),
+                                                   Ftypes.MP3, 'Download', Ftypes.MP3))
+        while proc_info.proc.poll() is None:
+            time.sleep(0.05)
+        self.assertEqual(downloads.finished_handler(proc_info), 0)
+        with open(file_record[-1].path, 'rb') as ifl:
+            self.assertEqual(ifl.read(), RangeHandler.body)
+        downloads.executor.shutdown()
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_check(self):
+        clock = FakeClock()
+        watchdog = Watchdog(stall_timeout=10, timeout=100, min_rate=1000, clock=clock)
+        procinfo = Procinfo(object(), None)
+        self.assertEqual(watchdog.check(procinfo, 0, 50000), '')
+        clock.now = 8
+        self.assertEqual(watchdog.check(procinfo, 100, 50000), '')
+        clock.now = 15
+        self.assertEqual(watchdog.check(procinfo, 100, 50000), '')
+        clock.now = 19
+        self.assertEqual(watchdog.check(procinfo, 100, 50000), 'stalled')
+        # hard timeout is 100 s + 50 s for expected size
+        watchdog.stall_timeout = 0
+        clock.now = 149
+        self.assertEqual(watchdog.check(procinfo, 100, 50000), '')
+        clock.now = 151
+        self.assertEqual(watchdog.check(procinfo, 100, 50000), 'timeout')
+
+    def test_kill_and_requeue(self):
+        rtmpdump = os.path.join(self.tmpdir.name, 'rtmpdump')
+        with open(rtmpdump, 'w') as ofl:
+            ofl.write('#!/bin/sh\nfor out; do :; done\nhead -c 100 /dev/zero >> "$out"\nsleep 60\n')
+        os.chmod(rtmpdump, 0o755)
+        conf = Config()
+        conf.COMMANDS.rtmpdump = rtmpdump
+        conf.DOWNLOAD.retries = '1'
+        file_record = FileRecord(Fileinfo('rtmp://foo', Rtypes.RTMP))
+        to_do = [file_record]
+        downloads = Download(conf, to_do, destination=self.tmpdir.name)
+        scheduler = ProcScheduler(downloads, 1)
+        scheduler.watchdog = Watchdog(stall_timeout=0.2)
+
+        def run_until_stalled(num):
+            deadline = time.time() + 10
+            while len(downloads.out[MsgTypes.stalled]) < num and time.time() < deadline:
+                if not scheduler.running_procs:
+                    scheduler._spawn()
+                time.sleep(0.05)
+                scheduler._check_running_procs()
+
+        run_until_stalled(1)
+        # the download was killed and returned to the queue
+        self.assertEqual(scheduler.running_procs, [])
+        self.assertEqual(to_do, [file_record])
+        self.assertEqual(len(file_record), 1)
+        self.assertEqual(len(downloads.out[MsgTypes.failed]), 0)
+        self.assertEqual(downloads._done_bytes, 100)
+
+        run_until_stalled(2)
+        # no more retries
+        self.assertEqual(to_do, [])
+        # the resumed download added to the kept .part file, its start is not counted again
+        self.assertEqual(downloads._done_bytes, 200)
+        self.assertEqual(downloads.out[MsgTypes.failed].msglist[0][0],
+                         os.path.join(self.tmpdir.name, 'foo.flv'))
+
+
+
+class TestFakeReplayServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = FakeReplayServer(recordings=3, segments=3, segment_size=10000,
+                                       media_size=50000).start()
+        self.conf = Config()
+        self.conf.AUTH.cookie_file = os.path.join(self.tmpdir.name, 'cookies')
+        self.server.configure(self.conf)
+        session.close_session()
+
+    def tearDown(self):
+        session.close_session()
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_replay_lists(self):
+        names = self.server.recordings
+        self.assertEqual(list(iter_replay_list(Rtypes.RTMP, self.conf)),
+                         [name + '.mp3' for name in names])
+        self.assertEqual(list(iter_replay_list(Rtypes.HTTP, self.conf)),
+                         [self.server.playlist_url(name) for name in names])
+        self.assertEqual(self.server.stats['login'], 1)
+        # including the redirect after login
+        self.assertEqual(self.server.stats['listing'], 4)
+
+    def test_hls(self):
+        ses = session.get_session(self.conf)
+        url = self.server.playlist_url(self.server.recordings[0])
+        master = hls.Playlist(ses.get(url).text, url)
+        self.assertTrue(master.is_master)
+        self.assertEqual([variant.bandwidth for variant in master.variants],
+                         [64000, 400000, 1200000])
+        self.assertEqual(master.renditions[0].type, 'AUDIO')
+        media = hls.Playlist(ses.get(master.variants[0].url).text, master.variants[0].url)
+        self.assertEqual(media.duration, 30)
+        segment = ses.get(media.segment_urls[-1]).content
+        self.assertEqual(len(segment), 10000)
+        self.assertEqual(segment[::188], b'\x47' * len(segment[::188]))
+
+    def test_errors_and_latency(self):
+        self.server.error_rate = 1.0
+        self.server.latency = 0.1
+        ses = session.get_session(self.conf)
+        url = self.server.playlist_url(self.server.recordings[0])
+        start = time.time()
+        response = ses.get(url.replace('playlist.m3u8', 'media_audio_0.ts'))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.server.stats['errors'], 1)
+
+    def test_download_rendition(self):
+        self.conf.COMMANDS.ffmpeg = '/bin/true'
+        url = self.server.playlist_url(self.server.recordings[0])
+        for policy, expected in (('audio', 'chunklist_audio.m3u8'),
+                                 ('highest', 'chunklist_high.m3u8'),
+                                 ('master', 'playlist.m3u8')):
+            self.conf.HTTP.rendition = policy
+            downloads = Download(self.conf, [], destination=self.tmpdir.name)
+            proc_info = downloads.spawn(Download.parse_line(url))
+            proc = proc_info.proc
+            if policy != 'master':
+                # the playlist is read in the pool of workers
+                self.assertIsInstance(proc, perform.ChainedProc)
+                proc.future.result()
+                proc.poll()
+                proc = proc.proc
+            self.assertEqual(proc.args[2], url.replace('playlist.m3u8', expected))
+            proc.wait()
+            if downloads.executor is not None:
+                downloads.executor.shutdown()
+
+    def test_chained_proc_failed(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            proc = perform.ChainedProc(executor.submit(lambda: 1 / 0), lambda res: None)
+            proc.future.exception()
+            self.assertEqual(proc.poll(), 1)
+            self.assertIn(b'ZeroDivisionError', proc.communicate()[1])
+        finally:
+            executor.shutdown()
+
+    def test_pipeline(self):
+        self.conf.HTTP.range_size = '16K'
+        to_do = [Download.parse_line(self.server.media_url(name))
+                 for name in self.server.recordings]
+        context = {'work_dir': self.tmpdir.name, 'destination': self.tmpdir.name,
+                   'concurrency': 2}
+        work, tasks = stages.build_pipeline(self.conf, ['download', 'extract_audio', 'cleanup'],
+                                            to_do, context)
+        delay = perform.LOOP_DELAY
+        perform.LOOP_DELAY = 0.01
+        try:
+            perform.do_the_work(work, lambda: None)
+        finally:
+            perform.LOOP_DELAY = delay
+        tasks['download'].obj.executor.shutdown()
+
+        self.assertEqual(len(tasks['cleanup'].out[MsgTypes.finished]), 3)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+                         sorted(name + '.mp3' for name in self.server.recordings))
+        with open(os.path.join(self.tmpdir.name, self.server.recordings[0] + '.mp3'),
+                  'rb') as ifl:
+            self.assertTrue(ifl.read().startswith(b'\xff\xfb'))
+        # every file was downloaded in several ranges
+        self.assertGreater(self.server.stats['media'], 3 * 3)
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = FakeReplayServer(recordings=3, media_size=50000).start()
+        self.conf = Config()
+        self.conf.HTTP.range_size = '16K'
+        self.events = []
+        self.delay = perform.LOOP_DELAY
+        perform.LOOP_DELAY = 0.01
+        session.close_session()
+
+    def tearDown(self):
+        perform.LOOP_DELAY = self.delay
+        session.close_session()
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_submit(self):
+        # the downloads run long enough to be seen running
+        self.server.latency = 0.02
+        with api.Pipeline(self.conf, ['download', 'extract_audio', 'cleanup'],
+                          work_dir=self.tmpdir.name, destination=self.tmpdir.name,
+                          concurrency=2, callback=self.events.append) as pipeline:
+            names = self.server.recordings
+            first = pipeline.submit([self.server.media_url(names[0]), '# comment'])
+            result = first[0].result(timeout=10)
+            self.assertEqual(result.path, os.path.join(self.tmpdir.name, names[0] + '.mp3'))
+            self.assertTrue(os.path.isfile(result.path))
+            with self.assertRaises(ValueError):
+                first[1].result(timeout=10)
+
+            # the same pipeline takes more entries
+            second = pipeline.submit([self.server.media_url(name) for name in names[1:]] +
+                                     [self.server.url + '/media/missing.flv'])
+            for future in second[:2]:
+                self.assertTrue(os.path.isfile(future.result(timeout=10).path))
+            with self.assertRaises(api.JobFailed) as err:
+                second[2].result(timeout=10)
+            self.assertEqual(err.exception.stage, 'download')
+
+        kinds = [(event.kind, event.stage) for event in self.events
+                 if event.entry == self.server.media_url(names[0])]
+        self.assertEqual(kinds[0], ('running', 'download'))
+        self.assertEqual(kinds[-1], ('finished', ''))
+        with self.assertRaises(RuntimeError):
+            pipeline.submit(['foo'])
+
+    def test_shutdown_without_waiting(self):
+        rtmpdump = os.path.join(self.tmpdir.name, 'rtmpdump')
+        with open(rtmpdump, 'w') as ofl:
+            ofl.write('#!/bin/sh\nsleep 60\n')
+        os.chmod(rtmpdump, 0o755)
+        self.conf.COMMANDS.rtmpdump = rtmpdump
+        pipeline = api.Pipeline(self.conf, ['download'], work_dir=self.tmpdir.name,
+                                concurrency=1)
+        futures = pipeline.submit(['foo.mp3', 'bar.mp3'])
+        deadline = time.time() + 10
+        while not pipeline.tasks['download'].running_procs and time.time() < deadline:
+            time.sleep(0.01)
+        start = time.time()
+        pipeline.shutdown(wait=False)
+        self.assertLess(time.time() - start, 5)
+        self.assertIsInstance(futures[0].exception(timeout=1), api.JobFailed)
+        self.assertIsInstance(futures[1].exception(timeout=1), api.JobFailed)
+        # message queues of the stages are removed
+        out = pipeline.tasks['download'].obj.out
+        for key, msglist in out.items():
+            self.assertNotIn(msglist, msgs._OUT.get(key, []))
+
+
+class TestHedge(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = FakeReplayServer(recordings=['20151205_TS_Teaching']).start()
+        self.conf = Config()
+        self.conf.AUTH.cookie_file = os.path.join(self.tmpdir.name, 'cookies')
+        self.server.configure(self.conf)
+        self.conf.DOWNLOAD.hedge = 'yes'
+        self.conf.HTTP.rendition = 'master'
+        session.close_session()
+
+    def tearDown(self):
+        session.close_session()
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def script(self, name, body):
+        """Creates command that writes to the file given by its last argument."""
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as ofl:
+            ofl.write('#!/bin/sh\nfor out; do :; done\n' + body + '\n')
+        os.chmod(path, 0o755)
+        return path
+
+    def test_source_map(self):
+        sources = hedge.SourceMap()
+        rtmp = Fileinfo('rtmp://20151205_TS.mp3', Rtypes.RTMP)
+        http = Fileinfo('http://h/replay/mp4:20151205_TS.mp4/playlist.m3u8', Rtypes.HTTP)
+        sources.add(rtmp)
+        self.assertIsNone(sources.alternative(rtmp))
+        sources.add(http)
+        self.assertEqual(sources.alternative(rtmp), http)
+        self.assertEqual(sources.alternative(http), rtmp)
+        self.assertIsNone(sources.alternative(Fileinfo('rtmp://other.mp3', Rtypes.RTMP)))
+
+    def run_download(self):
+        downloads = Download.create(self.conf, [], {'work_dir': self.tmpdir.name,
+                                                    'destination': self.tmpdir.name})
+        self.assertEqual(len(downloads.sources), 1)
+        file_record = Download.parse_line('20151205_TS_Teaching.mp3')
+        proc_info = downloads.spawn(file_record)
+        deadline = time.time() + 10
+        while proc_info.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(downloads.finished_handler(proc_info), 0)
+        return file_record
+
+    def test_fallback_on_failure(self):
+        self.conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'echo x > "$out"; exit 1')
+        self.conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'echo mp4 > "$out"')
+        file_record = self.run_download()
+        self.assertEqual(file_record[0].type, Rtypes.HTTP)
+        self.assertEqual(file_record[-1],
+                         Fileinfo(os.path.join(self.tmpdir.name, '20151205_TS_Teaching.mp4'),
+                                  Ftypes.MP4, 'Download', Ftypes.AAC))
+        self.assertTrue(os.path.isfile(file_record[-1].path))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir.name, '20151205_TS_Teaching.flv.part')))
+
+    def test_slow_source(self):
+        self.conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'echo x > "$out"; sleep 60')
+        self.conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'echo mp4 > "$out"')
+        self.conf.DOWNLOAD.hedge_min_rate = '1M'
+        self.conf.DOWNLOAD.hedge_delay = '0.2'
+        start = time.time()
+        file_record = self.run_download()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(file_record[0].type, Rtypes.HTTP)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+                         ['20151205_TS_Teaching.mp4', 'cookies', 'ffmpeg', 'rtmpdump'])
+
+    def test_fast_source_wins(self):
+        self.conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'echo flv > "$out"')
+        self.conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'exit 1')
+        file_record = self.run_download()
+        self.assertEqual(file_record[0].type, Rtypes.RTMP)
+        self.assertEqual(file_record[-1].type, Ftypes.FLV)
+
+    def run_with_mirrors(self, rtmp_failures=0):
+        """Runs hedged download, returns RTMP and HTTP mirror."""
+        self.conf.HTTP.mirrors = 'http://127.0.0.1:1'
+        downloads = Download.create(self.conf, [], {'work_dir': self.tmpdir.name,
+                                                    'destination': self.tmpdir.name})
+        rtmp_mirror = downloads.mirrors[Rtypes.RTMP].mirrors[0]
+        http_mirror = downloads.mirrors[Rtypes.HTTP].mirrors[0]
+        rtmp_mirror.failures = rtmp_failures
+        proc_info = downloads.spawn(Download.parse_line('20151205_TS_Teaching.mp3'))
+        deadline = time.time() + 10
+        while proc_info.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(downloads.finished_handler(proc_info), 0)
+        self.assertEqual((rtmp_mirror.active, http_mirror.active), (0, 0))
+        return rtmp_mirror, http_mirror
+
+    def test_mirror_outcomes(self):
+        # the primary failed, the backup succeeded
+        self.conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'echo x > "$out"; exit 1')
+        self.conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'echo mp4 > "$out"')
+        rtmp_mirror, http_mirror = self.run_with_mirrors()
+        self.assertEqual(rtmp_mirror.failures, 1)
+        self.assertEqual(http_mirror.failures, 0)
+
+    def test_mirror_of_loser_kept(self):
+        # the slow primary is killed when the backup wins, it's not its failure
+        self.conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'echo x > "$out"; sleep 60')
+        self.conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'echo mp4 > "$out"')
+        self.conf.DOWNLOAD.hedge_min_rate = '1M'
+        self.conf.DOWNLOAD.hedge_delay = '0.2'
+        rtmp_mirror, http_mirror = self.run_with_mirrors(rtmp_failures=1)
+        self.assertEqual(rtmp_mirror.failures, 1)
+        self.assertEqual(http_mirror.failures, 0)
+
+    def test_mirror_released_on_spawn_error(self):
+        self.conf.COMMANDS.rtmpdump = os.path.join(self.tmpdir.name, 'missing')
+        self.conf.HTTP.mirrors = 'http://127.0.0.1:1'
+        downloads = Download.create(self.conf, [], {'work_dir': self.tmpdir.name,
+                                                    'destination': self.tmpdir.name})
+        rtmp_mirror = downloads.mirrors[Rtypes.RTMP].mirrors[0]
+        with self.assertRaises(OSError):
+            downloads.spawn(Download.parse_line('20151205_TS_Teaching.mp3'))
+        self.assertEqual(rtmp_mirror.active, 0)
+        self.assertEqual(rtmp_mirror.failures, 1)
+        self.assertEqual(downloads._mirror_of, {})
+
+    def test_no_backup_over_limit(self):
+        self.conf.COMMANDS.rtmpdump = self.script('rtmpdump', 'echo x > "$out"; exit 1')
+        self.conf.COMMANDS.ffmpeg = self.script('ffmpeg', 'echo mp4 > "$out"')
+        self.conf.BANDWIDTH.limit = '1k'
+        downloads = Download.create(self.conf, [], {'work_dir': self.tmpdir.name,
+                                                    'destination': self.tmpdir.name})
+        # the budget is already used up
+        downloads.throttle.can_spawn(0, 0)
+        downloads._done_bytes = 10 ** 9
+        file_record = Download.parse_line('20151205_TS_Teaching.mp3')
+        proc_info = downloads.spawn(file_record)
+        deadline = time.time() + 10
+        while proc_info.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertNotEqual(downloads.finished_handler(proc_info), 0)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir.name, '20151205_TS_Teaching.mp4')))
+        self.assertEqual(downloads._active, set())
+
+    def test_replay_list_failed(self):
+        self.conf.HTTP.replay_url = 'http://127.0.0.1:1/replay'
+        downloads = Download.create(self.conf, [], {'work_dir': self.tmpdir.name,
+                                                    'destination': self.tmpdir.name})
+        errors = downloads.out[MsgTypes.errors].msglist
+        self.assertEqual(len(errors), 1)
+        self.assertIn('HTTP replay list', errors[0][0])
+
+
+class TestWorkCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_file(self, name, size=100):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as ofl:
+            ofl.write(bytes(size))
+        return path
+
+    def test_lru(self):
+        work_cache = cache.WorkCache(self.tmpdir.name, 250, clock=self.clock)
+        paths = [self.make_file(name) for name in ('a.flv', 'b.flv', 'c.flv')]
+        for path in paths[:2]:
+            self.clock.now += 1
+            self.assertEqual(work_cache.store([path, 'rtmp://a.mp3']), [])
+        # 'a' is used by a running job
+        self.clock.now += 1
+        work_cache.use(paths[0])
+        self.clock.now += 1
+        self.assertEqual(work_cache.store([paths[2]]), [paths[1]])
+        self.assertIn(paths[0], work_cache)
+        self.assertNotIn(paths[1], work_cache)
+        self.assertEqual(work_cache.size(), 200)
+
+        # the index survives restart
+        work_cache = cache.WorkCache(self.tmpdir.name, 150, clock=self.clock)
+        self.clock.now += 1
+        self.assertEqual(work_cache.store([paths[0]]), [paths[2]])
+
+    def test_sweep_parts(self):
+        old = self.make_file('old.flv.part')
+        new = self.make_file('new.mp4.part')
+        self.clock.now = os.path.getmtime(new) + 100
+        os.utime(old, (self.clock.now - 1000, self.clock.now - 1000))
+        work_cache = cache.WorkCache(self.tmpdir.name, 1000, clock=self.clock)
+        self.assertEqual(work_cache.sweep_parts(500), [old])
+        self.assertTrue(os.path.exists(new))
+
+    def test_pipeline(self):
+        conf = Config()
+        conf.CLEANUP.cache_size = '1M'
+        conf.COMMANDS.rtmpdump = '/bin/true'
+        flv_path = self.make_file('rec.flv')
+        mp3_path = os.path.join(self.tmpdir.name, 'rec.mp3')
+        file_record = FileRecord(Fileinfo('rtmp://rec.mp3', Rtypes.RTMP))
+        file_record.add(Fileinfo(flv_path, Ftypes.FLV))
+        file_record.add(Fileinfo(mp3_path, Ftypes.MP3))
+        cleaning = Cleanup.create(conf, [file_record], {'work_dir': self.tmpdir.name})
+        cleaning()
+        self.assertTrue(os.path.exists(flv_path))
+
+        # download of cached file is skipped
+        downloads = Download(conf, [], destination=self.tmpdir.name)
+        self.assertIs(downloads.cache, cleaning.cache)
+        file_record = FileRecord(Fileinfo('rtmp://rec.mp3', Rtypes.RTMP))
+        self.assertIsNone(downloads.spawn(file_record))
+        self.assertEqual(downloads.finished_ready, [file_record])
+        self.assertEqual(downloads.out[MsgTypes.finished].msglist[0][0], flv_path)
+        self.assertEqual(len(downloads.out[MsgTypes.skipped]), 0)
+        self.assertIn(flv_path, downloads.cache.pinned)
+        # failed extracting of the cached file releases it
+        extracting = ExtractAudio(conf, [], destination=self.tmpdir.name)
+        file_record.add(Fileinfo(os.path.join(self.tmpdir.name, 'rec.mp3'), Ftypes.MP3))
+        extracting._failed(file_record, 'error', {})
+        self.assertNotIn(flv_path, downloads.cache.pinned)
+
+    def test_sweep_without_cache(self):
+        old = self.make_file('old.flv.part')
+        os.utime(old, (time.time() - 1000, time.time() - 1000))
+        conf = Config()
+        conf.CLEANUP.part_max_age = '500'
+        self.assertIsNone(cache.get_cache(conf, self.tmpdir.name))
+        self.assertFalse(os.path.exists(old))
+
+    def test_sweep_only_downloads(self):
+        names = ('old.flv.part', 'old.mp3.part.ranges', 'setup.exe.part', 'notes.part')
+        paths = [self.make_file(name) for name in names]
+        for path in paths:
+            os.utime(path, (time.time() - 1000, time.time() - 1000))
+        self.assertEqual(sorted(cache.sweep_parts(self.tmpdir.name, 500)), sorted(paths[:2]))
+        self.assertTrue(all(os.path.exists(path) for path in paths[2:]))
+        # off by default
+        old = self.make_file('other.flv.part')
+        os.utime(old, (time.time() - 10 ** 7, time.time() - 10 ** 7))
+        cache.get_cache(Config(), self.tmpdir.name)
+        self.assertTrue(os.path.exists(old))
+
+
+class TestControl(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self.tmpdir.name, 'replay_downloader.ini')
+        self.write(self.config_file, '[DOWNLOAD]\nconcurrency = 2\n')
+        self.conf = Config(self.config_file)
+        self.conf.RUN.resume_file = os.path.join(self.tmpdir.name, 'resume')
+        self.loop_delay = perform.LOOP_DELAY
+        perform.LOOP_DELAY = 0.01
+
+    def tearDown(self):
+        perform.LOOP_DELAY = self.loop_delay
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def write(path, text, mtime=None):
+        with open(path, 'w') as ofl:
+            ofl.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def make_controller(self, to_do, stage_names=('download', 'extract_audio')):
+        context = {'work_dir': self.tmpdir.name, 'destination': self.tmpdir.name,
+                   'concurrency': 3}
+        self.work, self.tasks = stages.build_pipeline(self.conf, list(stage_names), to_do,
+                                                      context)
+        return control.Controller(self.conf, self.work, to_do)
+
+    def test_reload_on_sighup(self):
+        controller = self.make_controller([])
+        scheduler = self.tasks['download']
+        self.assertEqual(scheduler.max_slots, 2)
+        self.assertIsNotNone(scheduler.watchdog)
+        self.write(self.config_file, '[RUN]\nconcurrency = 4\n[DOWNLOAD]\nconcurrency = 5\n'
+                   'stall_timeout = 0\n[BANDWIDTH]\nlimit = 1M\n')
+        with controller:
+            os.kill(os.getpid(), signal.SIGHUP)
+            controller.check()
+        self.assertEqual(scheduler.max_slots, 5)
+        self.assertEqual(scheduler.avail_slots, 5)
+        self.assertIsNone(scheduler.watchdog)
+        self.assertEqual(scheduler.obj.throttle.rate, 1024 * 1024)
+        self.assertEqual(scheduler.obj.throttle.bucket.rate, 1024 * 1024)
+        # stage without its own concurrency gets the new default
+        self.assertEqual(self.tasks['extract_audio'].max_slots, 4)
+
+    def test_control_file(self):
+        control_file = os.path.join(self.tmpdir.name, 'control')
+        self.conf.RUN.control_file = control_file
+        controller = self.make_controller([])
+        scheduler = self.tasks['download']
+        controller.check()
+        self.assertEqual(scheduler.max_slots, 2)
+
+        self.write(control_file, '[DOWNLOAD]\nconcurrency = 1\n', mtime=1000)
+        controller.check()
+        self.assertEqual(scheduler.max_slots, 1)
+
+        # invalid values are ignored
+        self.write(control_file, '[DOWNLOAD]\nconcurrency = many\n', mtime=2000)
+        controller.check()
+        self.assertEqual(scheduler.max_slots, 1)
+
+        self.write(control_file, '[RUN]\ndrain = yes\n', mtime=3000)
+        controller.check()
+        self.assertTrue(controller.draining)
+        self.assertTrue(scheduler.paused)
+        self.assertEqual(scheduler.max_slots, 2)
+
+    def test_drain_on_sigusr1(self):
+        rtmpdump = os.path.join(self.tmpdir.name, 'rtmpdump')
+        self.write(rtmpdump, '#!/bin/sh\nfor out; do :; done\nsleep 0.5\necho x > "$out"\n')
+        os.chmod(rtmpdump, 0o755)
+        self.conf.COMMANDS.rtmpdump = rtmpdump
+        self.conf.DOWNLOAD.concurrency = '1'
+        spool_path = os.path.join(self.tmpdir.name, 'spool')
+        to_do = TodoQueue(['a.mp3', 'b.mp3', 'c.mp3'], Download.parse_line,
+                          spool=SpoolFile(spool_path))
+        controller = self.make_controller(to_do, ['download'])
+        timer = threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGUSR1))
+        with controller:
+            timer.start()
+            perform.do_the_work(self.work, lambda: None, controller)
+        timer.join()
+
+        # the running download was finished, the others are back in the spool
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir.name, 'a.flv')))
+        self.assertEqual(controller.saved, 2)
+        self.assertEqual(controller.saved_to, spool_path)
+        to_do.spool.close()
+        resumed = TodoQueue([], Download.parse_line, spool=SpoolFile(spool_path))
+        self.assertEqual([Download.format_line(rec) for rec in resumed], ['b.mp3', 'c.mp3'])
+        resumed.spool.close()
+
+    def test_save_state(self):
+        to_do = Download.parse_todownload_list(['a.mp3', 'http://h/b.mp4'])
+        controller = self.make_controller(to_do)
+        self.assertFalse(controller.drained())
+        controller.drain()
+        self.assertTrue(controller.drained())
+        self.assertEqual(controller.save_state(), 2)
+        # the order of the list is kept
+        self.assertEqual(get_list_from_file(self.conf.RUN.resume_file),
+                         ['a.mp3', 'http://h/b.mp4'])
+        self.assertEqual(daemon.parse_command(['drain']), {'cmd': 'drain'})
+
+        # earlier resume file is kept
+        to_do.extend(Download.parse_todownload_list(['c.mp3']))
+        self.assertEqual(controller.save_state(), 1)
+        self.assertEqual(get_list_from_file(self.conf.RUN.resume_file), ['c.mp3'])
+        self.assertEqual(get_list_from_file(self.conf.RUN.resume_file + '.1'),
+                         ['a.mp3', 'http://h/b.mp4'])
+
+    def test_save_state_queue(self):
+        to_do = TodoQueue(['a.mp3', 'b.mp3'], Download.parse_line)
+        controller = self.make_controller(to_do)
+        self.assertEqual(controller.save_state(), 2)
+        self.assertEqual(get_list_from_file(self.conf.RUN.resume_file), ['a.mp3', 'b.mp3'])
+
+    def test_reload_keeps_runtime_concurrency(self):
+        controller = self.make_controller([])
+        service = daemon.Daemon(self.conf, self.work, self.tasks, [], controller=controller)
+        self.assertTrue(service.handle({'cmd': 'concurrency', 'stage': 'download',
+                                        'value': 7})['ok'])
+        self.write(self.config_file, '[DOWNLOAD]\nconcurrency = 5\n')
+        controller.reload()
+        self.assertEqual(self.tasks['download'].max_slots, 7)
+
+    def test_reload_keeps_command_line_concurrency(self):
+        self.make_controller([])
+        controller = control.Controller(self.conf, self.work, [], concurrency=3)
+        self.write(self.config_file, '[DOWNLOAD]\nconcurrency = 5\n')
+        controller.reload()
+        self.assertEqual(self.tasks['download'].max_slots, 3)
+        self.assertEqual(self.tasks['extract_audio'].max_slots, 3)
+
+
+class TestTools(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmpdir.name, 'cache', 'tools.json')
+        self.runs = os.path.join(self.tmpdir.name, 'runs')
+        self.ffmpeg = os.path.join(self.tmpdir.name, 'ffmpeg')
+        with open(self.ffmpeg, 'w') as ofl:
+            ofl.write('#!/bin/sh\necho run >> {}\n'
+                      'echo "ffmpeg version 6.1 Copyright"\n'
+                      'echo " --"\necho " DE mp3   MP2/3"\necho " D  aac   raw ADTS AAC"\n'
+                      'echo "  E ipod,mp4  MP4"\n'.format(self.runs))
+        os.chmod(self.ffmpeg, 0o755)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def probes(self):
+        try:
+            return len(get_list_from_file(self.runs))
+        except FileNotFoundError:
+            return 0
+
+    def test_find_tools(self):
+        found, missing = tools.find_tools([self.ffmpeg, 'no-such-command'], self.cache_file)
+        self.assertEqual(missing, ['no-such-command'])
+        self.assertEqual(found[self.ffmpeg]['version'], '6.1')
+        self.assertEqual(found[self.ffmpeg]['muxers'], ['ipod', 'mp3', 'mp4'])
+        self.assertEqual(self.probes(), 2)
+
+        # cached until the binary changes
+        found, _ = tools.find_tools([self.ffmpeg], self.cache_file)
+        self.assertEqual(found[self.ffmpeg]['version'], '6.1')
+        self.assertEqual(self.probes(), 2)
+        os.utime(self.ffmpeg, (1000, 1000))
+        tools.find_tools([self.ffmpeg], self.cache_file)
+        self.assertEqual(self.probes(), 4)
+
+    def test_check_required_tools(self):
+        work = Work()
+        extracting = ExtractAudio(Config(), [])
+        extracting.required_tools = [self.ffmpeg, '/bin/true']
+        work.add(ProcScheduler(extracting))
+        perform.check_required_tools(work, self.cache_file)
+        extracting.required_tools.append('no-such-command')
+        with self.assertRaises(SystemExit):
+            perform.check_required_tools(work, self.cache_file)
+
+    def test_lazy_imports(self):
+        code = ('import sys, replay_downloader.stages, replay_downloader.control, '
+                'replay_downloader.daemon, replay_downloader.planner; '
+                'print(" ".join(m for m in ("requests", "http.client", "ssl") '
+                'if m in sys.modules))')
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        out = Popen([sys.executable, '-c', code], cwd=root, stdout=PIPE).communicate()[0]
+        self.assertEqual(out.strip(), b'')